@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+swiftnbd. benchmarks common code
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import struct
+import socket
+import threading
+import tracemalloc
+
+# the Swift client mock up used by the tests
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+from test_swiftstorage import MockConnection
+
+def mock_storage(object_size=65536, objects=1024, **kwargs):
+    """
+    Return a SwiftStorage using the Swift client mock up.
+
+    The first 8 objects exist (filled with 0xff), the rest are holes.
+    """
+    import swiftnbd.swift as swift
+    import swiftnbd.pool as pool
+    from swiftnbd.cache import Cache
+
+    swift.client = MockConnection
+    pool.client = MockConnection
+    pool.reset_pools()
+
+    MockConnection.object_size = object_size
+    MockConnection()
+
+    if "cache" not in kwargs:
+        kwargs["cache"] = Cache(objects)
+    return swift.SwiftStorage(dict(), "container", object_size, objects, **kwargs)
+
+def start_server(stores, **kwargs):
+    """
+    Run a Server on a random local port in a background thread.
+
+    Returns the server and the port.
+    """
+    import asyncio
+    from swiftnbd.server import Server
+
+    server = Server(("127.0.0.1", 0), stores, **kwargs)
+    loop = asyncio.new_event_loop()
+    started = threading.Event()
+    ports = []
+
+    def run():
+        asyncio.set_event_loop(loop)
+        listener = loop.run_until_complete(server.start_server())
+        ports.append(listener.sockets[0].getsockname()[1])
+        started.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    started.wait()
+    return server, ports[0]
+
+class NBDClient(object):
+    """Minimal NBD client (fixed new-style handshake, simple replies)"""
+
+    NBD_CMD_READ = 0
+    NBD_CMD_WRITE = 1
+    NBD_CMD_DISC = 2
+    NBD_CMD_FLUSH = 3
+
+    REQUEST = struct.Struct(">LHHQQL")
+    RESPONSE = struct.Struct(">LLQ")
+
+    def __init__(self, port, export, host="127.0.0.1"):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lengths = dict()
+
+        self.recv(18)
+        # fixed new-style and no zeroes
+        self.sock.sendall(struct.pack(">L", 3))
+        name = export.encode("utf-8")
+        self.sock.sendall(struct.pack(">QLL", 0x49484156454F5054, 1, len(name)) + name)
+        self.size, self.flags = struct.unpack(">QH", self.recv(10))
+
+    def recv(self, size):
+        data = bytearray(size)
+        view = memoryview(data)
+        pos = 0
+        while pos < size:
+            received = self.sock.recv_into(view[pos:])
+            if not received:
+                raise IOError("Connection closed")
+            pos += received
+        return data
+
+    def send(self, cmd, handle, offset, length, data=None):
+        """Send a request without waiting for the reply"""
+        self.lengths[handle] = length if cmd == self.NBD_CMD_READ else 0
+        header = self.REQUEST.pack(0x25609513, 0, cmd, handle, offset, length)
+        if data:
+            self.sock.sendall(header + data)
+        else:
+            self.sock.sendall(header)
+
+    def reply(self):
+        """Wait for a reply, returns (handle, error, data)"""
+        (magic, error, handle) = self.RESPONSE.unpack(self.recv(self.RESPONSE.size))
+        length = self.lengths.pop(handle)
+        data = self.recv(length) if length and not error else None
+        return handle, error, data
+
+    def close(self):
+        self.send(self.NBD_CMD_DISC, 0, 0, 0)
+        self.lengths.clear()
+        self.sock.close()
+
+def peak_allocated(func, *args):
+    """Bytes allocated at the peak while running func (tracemalloc must be tracing)"""
+    tracemalloc.clear_traces()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    del result
+    return peak - current
+
+def report(results, as_json=False):
+    """Print the results, a list of dictionaries with the same keys"""
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+
+    keys = list(results[0].keys())
+    widths = [max(len(str(key)), *(len(str(result[key])) for result in results)) for key in keys]
+    print("  ".join(str(key).ljust(width) for key, width in zip(keys, widths)))
+    for result in results:
+        print("  ".join(str(result[key]).ljust(width) for key, width in zip(keys, widths)))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+swiftnbd. bytes copied per request microbenchmark
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import argparse
+import tracemalloc
+
+from benchmarks.common import mock_storage, peak_allocated, report
+
+KB = 1024
+
+# name, operation, offset and size (in bytes, object size is 64K)
+SCENARIOS = [
+    ("read 4K in object", "read", 16*KB, 4*KB),
+    ("read object", "read", 64*KB, 64*KB),
+    ("read 4 objects unaligned", "read", 32*KB, 256*KB),
+    ("write 4K in object", "write", 16*KB, 4*KB),
+    ("write object", "write", 64*KB, 64*KB),
+    ("write 4 objects unaligned", "write", 32*KB, 256*KB),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Bytes allocated per request in the read and write paths")
+    parser.add_argument("--json", dest="as_json", action="store_true",
+                        help="output the results as JSON")
+    args = parser.parse_args()
+
+    store = mock_storage()
+    results = []
+    tracemalloc.start()
+    try:
+        for name, operation, offset, size in SCENARIOS:
+            if operation == "read":
+                # as the server does it: the views are sent to the client
+                func, arg = store.read_views, size
+            else:
+                func, arg = store.write_at, b'X'*size
+
+            # warm up, the objects are in the cache
+            func(offset, arg)
+            peak = peak_allocated(func, offset, arg)
+            results.append(dict(scenario=name, request=size, allocated=peak, ratio=round(peak / size, 2)))
+    finally:
+        tracemalloc.stop()
+
+    report(results, args.as_json)
+
+if __name__ == "__main__":
+    main()
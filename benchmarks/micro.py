@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+swiftnbd. microbenchmarks: cost per operation of the hot paths
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import gc
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+
+from benchmarks.common import mock_storage, peak_allocated, report
+
+KB = 1024
+
+def cache_benchmarks():
+    """Cache.get/set with the cache filled at different levels"""
+    from swiftnbd.cache import Cache
+
+    size = 4*KB
+    capacity = 1024
+    data = b'X'*size
+
+    for fill in (10, 50, 100):
+        cache = Cache(capacity*size)
+        keys = list(range(capacity*fill // 100))
+        for key in keys:
+            cache.set(key, data)
+
+        hits = iter_cycle(keys)
+        yield "cache get hit (%s%% full)" % fill, lambda: cache.get(next(hits))
+        yield "cache get miss (%s%% full)" % fill, lambda: cache.get(-1)
+        updates = iter_cycle(keys)
+        yield "cache set existing (%s%% full)" % fill, lambda: cache.set(next(updates), data)
+
+    # every new object evicts another one
+    new = iter_cycle(range(capacity, capacity*4))
+    yield "cache set evicting (100% full)", lambda: cache.set(next(new), data)
+
+def storage_benchmarks():
+    """SwiftStorage reads and writes, the objects are cached (object size is 64K)"""
+    store = mock_storage(objects=64)
+
+    for name, offset, size in (("aligned 4K", 0, 4*KB),
+                               ("unaligned 4K", 1000, 4*KB),
+                               ("object", 64*KB, 64*KB),
+                               ("4 objects unaligned", 32*KB, 256*KB),
+                               ):
+        # warm up, the objects are in the cache
+        store.read_views(offset, size)
+        yield "storage read %s" % name, lambda offset=offset, size=size: store.read_views(offset, size)
+
+        data = b'X'*size
+        yield "storage write %s" % name, lambda offset=offset, data=data: store.write_at(offset, data)
+
+def server_benchmarks():
+    """Packing and unpacking the protocol headers"""
+    if not hasattr(asyncio, "coroutine"):
+        sys.stderr.write("skipping the server benchmarks: requires generator based coroutines (Python < 3.11)\n")
+        return
+
+    from swiftnbd.server import Server
+
+    class NullWriter(object):
+        def write(self, data):
+            pass
+
+        def writelines(self, data):
+            pass
+
+    server = Server(("127.0.0.1", 0), dict())
+    writer = NullWriter()
+    header = Server.REQUEST_HEADER.pack(Server.NBD_REQUEST, 0, Server.NBD_CMD_READ, 1, 4*KB, 4*KB)
+
+    yield "server request header unpack", lambda: Server.REQUEST_HEADER.unpack(header)
+    yield "server simple reply", lambda: server.nbd_response(writer, 1)
+    yield "server structured reply chunk", lambda: server.nbd_chunk(writer, 1, Server.NBD_REPLY_TYPE_NONE, done=True)
+
+def iter_cycle(items):
+    """Endless iterator over items"""
+    while True:
+        for item in items:
+            yield item
+
+def ops_per_second(func, duration):
+    """Run func for about duration seconds, returns the operations per second"""
+    ops = 0
+    batch = 1
+    # as timeit, the garbage collector doesn't add noise to the timing
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        while True:
+            for _ in range(batch):
+                func()
+            ops += batch
+            elapsed = time.perf_counter() - start
+            if elapsed >= duration:
+                return ops / elapsed
+            batch *= 2
+    finally:
+        if enabled:
+            gc.enable()
+
+def main():
+    parser = argparse.ArgumentParser(description="Operations per second and bytes allocated per operation of the hot paths")
+    parser.add_argument("--duration", type=float, default=0.2,
+                        help="seconds per benchmark run (default: 0.2)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs per benchmark, the best one is reported (default: 5)")
+    parser.add_argument("--filter", dest="filter", default="",
+                        help="run only the benchmarks with this text in their name")
+    parser.add_argument("--save", dest="save", metavar="FILE",
+                        help="save the results as a baseline in FILE")
+    parser.add_argument("--baseline", dest="baseline", metavar="FILE",
+                        help="compare the results with a baseline saved in FILE")
+    parser.add_argument("--json", dest="as_json", action="store_true",
+                        help="output the results as JSON")
+    args = parser.parse_args()
+
+    baseline = dict()
+    if args.baseline:
+        try:
+            with open(args.baseline, "r") as fd:
+                baseline = dict((result["benchmark"], result) for result in json.load(fd))
+        except (IOError, ValueError) as ex:
+            sys.exit("Failed to load the baseline: %s" % ex)
+
+    results = []
+    for benchmarks in (cache_benchmarks, storage_benchmarks, server_benchmarks):
+        for name, func in benchmarks():
+            if args.filter not in name:
+                continue
+
+            func()
+            rate = max(ops_per_second(func, args.duration) for _ in range(args.repeat))
+
+            tracemalloc.start()
+            try:
+                allocated = peak_allocated(func)
+            finally:
+                tracemalloc.stop()
+
+            result = dict(benchmark=name, ops=int(rate), allocated=allocated)
+            if args.baseline:
+                base = baseline.get(name)
+                # positive is faster than the baseline
+                result["change"] = "%+.1f%%" % (100.0*rate / base["ops"] - 100) if base else "-"
+            results.append(result)
+
+    if not results:
+        sys.exit("No benchmarks to run")
+
+    if args.save:
+        with open(args.save, "w") as fd:
+            json.dump([dict(benchmark=result["benchmark"], ops=result["ops"], allocated=result["allocated"])
+                       for result in results], fd, indent=2)
+
+    report(results, args.as_json)
+
+if __name__ == "__main__":
+    main()
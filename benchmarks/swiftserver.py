@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+swiftnbd. local Swift stand-in for the benchmarks
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import json
+import time
+import threading
+from hashlib import md5
+from urllib.parse import urlsplit, parse_qs, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class SwiftHandler(BaseHTTPRequestHandler):
+    """
+    Request handler implementing the subset of the Swift API used by swiftnbd.
+
+    Auth v1 (any user and key), account HEAD/GET, container GET/PUT/POST/HEAD/DELETE
+    and object GET/PUT/HEAD/DELETE.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def delay(self, size):
+        """Wait the injected latency and the time to transfer size bytes"""
+        wait = self.server.latency
+        if self.server.bandwidth:
+            wait += size / self.server.bandwidth
+        if wait:
+            time.sleep(wait)
+
+    def reply(self, status, body=b'', headers=None):
+        self.delay(len(body))
+        self.send_response(status)
+        for key, value in (headers or dict()).items():
+            self.send_header(key, value)
+        if self.command == "HEAD":
+            if not headers or "Content-Length" not in headers:
+                self.send_header("Content-Length", "0")
+            self.end_headers()
+        else:
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = self.rfile.read(length) if length else b''
+        self.delay(len(data))
+        return data
+
+    def meta(self, container):
+        """Update the container metadata from the request headers"""
+        for key, value in self.headers.items():
+            key = key.lower().replace("_", "-")
+            if key.startswith("x-container-meta-"):
+                # an empty value removes the metadata
+                if value:
+                    container.meta[key] = value
+                else:
+                    container.meta.pop(key, None)
+
+    def route(self):
+        """Split the path, returns (container, object)"""
+        parts = urlsplit(self.path)
+        self.query = parse_qs(parts.query)
+        path = unquote(parts.path).split("/", 4)
+        # /v1/account[/container[/object]]
+        if len(path) < 3 or path[1] != "v1":
+            return None, None
+        container = path[3] if len(path) > 3 and path[3] else None
+        name = path[4] if len(path) > 4 and path[4] else None
+        return container, name
+
+    def authorized(self):
+        if self.headers.get("X-Auth-Token") != self.server.token:
+            self.reply(401)
+            return False
+        return True
+
+    def do_GET(self):
+        if self.path.startswith("/auth/"):
+            self.reply(200, headers={"X-Storage-Url": self.server.storage_url,
+                                     "X-Auth-Token": self.server.token,
+                                     })
+            return
+        if self.path.startswith("/info"):
+            self.reply(200, json.dumps(dict(swift=dict(version="fake"))).encode("utf-8"))
+            return
+        if not self.authorized():
+            return
+
+        container, name = self.route()
+        if container is None:
+            self.reply(200, json.dumps([dict(name=name) for name in sorted(self.server.containers)]).encode("utf-8"),
+                       {"Content-Type": "application/json"})
+            return
+        store = self.server.containers.get(container)
+        if store is None:
+            self.reply(404)
+        elif name is None:
+            self.list(store)
+        else:
+            data = store.objects.get(name)
+            if data is None:
+                self.reply(404)
+            else:
+                self.reply(200, data, {"ETag": md5(data).hexdigest()})
+
+    def do_HEAD(self):
+        if not self.authorized():
+            return
+
+        container, name = self.route()
+        if container is None:
+            self.reply(204)
+            return
+        store = self.server.containers.get(container)
+        if store is None:
+            self.reply(404)
+        elif name is None:
+            headers = dict(store.meta)
+            headers["X-Container-Object-Count"] = str(len(store.objects))
+            self.reply(204, headers=headers)
+        elif name not in store.objects:
+            self.reply(404)
+        else:
+            self.reply(200, headers={"Content-Length": str(len(store.objects[name])),
+                                     "ETag": md5(store.objects[name]).hexdigest(),
+                                     })
+
+    def do_PUT(self):
+        data = self.body()
+        if not self.authorized():
+            return
+
+        container, name = self.route()
+        if container is None:
+            self.reply(405)
+            return
+        if name is None:
+            store = self.server.containers.setdefault(container, Container())
+            self.meta(store)
+            self.reply(201)
+            return
+        store = self.server.containers.get(container)
+        if store is None:
+            self.reply(404)
+            return
+        store.objects[name] = data
+        self.reply(201, headers={"ETag": md5(data).hexdigest()})
+
+    def do_POST(self):
+        self.body()
+        if not self.authorized():
+            return
+
+        container, name = self.route()
+        store = self.server.containers.get(container)
+        if store is None or name is not None:
+            self.reply(404)
+            return
+        self.meta(store)
+        self.reply(204)
+
+    def do_DELETE(self):
+        if not self.authorized():
+            return
+
+        container, name = self.route()
+        store = self.server.containers.get(container)
+        if store is None:
+            self.reply(404)
+        elif name is None:
+            if store.objects:
+                self.reply(409)
+            else:
+                del self.server.containers[container]
+                self.reply(204)
+        elif store.objects.pop(name, None) is None:
+            self.reply(404)
+        else:
+            self.reply(204)
+
+    def list(self, store):
+        prefix = self.query.get("prefix", [""])[0]
+        marker = self.query.get("marker", [""])[0]
+        limit = int(self.query.get("limit", [10000])[0])
+        listing = []
+        for name in sorted(store.objects):
+            if name.startswith(prefix) and name > marker:
+                data = store.objects[name]
+                listing.append(dict(name=name, hash=md5(data).hexdigest(), bytes=len(data)))
+                if len(listing) == limit:
+                    break
+
+        headers = dict(store.meta)
+        headers["Content-Type"] = "application/json"
+        if not listing:
+            self.reply(204, headers=headers)
+        else:
+            self.reply(200, json.dumps(listing).encode("utf-8"), headers)
+
+class Container(object):
+    """A container: its metadata and objects"""
+    def __init__(self):
+        self.meta = dict()
+        self.objects = dict()
+
+class SwiftServer(ThreadingHTTPServer):
+    """
+    Local Swift stand-in running in a background thread.
+
+    Every request waits 'latency' seconds, plus the time to transfer its body
+    at 'bandwidth' bytes per second (0 is unlimited).
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0, bandwidth=0, host="127.0.0.1"):
+        super(SwiftServer, self).__init__((host, 0), SwiftHandler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.token = "AUTH_tkbenchmark"
+        self.containers = dict()
+
+        host, port = self.server_address[:2]
+        self.auth_url = "http://%s:%s/auth/v1.0" % (host, port)
+        self.storage_url = "http://%s:%s/v1/AUTH_benchmark" % (host, port)
+
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def auth(self):
+        """Auth dictionary to create client connections"""
+        return dict(authurl=self.auth_url, user="benchmark", key="benchmark")
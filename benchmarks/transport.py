@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+swiftnbd. transport benchmark: requests per second
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+from benchmarks.common import mock_storage, start_server, NBDClient, report
+
+KB = 1024
+
+# name, command and request size
+WORKLOADS = [
+    ("read 4K", NBDClient.NBD_CMD_READ, 4*KB),
+    ("write 4K", NBDClient.NBD_CMD_WRITE, 4*KB),
+    ("read 64K", NBDClient.NBD_CMD_READ, 64*KB),
+    ]
+
+def run(client, cmd, size, depth, duration):
+    """Keep depth requests in flight for duration seconds, returns requests per second"""
+    data = b'X'*size if cmd == NBDClient.NBD_CMD_WRITE else None
+    # the first objects, in the cache after the first round
+    offsets = [random.randrange(0, 8*64*KB - size, size) for _ in range(1024)]
+
+    handle = 0
+    for _ in range(depth):
+        handle += 1
+        client.send(cmd, handle, offsets[handle % len(offsets)], size, data)
+
+    done = 0
+    start = time.time()
+    while time.time() - start < duration:
+        _, error, _ = client.reply()
+        if error:
+            raise IOError("Request failed: %s" % error)
+        done += 1
+        handle += 1
+        client.send(cmd, handle, offsets[handle % len(offsets)], size, data)
+    elapsed = time.time() - start
+
+    for _ in range(depth):
+        client.reply()
+
+    return done / elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="Requests per second of the stream and buffered transports")
+    parser.add_argument("--duration", type=float, default=2,
+                        help="seconds per workload (default: 2)")
+    parser.add_argument("--depth", type=int, nargs="+", default=[1, 16],
+                        help="requests in flight (default: 1 16)")
+    parser.add_argument("--json", dest="as_json", action="store_true",
+                        help="output the results as JSON")
+    args = parser.parse_args()
+
+    if not hasattr(asyncio, "coroutine"):
+        sys.exit("The server requires generator based coroutines (Python < 3.11)")
+
+    results = []
+    for buffered in (False, True):
+        store = mock_storage(objects=64)
+        server, port = start_server(dict(bench=store), buffered=buffered)
+        client = NBDClient(port, "bench")
+        for name, cmd, size in WORKLOADS:
+            for depth in args.depth:
+                rate = run(client, cmd, size, depth, args.duration)
+                results.append(dict(transport="buffered" if buffered else "stream",
+                                    workload=name, depth=depth, rps=int(rate)))
+        client.close()
+
+    report(results, args.as_json)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+swiftnbd. end-to-end benchmark: workloads against a local Swift stand-in
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+
+from swiftclient import client
+
+from benchmarks.common import start_server, NBDClient, report
+from benchmarks.swiftserver import SwiftServer
+
+KB = 1024
+MB = 1024**2
+
+# name, ratio of reads, sequential and writes between flushes (0 for no flushes)
+WORKLOADS = [
+    ("seq-read", 1.0, True, 0),
+    ("rand-read", 1.0, False, 0),
+    ("seq-write", 0.0, True, 0),
+    ("rand-write", 0.0, False, 0),
+    ("mixed", 0.7, False, 0),
+    ("fsync", 0.0, False, 4),
+    ]
+
+def setup_container(swift, name, object_size, objects):
+    """Setup a container with all its objects stored"""
+    from swiftnbd.const import disk_version
+    from swiftnbd.common import setMeta
+    from swiftnbd.swift import SwiftStorage
+
+    cli = client.Connection(**swift.auth())
+    cli.put_container(name, headers=setMeta(dict(version=disk_version, objects=objects, object_size=object_size)))
+
+    # the objects are stored directly, uploading them would take too long with latency
+    data = os.urandom(object_size)
+    container = swift.containers[name]
+    for object_num in range(objects):
+        container.objects[SwiftStorage.object_prefix + "%08i" % object_num] = data
+
+def wait_unlocked(swift, name, timeout=30):
+    """Wait until the server has unlocked the container"""
+    deadline = time.time() + timeout
+    while "x-container-meta-swiftnbd-client" in swift.containers[name].meta:
+        if time.time() > deadline:
+            raise IOError("%s still locked" % name)
+        time.sleep(0.05)
+
+def percentile(values, percent):
+    """Percentile of a sorted list"""
+    if not values:
+        return 0
+    return values[min(int(round(percent / 100.0 * (len(values) - 1))), len(values) - 1)]
+
+def run(client, disk_size, request_size, depth, duration, reads, sequential, fsync):
+    """
+    Keep depth requests in flight for duration seconds.
+
+    Returns (requests, bytes, latencies, elapsed).
+    """
+    data = b'X'*request_size
+    blocks = disk_size // request_size
+    state = dict(pos=0, writes=0)
+
+    def next_request():
+        if fsync and state["writes"] == fsync:
+            state["writes"] = 0
+            return NBDClient.NBD_CMD_FLUSH, 0, 0
+
+        if sequential:
+            offset = state["pos"]*request_size
+            state["pos"] = (state["pos"] + 1) % blocks
+        else:
+            offset = random.randrange(blocks)*request_size
+
+        if random.random() < reads:
+            return NBDClient.NBD_CMD_READ, offset, request_size
+        state["writes"] += 1
+        return NBDClient.NBD_CMD_WRITE, offset, request_size
+
+    sent = dict()
+    handle = 0
+
+    def send():
+        cmd, offset, length = next_request()
+        sent[handle] = (time.time(), length)
+        client.send(cmd, handle, offset, length, data if cmd == NBDClient.NBD_CMD_WRITE else None)
+
+    for _ in range(depth):
+        handle += 1
+        send()
+
+    latencies = []
+    transferred = 0
+    start = time.time()
+    while time.time() - start < duration:
+        reply_handle, error, _ = client.reply()
+        if error:
+            raise IOError("Request failed: %s" % error)
+        started, length = sent.pop(reply_handle)
+        latencies.append(time.time() - started)
+        transferred += length
+        handle += 1
+        send()
+    elapsed = time.time() - start
+
+    for _ in range(depth):
+        client.reply()
+
+    latencies.sort()
+    return len(latencies), transferred, latencies, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end workloads against a local Swift stand-in")
+    parser.add_argument("--duration", type=float, default=2,
+                        help="seconds per workload (default: 2)")
+    parser.add_argument("--depth", type=int, nargs="+", default=[1, 16],
+                        help="requests in flight (default: 1 16)")
+    parser.add_argument("--object-size", dest="object_size", type=int, nargs="+", default=[64*KB],
+                        help="object sizes in bytes (default: 65536)")
+    parser.add_argument("--request-size", dest="request_size", type=int, default=4*KB,
+                        help="request size in bytes (default: 4096)")
+    parser.add_argument("--disk-size", dest="disk_size", type=int, default=64,
+                        help="disk size in MB (default: 64)")
+    parser.add_argument("--cache", type=int, default=8,
+                        help="server cache in MB (default: 8)")
+    parser.add_argument("--latency", type=float, default=10,
+                        help="latency per Swift request in ms (default: 10)")
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="bandwidth per Swift connection in MB/s (default: 0, unlimited)")
+    parser.add_argument("--workload", dest="workloads", nargs="+",
+                        choices=[workload[0] for workload in WORKLOADS],
+                        help="workloads to run (default: all)")
+    parser.add_argument("--json", dest="as_json", action="store_true",
+                        help="output the results as JSON")
+    args = parser.parse_args()
+
+    if not hasattr(asyncio, "coroutine"):
+        sys.exit("The server requires generator based coroutines (Python < 3.11)")
+
+    from swiftnbd.swift import SwiftStorage
+    from swiftnbd.cache import Cache
+
+    swift = SwiftServer(args.latency / 1000.0, args.bandwidth*MB)
+
+    results = []
+    for object_size in args.object_size:
+        name = "bench-%s" % object_size
+        objects = args.disk_size*MB // object_size
+        setup_container(swift, name, object_size, objects)
+
+        # a store per run, so every run starts with a cold cache
+        runs = [(workload, depth) for workload in WORKLOADS for depth in args.depth
+                if not args.workloads or workload[0] in args.workloads]
+        stores = dict(("%s-%s" % (workload[0], depth), SwiftStorage(swift.auth(), name, object_size, objects,
+                                                                    Cache(args.cache*MB)))
+                      for workload, depth in runs)
+        server, port = start_server(stores)
+
+        for (workload, reads, sequential, fsync), depth in runs:
+            wait_unlocked(swift, name)
+            nbd = NBDClient(port, "%s-%s" % (workload, depth))
+            requests, transferred, latencies, elapsed = run(nbd, objects*object_size, args.request_size,
+                                                            depth, args.duration, reads, sequential, fsync)
+            nbd.close()
+
+            results.append(dict(workload=workload,
+                                object_size=object_size,
+                                depth=depth,
+                                iops=int(requests / elapsed),
+                                mbps=round(transferred / elapsed / MB, 2),
+                                p50_ms=round(percentile(latencies, 50)*1000, 2),
+                                p99_ms=round(percentile(latencies, 99)*1000, 2),
+                                ))
+
+        wait_unlocked(swift, name)
+
+    report(results, args.as_json)
+
+if __name__ == "__main__":
+    main()
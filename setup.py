@@ -30,7 +30,7 @@ setup(name="swiftnbd",
       zip_safe=False,
       install_requires=install_requires,
       scripts=["bin/swiftnbd-server", "bin/swiftnbd-ctl"],
-      packages=find_packages(exclude=["tests"]),
+      packages=find_packages(exclude=["tests", "benchmarks"]),
       classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Console",
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+swiftnbd. admin socket
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import json
+import logging
+import asyncio
+
+class AdminError(Exception):
+    pass
+
+class Admin(object):
+    """
+    Admin socket to inspect and tune the server while it runs.
+
+    The requests and replies are JSON objects, one per line. A request has
+    the command, and the export and the value if the command needs them; the
+    reply has either the result or an error.
+    """
+    COMMANDS = ("stats", "cache", "cache-limit", "drop-cache", "warm-cache",
+                "read-ahead", "concurrency", "debug")
+
+    def __init__(self, server):
+        self.server = server
+        self.log = logging.getLogger(__package__)
+
+    @asyncio.coroutine
+    def start_server(self, path):
+        """Create the asyncio server, the socket can be used only by the owner"""
+        umask = os.umask(0o177)
+        try:
+            server = yield from asyncio.start_unix_server(self.handler, path)
+        finally:
+            os.umask(umask)
+        return server
+
+    @asyncio.coroutine
+    def handler(self, reader, writer):
+        try:
+            while True:
+                line = yield from reader.readline()
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    if not isinstance(request, dict):
+                        raise AdminError("invalid request")
+                    result = yield from self.execute(request.get("command"), request.get("export"),
+                                                     request.get("value"))
+                    reply = dict(result=result)
+                except (ValueError, TypeError) as ex:
+                    reply = dict(error="invalid request: %s" % ex)
+                except (AdminError, IOError) as ex:
+                    reply = dict(error=str(ex))
+
+                writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+                yield from writer.drain()
+        except IOError as ex:
+            self.log.debug("admin request failed: %s" % ex)
+        finally:
+            writer.close()
+
+    def get_store(self, name):
+        if name is None:
+            raise AdminError("export required")
+        if name not in self.server.stores:
+            raise AdminError("unknown export %r" % name)
+        return self.server.stores[name]
+
+    @staticmethod
+    def get_int(value, minimum=0):
+        if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+            raise AdminError("invalid value %r, an integer >= %s is required" % (value, minimum))
+        return value
+
+    @asyncio.coroutine
+    def execute(self, command, export=None, value=None):
+        """Execute a command, returns the result (raises AdminError on error)"""
+        if command not in self.COMMANDS:
+            raise AdminError("unknown command %r" % command)
+
+        if command == "stats":
+            if export is None:
+                return dict((name, self.stats(store)) for name, store in self.server.stores.items())
+            return self.stats(self.get_store(export))
+
+        store = self.get_store(export)
+
+        if command == "cache":
+            return self.cache(store)
+
+        if command == "cache-limit":
+            limit = self.get_int(value, 1)
+            self.log.info("%s: cache limit set to %s MB" % (store, limit))
+            store.cache.resize(limit*1024**2)
+            return self.cache(store)
+
+        if command == "drop-cache":
+            size = store.cache.size
+            store.cache.flush()
+            self.log.info("%s: cache dropped (%s bytes)" % (store, size))
+            return dict(dropped=size)
+
+        if command == "warm-cache":
+            if not isinstance(value, list) or len(value) != 2:
+                raise AdminError("invalid value %r, first and last objects are required" % (value,))
+            first, last = self.get_int(value[0]), self.get_int(value[1])
+            if first > last or first >= store.objects:
+                raise AdminError("invalid range of objects %s-%s" % (first, last))
+            self.log.info("%s: warming the cache, objects %s-%s" % (store, first, last))
+            cached = yield from self.server.aio[store].run(store.warm, first, last)
+            return dict(cached=cached)
+
+        if command == "read-ahead":
+            if store.prefetcher is None:
+                raise AdminError("%s: read-ahead is disabled" % store)
+            window = self.get_int(value)
+            self.log.info("%s: read-ahead set to %s" % (store, window))
+            store.prefetcher.resize(window)
+            return dict(read_ahead=window)
+
+        if command == "concurrency":
+            concurrency = self.get_int(value, 1)
+            self.log.info("%s: concurrency set to %s" % (store, concurrency))
+            store.set_concurrency(concurrency)
+            return dict(concurrency=concurrency)
+
+        if command == "debug":
+            if value not in ("on", "off"):
+                raise AdminError("invalid value %r, on or off is required" % (value,))
+            self.log.info("%s: debug %s" % (store, value))
+            store.log.setLevel(logging.DEBUG if value == "on" else logging.NOTSET)
+            return dict(debug=store.log.isEnabledFor(logging.DEBUG))
+
+    def stats(self, store):
+        """Stats of an export"""
+        stats = self.server.stats[store]
+        cache = store.cache
+        result = dict(locked=store.locked,
+                      requests=dict(stats.requests),
+                      bytes=dict(stats.bytes),
+                      errors=dict(stats.errors),
+                      in_flight=stats.in_flight,
+                      swift=dict(bytes_in=store.bytes_in, bytes_out=store.bytes_out),
+                      latency=dict((method, dict(count=count, sum=total))
+                                   for method, (_, _, count, total)
+                                   in ((method, histogram.snapshot())
+                                       for method, histogram in store.latency.items())),
+                      cache=dict(hits=cache.hits, misses=cache.misses, evictions=cache.evictions,
+                                 size=cache.size, limit=cache.limit, objects=len(cache)),
+                      concurrency=store.concurrency,
+                      debug=store.log.isEnabledFor(logging.DEBUG),
+                      )
+        if store.prefetcher is not None:
+            result["read_ahead"] = dict(window=store.prefetcher.window, max=store.prefetcher.max_window,
+                                        hits=store.prefetcher.hits, wasted=store.prefetcher.wasted)
+        if store.write_back is not None:
+            result["write_back"] = dict(dirty_bytes=store.write_back.dirty_bytes,
+                                        dirty_objects=len(store.write_back))
+        return result
+
+    def cache(self, store):
+        """Summary of the contents of the cache of an export"""
+        cache = store.cache
+        return dict(size=cache.size, limit=cache.limit, objects=len(cache),
+                    recent=dict(objects=len(cache.recent), size=cache.recent_size),
+                    frequent=dict(objects=len(cache.frequent), size=cache.frequent_size),
+                    ghost=dict(objects=len(cache.recent_ghost) + len(cache.frequent_ghost),
+                               size=cache.recent_ghost_size + cache.frequent_ghost_size),
+                    ranges=self.ranges(cache.keys()))
+
+    @staticmethod
+    def ranges(object_nums):
+        """Sorted [first, last] ranges of consecutive object numbers"""
+        ranges = []
+        for object_num in sorted(object_nums):
+            if ranges and ranges[-1][1] + 1 == object_num:
+                ranges[-1][1] = object_num
+            else:
+                ranges.append([object_num, object_num])
+        return ranges
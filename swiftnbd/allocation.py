@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+swiftnbd. allocation bitmap
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import re
+import threading
+
+_not_empty = re.compile(b"[^\x00]")
+_not_full = re.compile(b"[^\xff]")
+
+class Allocation(object):
+    """
+    Allocation bitmap.
+
+    Keeps one bit per object telling if the object exists in the storage, so
+    reading an object that was never written doesn't need a request to know
+    that it's a hole.
+
+    It is thread safe.
+    """
+    def __init__(self, objects):
+        self.objects = objects
+        self.bitmap = bytearray((objects + 7) // 8)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        """Number of allocated objects"""
+        return self.count
+
+    def __contains__(self, object_num):
+        if not 0 <= object_num < self.objects:
+            return False
+        return bool(self.bitmap[object_num >> 3] & (1 << (object_num & 7)))
+
+    def add(self, object_num):
+        """Mark an object as allocated"""
+        if not 0 <= object_num < self.objects:
+            return
+        with self.lock:
+            mask = 1 << (object_num & 7)
+            if not self.bitmap[object_num >> 3] & mask:
+                self.bitmap[object_num >> 3] |= mask
+                self.count += 1
+
+    def discard(self, object_num):
+        """Mark an object as a hole"""
+        if not 0 <= object_num < self.objects:
+            return
+        with self.lock:
+            mask = 1 << (object_num & 7)
+            if self.bitmap[object_num >> 3] & mask:
+                self.bitmap[object_num >> 3] &= ~mask & 0xff
+                self.count -= 1
+
+    def next_change(self, object_num):
+        """
+        First object after object_num with a different allocation state.
+
+        Returns the number of objects if there's no change until the end.
+        """
+        allocated = object_num in self
+        object_num += 1
+
+        # bit by bit until the next byte, then byte by byte
+        while object_num < self.objects and object_num & 7:
+            if (object_num in self) != allocated:
+                return object_num
+            object_num += 1
+
+        if object_num >= self.objects:
+            return self.objects
+
+        match = (_not_full if allocated else _not_empty).search(self.bitmap, object_num >> 3)
+        if match is None:
+            return self.objects
+
+        object_num = match.start() << 3
+        while object_num < self.objects and (object_num in self) == allocated:
+            object_num += 1
+        return object_num
+
+    def to_bytes(self):
+        """The bitmap as bytes (see from_bytes)"""
+        with self.lock:
+            return bytes(self.bitmap)
+
+    @classmethod
+    def from_bytes(cls, objects, data):
+        """Create an allocation from a bitmap (see to_bytes)"""
+        allocation = cls(objects)
+        if len(data) != len(allocation.bitmap):
+            raise ValueError("Invalid bitmap size (%s), %s expected" % (len(data), len(allocation.bitmap)))
+        for object_num in range(objects):
+            if data[object_num >> 3] & (1 << (object_num & 7)):
+                allocation.add(object_num)
+        return allocation
+
+    def clear(self):
+        """Mark all the objects as holes"""
+        with self.lock:
+            self.bitmap = bytearray(len(self.bitmap))
+            self.count = 0
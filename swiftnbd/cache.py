@@ -23,58 +23,206 @@ THE SOFTWARE.
 """
 
 import logging
-from collections import Counter
+import threading
+from time import monotonic
+from collections import OrderedDict
+
+from swiftnbd.const import cache_correlated
 
 class Cache(object):
     """
     Cache manager.
 
-    This is an in-memory cache manager that stores up to 'limit' items (objects),
-    releasing the least frequently used when the limit is reached.
+    This is an in-memory cache manager that stores up to 'limit' bytes using
+    an Adaptive Replacement Cache (ARC) policy: the objects seen once and the
+    objects seen more than once are kept in two LRU lists, and the space given
+    to each list adapts using the history of recently released objects. This
+    way a scan only displaces objects that were seen once.
+
+    References to an object seen once that come within 'correlated' seconds
+    of the previous one are considered the same reference (eg, a scan reading
+    an object in several requests), so they don't make the object frequent.
+
+    All the operations are O(1) and the cache is thread safe.
     """
-    def __init__(self, limit):
+    def __init__(self, limit, correlated=cache_correlated):
 
         self.limit = limit
-        self.ref = Counter()
-        self.data = dict()
+        self.correlated = correlated
+
+        # target size of the recent list
+        self.target = 0
+
+        # recent and frequent lists: object_name -> data
+        self.recent = OrderedDict()
+        self.frequent = OrderedDict()
+        self.recent_size = 0
+        self.frequent_size = 0
+
+        # last reference to the objects in the recent list: object_name -> time
+        self.referenced = dict()
+
+        # history of released objects: object_name -> size
+        self.recent_ghost = OrderedDict()
+        self.frequent_ghost = OrderedDict()
+        self.recent_ghost_size = 0
+        self.frequent_ghost_size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.lock = threading.Lock()
 
         self.log = logging.getLogger(__package__)
         self.log.debug("cache size: %s" % self.limit)
 
     def __len__(self):
-        return len(self.data)
+        return len(self.recent) + len(self.frequent)
 
-    def get(self, object_name, default=None):
-        """Get an element from the cache"""
-        if self.ref[object_name] > 0:
-            self.ref[object_name] += 1
+    def __contains__(self, object_name):
+        return object_name in self.recent or object_name in self.frequent
 
-            self.log.debug("cache get hit: %s, %s" % (object_name, self.ref[object_name]))
-            return self.data[object_name]
+    @property
+    def size(self):
+        """Size in bytes of the cached data"""
+        return self.recent_size + self.frequent_size
 
-        self.log.debug("cache get miss: %s, %s" % (object_name, self.ref[object_name]))
-        return default
+    def get(self, object_name, default=None):
+        """Get an element from the cache"""
+        with self.lock:
+            if object_name in self.frequent:
+                self.frequent.move_to_end(object_name)
+                data = self.frequent[object_name]
+            elif object_name in self.recent:
+                now = monotonic()
+                if now - self.referenced[object_name] < self.correlated:
+                    # same reference, still seen once
+                    self.referenced[object_name] = now
+                    data = self.recent[object_name]
+                else:
+                    data = self.recent.pop(object_name)
+                    del self.referenced[object_name]
+                    self.recent_size -= len(data)
+                    self.frequent[object_name] = data
+                    self.frequent_size += len(data)
+            else:
+                self.misses += 1
+                self.log.debug("cache get miss: %s" % object_name)
+                return default
+
+            self.hits += 1
+            self.log.debug("cache get hit: %s" % object_name)
+            return data
 
     def set(self, object_name, data):
         """Put/update an element in the cache"""
-        self.data[object_name] = data
-        self.ref[object_name] += 1
-
-        self.log.debug("cache set: %s, %s" % (object_name, self.ref[object_name]))
-
-        if len(self.data) > self.limit:
-            self.log.debug("cache size is over limit (%s > %s)" % (len(self.data), self.limit))
-            less_used = self.ref.most_common()[:-3:-1]
-            for key, _ in less_used:
-                if object_name != key:
-                    self.log.debug("cache free: %s, %s" % (key, self.ref[key]))
-                    del self.ref[key]
-                    del self.data[key]
-                    break
+        size = len(data)
+        if size > self.limit:
+            return
+
+        with self.lock:
+            frequent = True
+            from_frequent_ghost = False
+
+            if object_name in self.recent:
+                # updating an object is not a new reference
+                self.recent_size -= len(self.recent.pop(object_name))
+                frequent = False
+            elif object_name in self.frequent:
+                self.frequent_size -= len(self.frequent.pop(object_name))
+            elif object_name in self.recent_ghost:
+                # the recent list was too small
+                delta = max(self.frequent_ghost_size // self.recent_ghost_size, 1) * size
+                self.target = min(self.target + delta, self.limit)
+                self.recent_ghost_size -= self.recent_ghost.pop(object_name)
+            elif object_name in self.frequent_ghost:
+                # the frequent list was too small
+                delta = max(self.recent_ghost_size // self.frequent_ghost_size, 1) * size
+                self.target = max(self.target - delta, 0)
+                self.frequent_ghost_size -= self.frequent_ghost.pop(object_name)
+                from_frequent_ghost = True
+            else:
+                frequent = False
+
+            self._release(size, from_frequent_ghost)
+
+            if frequent:
+                self.frequent[object_name] = data
+                self.frequent_size += size
+            else:
+                self.recent[object_name] = data
+                self.recent_size += size
+                self.referenced[object_name] = monotonic()
+
+            self._trim_history()
+
+            self.log.debug("cache set: %s (%s)" % (object_name, "frequent" if frequent else "recent"))
+
+    def discard(self, object_name):
+        """Remove an element from the cache"""
+        with self.lock:
+            if object_name in self.recent:
+                self.recent_size -= len(self.recent.pop(object_name))
+                del self.referenced[object_name]
+            elif object_name in self.frequent:
+                self.frequent_size -= len(self.frequent.pop(object_name))
+
+    def _release(self, size, from_frequent_ghost=False):
+        """Release objects until there's room for size bytes"""
+        while self.recent_size + self.frequent_size + size > self.limit:
+            if self.recent and (self.recent_size > self.target
+                                or (from_frequent_ghost and self.recent_size >= self.target)
+                                or not self.frequent):
+                key, data = self.recent.popitem(last=False)
+                del self.referenced[key]
+                self.recent_size -= len(data)
+                self.recent_ghost[key] = len(data)
+                self.recent_ghost_size += len(data)
+            else:
+                key, data = self.frequent.popitem(last=False)
+                self.frequent_size -= len(data)
+                self.frequent_ghost[key] = len(data)
+                self.frequent_ghost_size += len(data)
+
+            self.evictions += 1
+            self.log.debug("cache free: %s" % key)
+
+    def _trim_history(self):
+        """Keep the history of released objects bounded"""
+        while self.recent_ghost and self.recent_size + self.recent_ghost_size > self.limit:
+            _, size = self.recent_ghost.popitem(last=False)
+            self.recent_ghost_size -= size
+
+        while self.frequent_ghost and self.size + self.recent_ghost_size + self.frequent_ghost_size > 2*self.limit:
+            _, size = self.frequent_ghost.popitem(last=False)
+            self.frequent_ghost_size -= size
+
+    def resize(self, limit):
+        """Change the limit, releasing objects if the cache is bigger"""
+        with self.lock:
+            self.log.debug("cache resize: %s, was %s" % (limit, self.limit))
+            self.limit = limit
+            self.target = min(self.target, limit)
+            self._release(0)
+            self._trim_history()
+
+    def keys(self):
+        """Names of the cached objects"""
+        with self.lock:
+            return list(self.recent) + list(self.frequent)
 
     def flush(self):
         """Flush the cache"""
-        self.log.debug("cache flush, was (%s): %s" % (len(self.data), self.ref))
-        self.ref = Counter()
-        self.data = dict()
-
+        with self.lock:
+            self.log.debug("cache flush, was (%s): %s bytes" % (len(self), self.size))
+            self.target = 0
+            self.recent = OrderedDict()
+            self.frequent = OrderedDict()
+            self.recent_size = 0
+            self.frequent_size = 0
+            self.referenced = dict()
+            self.recent_ghost = OrderedDict()
+            self.frequent_ghost = OrderedDict()
+            self.recent_ghost_size = 0
+            self.frequent_ghost_size = 0
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+swiftnbd. write coalescing
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+
+from swiftnbd.const import coalesce_window
+
+class Window(object):
+    """Writes to an object being merged"""
+    def __init__(self):
+        # (object_pos, data) in the order they were received
+        self.patches = []
+        self.expired = asyncio.Event()
+        self.done = asyncio.Future()
+
+class Coalescer(object):
+    """
+    Write coalescing window.
+
+    The writes that fall within one object (without covering it) are merged in
+    memory for up to 'window' seconds since the first one, and the object is
+    stored once with the merge(object_num, patches) coroutine. The writers wait
+    until the merged object is stored, so the writes are acknowledged as usual.
+
+    The windows of an object are stored in order, and the pending patches can
+    be applied to the data read meanwhile with overlay().
+    """
+    def __init__(self, object_size, merge, window=coalesce_window):
+        self.object_size = object_size
+        self.merge = merge
+        self.window = window
+
+        # object_num: window accepting writes
+        self.open = dict()
+        # object_num: [windows being stored]
+        self.committing = dict()
+
+    def __len__(self):
+        return len(self.open) + len(self.committing)
+
+    def accepts(self, offset, length):
+        """Check if a write can be merged"""
+        if self.window <= 0 or length <= 0:
+            return False
+        object_pos = offset % self.object_size
+        return length < self.object_size and object_pos + length <= self.object_size
+
+    @asyncio.coroutine
+    def write(self, offset, data):
+        """Merge a write, returns when the object has been stored"""
+        object_num, object_pos = divmod(offset, self.object_size)
+        window = self.open.get(object_num)
+        if window is None:
+            window = Window()
+            self.open[object_num] = window
+            asyncio.ensure_future(self._commit(object_num, window))
+
+        window.patches.append((object_pos, data))
+        # other writers wait for the same future
+        yield from asyncio.shield(window.done)
+
+    def expire(self, offset=0, length=None):
+        """Close now the windows of the objects in a range (all of them by default)"""
+        if length is None:
+            objects = list(self.open)
+        else:
+            first = offset // self.object_size
+            last = (offset + max(length, 1) - 1) // self.object_size
+            objects = [object_num for object_num in self.open if first <= object_num <= last]
+
+        for object_num in objects:
+            self.open[object_num].expired.set()
+
+    @asyncio.coroutine
+    def flush(self):
+        """Close all the windows and wait until they are stored"""
+        self.expire()
+        windows = list(self.open.values())
+        for committing in self.committing.values():
+            windows.extend(committing)
+        if windows:
+            yield from asyncio.wait([window.done for window in windows])
+
+    def snapshot(self, offset, length):
+        """Patches pending in a range (object_num: patches)"""
+        first = offset // self.object_size
+        last = (offset + max(length, 1) - 1) // self.object_size
+
+        snapshot = dict()
+        for object_num in range(first, last + 1):
+            patches = []
+            for window in self.committing.get(object_num, []):
+                patches.extend(window.patches)
+            if object_num in self.open:
+                patches.extend(self.open[object_num].patches)
+            if patches:
+                snapshot[object_num] = patches
+        return snapshot
+
+    def overlay(self, offset, views, snapshot):
+        """
+        Apply the patches in snapshot (see snapshot()) to the views read
+        starting at offset (one view per object, see SwiftStorage.read_views).
+        """
+        object_num, start = divmod(offset, self.object_size)
+        result = []
+        for view in views:
+            patches = snapshot.get(object_num)
+            if patches:
+                end = start + len(view)
+                view = bytearray(view)
+                for object_pos, data in patches:
+                    _start = max(start, object_pos)
+                    _end = min(end, object_pos + len(data))
+                    if _start < _end:
+                        view[_start - start:_end - start] = data[_start - object_pos:_end - object_pos]
+                view = memoryview(view)
+            result.append(view)
+            object_num += 1
+            start = 0
+        return result
+
+    @asyncio.coroutine
+    def _commit(self, object_num, window):
+        try:
+            yield from asyncio.wait_for(window.expired.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+
+        # the next writes open a new window
+        del self.open[object_num]
+        committing = self.committing.setdefault(object_num, [])
+        previous = committing[-1] if committing else None
+        committing.append(window)
+        try:
+            if previous is not None:
+                yield from asyncio.wait([previous.done])
+            yield from self.merge(object_num, window.patches)
+        except Exception as ex:
+            window.done.set_exception(ex)
+        else:
+            window.done.set_result(None)
+        finally:
+            committing.remove(window)
+            if not committing:
+                del self.committing[object_num]
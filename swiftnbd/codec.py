@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+swiftnbd. compression codecs
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import zlib
+
+class Codec(object):
+    """
+    Compression codec.
+
+    compress(data) and decompress(data) work on bytes, and decompress raises
+    any exception on invalid data.
+    """
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+    def __str__(self):
+        return self.name
+
+_codecs = dict()
+
+def register(name, compress, decompress):
+    """Register a codec, replacing any other with the same name"""
+    _codecs[name] = Codec(name, compress, decompress)
+
+def codecs():
+    """Names of the available codecs"""
+    return sorted(_codecs.keys())
+
+def get_codec(name):
+    """Get a codec by name, raises ValueError if it's not available"""
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("codec %s is not available (available: %s)" % (name, ", ".join(codecs())))
+
+register("zlib", lambda data: zlib.compress(data, 6), zlib.decompress)
+
+# faster codecs, if they are installed
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    register("lz4", lz4.frame.compress, lz4.frame.decompress)
+
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    register("zstd",
+             lambda data: zstandard.ZstdCompressor().compress(data),
+             lambda data: zstandard.ZstdDecompressor().decompress(data))
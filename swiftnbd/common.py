@@ -25,9 +25,40 @@ THE SOFTWARE.
 import logging
 from logging.handlers import SysLogHandler
 import os
+import threading
+from collections import defaultdict
 
 from configparser import RawConfigParser
 
+from swiftnbd.const import latency_buckets
+
+class Histogram(object):
+    """
+    Histogram of observed values (eg, latencies in seconds).
+
+    The buckets are cumulative: counts[i] is the number of values less or
+    equal than buckets[i]. It is thread safe.
+    """
+    def __init__(self, buckets=latency_buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0]*len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    def snapshot(self):
+        """Consistent copy of the histogram: (buckets, counts, count, sum)"""
+        with self.lock:
+            return self.buckets, list(self.counts), self.count, self.sum
+
 class Stats(object):
     """Store and log stats."""
     def __init__(self, store):
@@ -35,8 +66,22 @@ class Stats(object):
 
         self.bytes_in = 0
         self.bytes_out = 0
+
+        # per command (name): requests, bytes and errors
+        self.requests = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.in_flight = 0
+
         self.log = logging.getLogger(__package__)
 
+    def request(self, command, size=0, error=False):
+        """Count a request that has finished"""
+        self.requests[command] += 1
+        self.bytes[command] += size
+        if error:
+            self.errors[command] += 1
+
     def log_stats(self):
         """Log stats."""
         self.log.info("STATS: %s in=%s (%s), out=%s (%s)" % (self.store,
@@ -46,9 +91,27 @@ class Stats(object):
                                                              self.store.bytes_in,
                                                              ))
 
-        cache = len(self.store.cache) * self.store.object_size
-        limit = self.store.cache.limit * self.store.object_size
-        self.log.info("CACHE: %s size=%s, limit=%s (%.2f%%)" % (self.store, cache, limit, (cache*100.0/limit)))
+        cache = self.store.cache
+        self.log.info("CACHE: %s size=%s, limit=%s (%.2f%%), hits=%s, misses=%s, evictions=%s" % (self.store,
+                                                                                            cache.size,
+                                                                                            cache.limit,
+                                                                                            (cache.size*100.0/cache.limit),
+                                                                                            cache.hits,
+                                                                                            cache.misses,
+                                                                                            cache.evictions,
+                                                                                            ))
+
+        if self.store.prefetcher is not None:
+            prefetcher = self.store.prefetcher
+            self.log.info("PREFETCH: %s window=%s, hits=%s, wasted=%s" % (self.store, prefetcher.window, prefetcher.hits, prefetcher.wasted))
+
+        if self.store.disk_cache is not None:
+            disk_cache = self.store.disk_cache
+            self.log.info("DISK CACHE: %s size=%s, hits=%s, misses=%s" % (self.store, disk_cache.size, disk_cache.hits, disk_cache.misses))
+
+        if self.store.write_back is not None:
+            write_back = self.store.write_back
+            self.log.info("WRITE-BACK: %s dirty=%s (%s objects)" % (self.store, write_back.dirty_bytes, len(write_back)))
 
 class Config(object):
     """Manage configuration read from a secrets file."""
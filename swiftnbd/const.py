@@ -37,10 +37,18 @@ secrets_file = "/etc/swiftnbd/secrets.conf"
 
 # for disk format versioning
 disk_version = "1"
+# objects compressed with the codec in the container metadata
+disk_version_compressed = "2"
+
+# default compression codec
+default_codec = "zlib"
 
 # stats delay (seconds)
 stats_delay = 300
 
+# upper bounds of the buckets of the latency histograms (seconds)
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
 # default tenant separator for auth 2.0 (eg, . for tenant.user)
 keystone_separator = "."
 
@@ -50,3 +58,62 @@ keystone_service = "object-store"
 # default endpoint type for auth 2.0
 keystone_endpoint = "publicURL"
 
+
+# cache: references to an object within this period (seconds) since the
+# previous one are correlated (eg, reads of parts of the same object)
+cache_correlated = 1
+
+# threads per store running the blocking storage operations
+storage_workers = 4
+
+# requests in flight per connection, and the bytes they can carry
+max_requests = 16
+max_request_bytes = 32*1024**2
+
+# write coalescing: seconds the writes within an object are merged
+# before storing it (0 disables it)
+coalesce_window = 0
+
+# buffered transport: size of the receive buffer per connection (bytes),
+# write payloads that don't fit are received into their own buffer
+receive_buffer = 256*1024
+
+# write-back: max age (seconds) and size (bytes) of the dirty data,
+# and threads uploading it
+write_back_age = 5
+write_back_size = 16*1024**2
+write_back_workers = 4
+# seconds before retrying failed uploads (doubled on each failure)
+write_back_retry = 1
+write_back_retry_max = 60
+
+# read-ahead: max objects prefetched, and threads fetching them
+read_ahead = 16
+read_ahead_workers = 4
+
+# objects written at once when writing zeros that can't be holes
+zero_objects = 64
+
+# max extents replied to a block status request
+max_extents = 1024
+
+# objects per page when listing a container
+listing_limit = 10000
+
+# concurrent requests to the storage per store
+concurrency = 8
+
+# connections per auth identity, lifetime of the auth token (seconds)
+# and delay between checks of idle connections (seconds)
+pool_size = 16
+token_ttl = 3600
+pool_check_delay = 30
+
+# swiftnbd-ctl transfers: objects transferred at the same time, and delay
+# between saves of the progress to resume an interrupted transfer (seconds)
+transfer_jobs = 8
+transfer_save_delay = 5
+
+# objects per bulk-delete request (if the cluster supports it, up to the
+# limit advertised by the cluster)
+bulk_delete_size = 1000
@@ -22,17 +22,26 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import os
 import socket
 import sys
+import json
 from time import time
+from hashlib import md5
+from urllib.parse import quote
 from argparse import ArgumentParser
 
 from swiftclient import client
 
 from swiftnbd.const import (version, description, project_url, auth_url, secrets_file, object_size,
-        disk_version, keystone_separator, keystone_service, keystone_endpoint)
+        disk_version, disk_version_compressed, default_codec, keystone_separator, keystone_service,
+        keystone_endpoint, transfer_jobs, transfer_save_delay, listing_limit, bulk_delete_size)
 from swiftnbd.common import setLog, setMeta, getMeta, Config
 from swiftnbd.swift import SwiftStorage, StorageError
+from swiftnbd.codec import codecs, get_codec
+from swiftnbd.allocation import Allocation
+from swiftnbd.transfer import parallel, batches, Progress
+from swiftnbd.pool import get_pool
 
 class Main(object):
 
@@ -63,6 +72,11 @@ class Main(object):
                        action="store_true",
                        help="force operation")
 
+        p.add_argument("--compress", dest="compress",
+                       nargs="?", const=default_codec, default=None,
+                       choices=codecs(),
+                       help="store the objects compressed (default codec: %s)" % default_codec)
+
         p.set_defaults(func=self.do_setup)
 
         p = subp.add_parser('unlock', help='unlock a container')
@@ -79,12 +93,84 @@ class Main(object):
         p.add_argument("-q", "--quiet", dest="quiet",
                        action="store_true",
                        help="don't show the process bar")
+        p.add_argument("-j", "--jobs", dest="jobs",
+                       type=int,
+                       default=transfer_jobs,
+                       help="objects downloaded at the same time (default: %s)" % transfer_jobs)
+        p.add_argument("--resume", dest="resume",
+                       action="store_true",
+                       help="resume an interrupted download")
         p.set_defaults(func=self.do_download)
 
+        p = subp.add_parser('upload', help='upload a raw image into a container')
+        p.add_argument("container", help="container to upload to")
+        p.add_argument("image", help="local file with the image")
+        p.add_argument("-q", "--quiet", dest="quiet",
+                       action="store_true",
+                       help="don't show the process bar")
+        p.add_argument("-j", "--jobs", dest="jobs",
+                       type=int,
+                       default=transfer_jobs,
+                       help="objects uploaded at the same time (default: %s)" % transfer_jobs)
+        p.add_argument("--object-size", dest="object_size",
+                       default=object_size,
+                       help="object size if the container is setup (default: %s)" % object_size)
+        p.add_argument("--compress", dest="compress",
+                       nargs="?", const=default_codec, default=None,
+                       choices=codecs(),
+                       help="store the objects compressed if the container is setup (default codec: %s)" % default_codec)
+        p.set_defaults(func=self.do_upload)
+
         p = subp.add_parser('delete', help='delete a container')
         p.add_argument("container", help="container to delete")
+        p.add_argument("-q", "--quiet", dest="quiet",
+                       action="store_true",
+                       help="don't show the process bar")
+        p.add_argument("-j", "--jobs", dest="jobs",
+                       type=int,
+                       default=transfer_jobs,
+                       help="delete requests at the same time (default: %s)" % transfer_jobs)
         p.set_defaults(func=self.do_delete)
 
+        p = subp.add_parser('server', help='inspect and tune a running server using its admin socket')
+        p.add_argument("-s", "--socket", dest="socket",
+                       required=True,
+                       help="path of the admin socket of the server (see --admin-socket)")
+        p.set_defaults(func=self.do_server)
+        admin = p.add_subparsers(title="server commands")
+        admin.required = True
+        admin.dest = "admin_command"
+
+        a = admin.add_parser('stats', help='show the stats of the exports')
+        a.add_argument("export", nargs="?", default=None, help="export (default: all the exports)")
+
+        a = admin.add_parser('cache', help='show a summary of the contents of the cache of an export')
+        a.add_argument("export", help="export")
+
+        a = admin.add_parser('cache-limit', help='change the cache memory limit of an export')
+        a.add_argument("export", help="export")
+        a.add_argument("value", type=int, help="cache memory limit in MB")
+
+        a = admin.add_parser('drop-cache', help='drop the cache of an export')
+        a.add_argument("export", help="export")
+
+        a = admin.add_parser('warm-cache', help='fetch a range of objects of an export into the cache')
+        a.add_argument("export", help="export")
+        a.add_argument("first", type=int, help="first object")
+        a.add_argument("last", type=int, help="last object")
+
+        a = admin.add_parser('read-ahead', help='change the max objects to prefetch of an export')
+        a.add_argument("export", help="export")
+        a.add_argument("value", type=int, help="max objects to prefetch, 0 to disable")
+
+        a = admin.add_parser('concurrency', help='change the concurrent requests to the storage of an export')
+        a.add_argument("export", help="export")
+        a.add_argument("value", type=int, help="concurrent requests")
+
+        a = admin.add_parser('debug', help='enable or disable the debug log of an export')
+        a.add_argument("export", help="export")
+        a.add_argument("value", choices=("on", "off"), help="on or off")
+
         parser.add_argument("--version", action="version", version="%(prog)s "  + version)
 
         parser.add_argument("--secrets", dest="secrets_file",
@@ -124,10 +210,13 @@ class Main(object):
 
         self.log = setLog(debug=self.args.verbose)
 
-        try:
-            self.conf = Config(self.args.secrets_file)
-        except OSError as ex:
-            parser.error("Failed to load secrets: %s" % ex)
+        # the server commands don't use the secrets
+        self.conf = None
+        if self.args.command != "server":
+            try:
+                self.conf = Config(self.args.secrets_file)
+            except OSError as ex:
+                parser.error("Failed to load secrets: %s" % ex)
 
         # setup by _setup_client()
         self.auth = None
@@ -152,12 +241,13 @@ class Main(object):
 
                 if meta:
                     lock = "unlocked" if not 'client' in meta else "locked by %s" % meta['client']
-                    out("%s objects=%s size=%s (version=%s, %s)" % (container,
-                                                                    meta['objects'],
-                                                                    meta['object-size'],
-                                                                    meta['version'],
-                                                                    lock,
-                                                                    ))
+                    out("%s objects=%s size=%s (version=%s, %s%s)" % (container,
+                                                                      meta['objects'],
+                                                                      meta['object-size'],
+                                                                      meta['version'],
+                                                                      lock,
+                                                                      ", codec=%s" % meta['codec'] if meta.get('codec') else "",
+                                                                      ))
                 else:
                     out("%s is not a swiftnbd container" % container)
 
@@ -291,6 +381,10 @@ class Main(object):
 
         self.log.debug("downloading %s" % self.args.container)
 
+        if self.args.jobs < 1:
+            self.log.error("At least one job is required")
+            return 1
+
         cli, meta = self._setup_client()
         if cli is None:
             return 1
@@ -301,10 +395,31 @@ class Main(object):
         object_size = int(meta['object-size'])
         objects = int(meta['objects'])
 
+        codec = None
+        if meta.get('codec'):
+            try:
+                codec = get_codec(meta['codec'])
+            except ValueError as ex:
+                self.log.error(ex)
+                return 1
+
+        # objects already downloaded, to resume an interrupted download
+        state_file = "%s.download" % self.args.image
+        done = Allocation(objects)
+        if self.args.resume:
+            try:
+                with open(state_file, "rb") as fd:
+                    done = Allocation.from_bytes(objects, fd.read())
+            except (IOError, ValueError) as ex:
+                self.log.error("Can't resume the download: %s" % ex)
+                return 1
+            self.log.info("Resuming download, %s objects already downloaded" % len(done))
+
         store = SwiftStorage(self.auth,
                              self.args.container,
                              object_size,
                              objects,
+                             codec=codec,
                              )
         try:
             store.lock("ctl-download")
@@ -312,85 +427,339 @@ class Main(object):
             self.log.error(ex)
             return 1
 
-        size = 0
+        def download(object_num):
+            """Download an object into the image, returns the bytes downloaded"""
+            offset = object_num*object_size
+            data = None
+            if store.allocation is None or object_num in store.allocation:
+                data = store.download_object(object_num)
+
+            if data is None or data == store.zero:
+                # holes are left unwritten (the image is sparse), but a resumed
+                # download may have written the object before it was deleted
+                if self.args.resume and os.pread(fdo, object_size, offset).strip(b'\0'):
+                    os.pwrite(fdo, store.zero, offset)
+                return 0
+
+            os.pwrite(fdo, data, offset)
+            return len(data)
+
+        size = objects*object_size
         fdo = None
+        progress = Progress("Downloading %s" % self.args.container, objects, self.args.quiet, len(done))
+        saved = time()
         try:
-            fdo = open(self.args.image, "wb")
-
-            while True:
-                data = store.read(object_size)
-                if data == b'':
-                    break
-                fdo.write(data)
-                size += len(data)
-                if not self.args.quiet:
-                    sys.stdout.write("\rDownloading %s [%.2d%%]" % (self.args.container, 100*size/(objects*object_size)))
-                    sys.stdout.flush()
-        except IOError as ex:
+            flags = os.O_RDWR | os.O_CREAT
+            if not self.args.resume:
+                flags |= os.O_TRUNC
+            fdo = os.open(self.args.image, flags | getattr(os, "O_BINARY", 0), 0o666)
+            # the parts not written are holes
+            os.ftruncate(fdo, size)
+
+            pending = (object_num for object_num in range(objects) if object_num not in done)
+            for object_num, downloaded in parallel(download, pending, self.args.jobs):
+                done.add(object_num)
+                progress.update(size=downloaded)
+
+                if time() - saved > transfer_save_delay:
+                    self._save_state(state_file, fdo, done)
+                    saved = time()
+
+            os.fsync(fdo)
+        except (IOError, OSError) as ex:
             self.log.error(ex)
+            if fdo is not None:
+                self._save_state(state_file, fdo, done)
             return 1
         except KeyboardInterrupt:
-            self.log.warning("user interrupt")
+            self.log.warning("user interrupt, use --resume to continue the download")
+            if fdo is not None:
+                self._save_state(state_file, fdo, done)
             return 1
         finally:
-            if fdo:
-                fdo.close()
+            if fdo is not None:
+                os.close(fdo)
 
             try:
                 store.unlock()
             except StorageError as ex:
                 self.log.warning("Failed to unlock %s: %s" % (self.args.container, ex))
 
-        if not self.args.quiet:
-            sys.stdout.write("\r")
-            sys.stdout.flush()
+            store.close()
+
+        progress.finish()
+
+        if os.path.exists(state_file):
+            os.unlink(state_file)
 
-        self.log.info("Done, %s bytes written" % size)
+        self.log.info("Done, %s bytes downloaded (%.2f MB/s), %s bytes image" % (progress.bytes, progress.rate(), size))
 
         return 0
 
-    def do_delete(self):
+    def _save_state(self, state_file, fd, done):
+        """Save the objects transferred, after syncing the data written"""
+        try:
+            os.fsync(fd)
+            with open(state_file + ".tmp", "wb") as state:
+                state.write(done.to_bytes())
+            os.replace(state_file + ".tmp", state_file)
+        except (IOError, OSError) as ex:
+            self.log.warning("Failed to save the progress: %s" % ex)
 
-        self.log.debug("deleting %s" % self.args.container)
+    def do_upload(self):
 
-        cli, meta = self._setup_client()
+        self.log.debug("uploading %s" % self.args.image)
+
+        if self.args.jobs < 1:
+            self.log.error("At least one job is required")
+            return 1
+
+        try:
+            image_size = os.stat(self.args.image).st_size
+        except OSError as ex:
+            self.log.error(ex)
+            return 1
+
+        cli, meta = self._setup_client(create=True)
         if cli is None:
             return 1
         elif 'client' in meta:
             self.log.error("%s is locked" % self.args.container)
             return 1
 
-        # this is the default limit for swift
-        limit = 10000
-        marker = None
-        while True:
+        if meta:
+            object_size = int(meta['object-size'])
+            objects = int(meta['objects'])
+        else:
+            object_size = int(self.args.object_size)
+            objects = max((image_size + object_size - 1) // object_size, 1)
+            self.log.info("Setting up %s with %s objects" % (self.args.container, objects))
+            meta = self._setup_container(cli, objects, object_size, self.args.compress)
+            if meta is None:
+                return 1
+
+        if image_size > objects*object_size:
+            self.log.error("%s is too big for %s (%s bytes)" % (self.args.image, self.args.container, objects*object_size))
+            return 1
+
+        codec = None
+        if meta.get('codec'):
             try:
-                _, objs = cli.get_container(self.args.container, limit=limit, marker=marker)
-            except client.ClientException as ex:
+                codec = get_codec(meta['codec'])
+            except ValueError as ex:
                 self.log.error(ex)
                 return 1
 
-            for obj in objs:
-                if 'name' in obj:
-                    try:
-                        cli.delete_object(self.args.container, obj['name'])
-                    except client.ClientException as ex:
-                        self.log.error("Failed to delete %s: %s" % (obj['name'], ex))
-                        return 1
+        store = SwiftStorage(self.auth,
+                             self.args.container,
+                             object_size,
+                             objects,
+                             codec=codec,
+                             )
+        try:
+            store.lock("ctl-upload")
+        except StorageError as ex:
+            self.log.error(ex)
+            return 1
 
-            if len(objs) < limit:
-                break
-            else:
-                marker = objs[-1]
-                self.log.debug("More than %s files, marker=%s" % (limit, marker))
+        def upload(object_num):
+            """Upload an object from the image, returns the bytes uploaded or None if skipped"""
+            data = os.pread(fdi, object_size, object_num*object_size)
+            if len(data) < object_size:
+                data += bytes(object_size - len(data))
+
+            stored = hashes.get(object_num)
+            if data == store.zero:
+                # the holes are not stored, but the object may exist from a previous upload
+                if stored is not None:
+                    store.delete_object(object_num)
+                    return 0
+                return None
+
+            payload = store.encode(data)
+            # resume: the objects already in the container are not uploaded again
+            if stored == md5(payload).hexdigest():
+                return None
+
+            store.upload_payload(object_num, payload)
+            return len(payload)
+
+        fdi = None
+        skipped = 0
+        progress = Progress("Uploading %s" % self.args.container, objects, self.args.quiet)
+        try:
+            hashes = dict((object_num, obj.get('hash')) for object_num, obj in store.list_objects())
+            if hashes:
+                self.log.info("%s objects in %s, only the changes will be uploaded" % (len(hashes), self.args.container))
+
+            fdi = os.open(self.args.image, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+            for _, uploaded in parallel(upload, range(objects), self.args.jobs):
+                if uploaded is None:
+                    skipped += 1
+                    uploaded = 0
+                progress.update(size=uploaded)
+        except (IOError, OSError) as ex:
+            self.log.error(ex)
+            return 1
+        except KeyboardInterrupt:
+            self.log.warning("user interrupt, run the upload again to continue")
+            return 1
+        finally:
+            if fdi is not None:
+                os.close(fdi)
+
+            try:
+                store.unlock()
+            except StorageError as ex:
+                self.log.warning("Failed to unlock %s: %s" % (self.args.container, ex))
+
+            store.close()
+
+        progress.finish()
 
+        self.log.info("Done, %s bytes uploaded (%.2f MB/s), %s objects skipped" % (progress.bytes, progress.rate(), skipped))
+
+        return 0
+
+    def do_delete(self):
+
+        self.log.debug("deleting %s" % self.args.container)
+
+        if self.args.jobs < 1:
+            self.log.error("At least one job is required")
+            return 1
+
+        cli, meta = self._setup_client()
+        if cli is None:
+            return 1
+        elif 'client' in meta and not meta['client'].startswith("ctl-delete@"):
+            self.log.error("%s is locked" % self.args.container)
+            return 1
+
+        # the container is locked while deleting, so it can't be used half deleted;
+        # if the delete is interrupted it can be run again to continue
+        meta['client'] = "ctl-delete@%i" % time()
+        try:
+            cli.put_container(self.args.container, headers=setMeta(meta))
+            headers = cli.head_container(self.args.container)
+        except (socket.error, client.ClientException) as ex:
+            self.log.error(ex)
+            return 1
+
+        total = int(headers.get('x-container-object-count', 0))
+        bulk_size = self._bulk_delete_size(cli)
+        pool = get_pool(self.auth, size=self.args.jobs)
+
+        def listing():
+            """Generator of (name, bytes) of the objects in the container"""
+            marker = ""
+            while True:
+                _, objs = cli.get_container(self.args.container, limit=listing_limit, marker=marker)
+                if not objs:
+                    break
+                for obj in objs:
+                    yield obj['name'], obj.get('bytes', 0)
+                marker = objs[-1]['name']
+                self.log.debug("More than %s files, marker=%s" % (listing_limit, marker))
+
+        def delete(obj):
+            """Delete an object, returns (objects, bytes) deleted"""
+            name, size = obj
+            try:
+                with pool.connection() as conn:
+                    conn.delete_object(self.args.container, name)
+            except client.ClientException as ex:
+                if ex.http_status != 404:
+                    raise
+            return 1, size
+
+        def bulk_delete(objs):
+            """Delete several objects in one request, returns (objects, bytes) deleted"""
+            data = "\n".join(quote("/%s/%s" % (self.args.container, name)) for name, _ in objs)
+            with pool.connection() as conn:
+                _, body = conn.post_account(headers={'Accept': 'application/json', 'Content-Type': 'text/plain'},
+                                            query_string="bulk-delete", data=data.encode("utf-8"))
+            result = json.loads(body.decode("utf-8"))
+            if result.get("Errors") or not result.get("Response Status", "").startswith("2"):
+                raise IOError("Bulk delete failed: %s %s" % (result.get("Response Status"), result.get("Errors")))
+            return len(objs), sum(size for _, size in objs)
+
+        if bulk_size:
+            self.log.debug("using bulk delete, %s objects per request" % bulk_size)
+            func, items = bulk_delete, batches(listing(), bulk_size)
+        else:
+            func, items = delete, listing()
+
+        progress = Progress("Deleting %s" % self.args.container, total, self.args.quiet)
         try:
+            for _, (deleted, size) in parallel(func, items, self.args.jobs):
+                progress.update(done=deleted, size=size)
+
             cli.delete_container(self.args.container)
-        except client.ClientException as ex:
+        except (socket.error, client.ClientException, IOError) as ex:
             self.log.error("Failed to delete %s: %s" % (self.args.container, ex))
+            self.log.info("%s is still locked, run the delete again to continue" % self.args.container)
             return 1
+        except KeyboardInterrupt:
+            self.log.warning("user interrupt, run the delete again to continue")
+            return 1
+
+        progress.finish()
 
-        self.log.info("Done, %s has been deleted" % self.args.container)
+        elapsed = max(time() - progress.start, 0.001)
+        self.log.info("Done, %s has been deleted (%s objects, %.2f objects/s)" % (self.args.container, progress.done, progress.done / elapsed))
+
+        return 0
+
+    def _bulk_delete_size(self, cli):
+        """Objects per bulk-delete request, 0 if the cluster doesn't support it"""
+        try:
+            capabilities = cli.get_capabilities()
+        except (socket.error, client.ClientException) as ex:
+            self.log.debug("no cluster capabilities: %s" % ex)
+            return 0
+
+        bulk = capabilities.get('bulk_delete')
+        if bulk is None:
+            return 0
+        return min(int(bulk.get('max_deletes_per_request', bulk_delete_size)), bulk_delete_size)
+
+    def do_server(self):
+
+        self.log.debug("server command %s using %s" % (self.args.admin_command, self.args.socket))
+
+        if self.args.admin_command == "warm-cache":
+            value = [self.args.first, self.args.last]
+        else:
+            value = getattr(self.args, "value", None)
+        request = dict(command=self.args.admin_command, export=self.args.export, value=value)
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(self.args.socket)
+                sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+                data = b""
+                while not data.endswith(b"\n"):
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        break
+                    data += chunk
+        except OSError as ex:
+            self.log.error("Failed to connect to %s: %s" % (self.args.socket, ex))
+            return 1
+
+        try:
+            reply = json.loads(data.decode("utf-8"))
+        except ValueError:
+            self.log.error("Invalid reply from the server: %r" % data)
+            return 1
+
+        if "error" in reply:
+            self.log.error(reply["error"])
+            return 1
+
+        print(json.dumps(reply["result"], indent=2, sort_keys=True))
 
         return 0
 
@@ -405,15 +774,29 @@ class Main(object):
             self.log.error("%s has already been setup" % self.args.container)
             return 1
 
-        hdrs = setMeta(dict(version=disk_version, objects=self.args.objects, object_size=self.args.object_size, client='', last=''))
+        if not self._setup_container(cli, self.args.objects, self.args.object_size, self.args.compress):
+            return 1
+
+        self.log.info("Done, %s" % self.args.container)
+
+        return 0
+
+    def _setup_container(self, cli, objects, object_size, compress):
+        """
+        Setup the container with its metadata.
+
+        Returns the metadata or None on error.
+        """
+        meta = dict(version=disk_version, objects=objects, object_size=object_size, client='', last='', codec='')
+        if compress:
+            meta.update(version=disk_version_compressed, codec=compress)
+        hdrs = setMeta(meta)
         self.log.debug("Meta headers: %s" % hdrs)
 
         try:
             cli.put_container(self.args.container, headers=hdrs)
         except client.ClientException as ex:
             self.log.error(ex)
-            return 1
-
-        self.log.info("Done, %s" % self.args.container)
+            return None
 
-        return 0
+        return meta
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+swiftnbd. local disk cache
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import struct
+import logging
+import threading
+from array import array
+from zlib import crc32
+from collections import OrderedDict
+
+class DiskCache(object):
+    """
+    Local disk cache manager.
+
+    Objects are stored in slots of a preallocated sparse file, releasing the
+    least recently used when the file is full. Each slot has a checksum that is
+    verified on read, so a slot that is being reused or has been damaged is
+    just a miss.
+
+    The index is saved next to the cache file with the id of the session that
+    wrote it, and it is only loaded back if the container hasn't been used by
+    anybody else since then (see load).
+    """
+
+    MAGIC = b"SWIFTNBD"
+    VERSION = 1
+    HEADER = struct.Struct(">8sIQQH")
+
+    def __init__(self, filename, size, object_size):
+        self.filename = filename
+        self.index_filename = filename + ".index"
+        self.object_size = object_size
+        self.slots = max(size // object_size, 1)
+
+        # object_num: (slot, crc), in LRU order
+        self.index = OrderedDict()
+        self.free = list(range(self.slots))
+
+        # object_num: slot, for the writes in progress
+        self.writing = dict()
+        # flush invalidates the writes in progress
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.log = logging.getLogger(__package__)
+
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o600)
+        os.ftruncate(self.fd, self.slots * self.object_size)
+
+        self.log.debug("disk cache %s: %s slots" % (self.filename, self.slots))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, object_num):
+        return object_num in self.index
+
+    @property
+    def size(self):
+        """Size in bytes of the cached data"""
+        return len(self.index) * self.object_size
+
+    def get(self, object_num, default=None):
+        """Get an object from the cache"""
+        with self.lock:
+            entry = self.index.get(object_num)
+            if entry is not None:
+                self.index.move_to_end(object_num)
+
+        data = None
+        if entry is not None:
+            slot, crc = entry
+            data = os.pread(self.fd, self.object_size, slot * self.object_size)
+            if crc32(data) != crc:
+                self.log.debug("disk cache %s: checksum mismatch for %s" % (self.filename, object_num))
+                data = None
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return data
+
+    def set(self, object_num, data):
+        """Put/update an object in the cache"""
+        with self.lock:
+            entry = self.index.pop(object_num, None)
+            if entry is not None:
+                slot, _ = entry
+            elif self.free:
+                slot = self.free.pop()
+            else:
+                _, (slot, _) = self.index.popitem(last=False)
+
+            self.writing[object_num] = slot
+            generation = self.generation
+
+        # the slot is out of the index, so it can be written without the lock
+        os.pwrite(self.fd, data, slot * self.object_size)
+        crc = crc32(data)
+
+        with self.lock:
+            if generation != self.generation:
+                # flushed meanwhile, the slot is already free
+                return
+            if self.writing.get(object_num) != slot:
+                # discarded or updated again meanwhile
+                self.free.append(slot)
+                return
+            del self.writing[object_num]
+            self.index[object_num] = (slot, crc)
+
+    def discard(self, object_num):
+        """Remove an object from the cache"""
+        with self.lock:
+            self.writing.pop(object_num, None)
+            entry = self.index.pop(object_num, None)
+            if entry is not None:
+                self.free.append(entry[0])
+
+    def flush(self):
+        """Flush the cache"""
+        with self.lock:
+            self.index = OrderedDict()
+            self.free = list(range(self.slots))
+            self.writing = dict()
+            self.generation += 1
+
+    def close(self):
+        """Close the cache file"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def load(self, session):
+        """
+        Load the index saved by session.
+
+        If the index wasn't saved by that session (or it was for a different
+        object size), the cache is empty.
+        """
+        self.flush()
+
+        try:
+            with open(self.index_filename, "rb") as fd:
+                data = fd.read()
+            # the index is only valid once
+            os.unlink(self.index_filename)
+        except OSError:
+            return
+
+        try:
+            magic, version, object_size, slots, session_len = self.HEADER.unpack_from(data)
+            offs = self.HEADER.size
+            _session = data[offs:offs+session_len].decode("utf-8")
+            offs += session_len
+        except (struct.error, UnicodeDecodeError):
+            self.log.warning("disk cache %s: invalid index" % self.filename)
+            return
+
+        if magic != self.MAGIC or version != self.VERSION or object_size != self.object_size \
+                or slots != self.slots or _session != session:
+            self.log.info("disk cache %s: index not valid for this session, discarded" % self.filename)
+            return
+
+        entries = array("q")
+        entries.frombytes(data[offs:])
+        if len(entries) % 3:
+            self.log.warning("disk cache %s: invalid index" % self.filename)
+            return
+
+        with self.lock:
+            free = set(self.free)
+            for i in range(0, len(entries), 3):
+                object_num, slot, crc = entries[i:i+3]
+                self.index[object_num] = (slot, crc)
+                free.discard(slot)
+            self.free = list(free)
+
+        self.log.info("disk cache %s: %s objects loaded" % (self.filename, len(self.index)))
+
+    def save(self, session):
+        """Save the index for session"""
+        session = session.encode("utf-8")
+        with self.lock:
+            entries = array("q")
+            for object_num, (slot, crc) in self.index.items():
+                entries.extend((object_num, slot, crc))
+
+        tmp = self.index_filename + ".tmp"
+        try:
+            os.fsync(self.fd)
+            with open(tmp, "wb") as fd:
+                fd.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.object_size, self.slots, len(session)))
+                fd.write(session)
+                fd.write(entries.tobytes())
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.rename(tmp, self.index_filename)
+        except OSError as ex:
+            self.log.warning("disk cache %s: failed to save the index: %s" % (self.filename, ex))
+            return
+
+        self.log.debug("disk cache %s: %s objects saved" % (self.filename, len(entries) // 3))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+swiftnbd. request dispatcher
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import asyncio
+
+from swiftnbd.const import max_requests, max_request_bytes
+
+class Dispatcher(object):
+    """
+    Run the requests of a connection concurrently.
+
+    Requests touching overlapping ranges run in the order they were received
+    (unless all of them are reads), and barrier requests wait for every request
+    received before them. The ranges are extended to 'block_size' boundaries,
+    so requests sharing a block (ie, an object) are ordered too.
+
+    Writes merged in memory by the storage (see Coalescer) are ordered with the
+    reads and the other merged writes only if their ranges overlap, and the
+    reads don't wait for them (the storage applies the merged writes to the
+    data read).
+
+    The number of requests in flight and the bytes they carry are limited
+    by max_requests and max_bytes; reserve() waits until there's room.
+    """
+    def __init__(self, max_requests=max_requests, max_bytes=max_request_bytes, block_size=1):
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+
+        self.requests = 0
+        self.bytes = 0
+        self.pending = []
+        self.room = asyncio.Condition()
+
+        self.log = logging.getLogger(__package__)
+
+    def __len__(self):
+        return self.requests
+
+    def _has_room(self, length):
+        if self.requests == 0:
+            # a request over the budget can run alone
+            return True
+        return self.requests < self.max_requests and self.bytes + length <= self.max_bytes
+
+    @asyncio.coroutine
+    def reserve(self, length):
+        """Wait until there's room for a new request of length bytes"""
+        yield from self.room.acquire()
+        try:
+            yield from self.room.wait_for(lambda: self._has_room(length))
+            self.requests += 1
+            self.bytes += length
+        finally:
+            self.room.release()
+
+    def try_reserve(self, length):
+        """Reserve room for a new request of length bytes if there's room now"""
+        if self.room.locked() or not self._has_room(length):
+            return False
+        self.requests += 1
+        self.bytes += length
+        return True
+
+    @asyncio.coroutine
+    def _release(self, length):
+        yield from self.room.acquire()
+        try:
+            self.requests -= 1
+            self.bytes -= length
+            self.room.notify_all()
+        finally:
+            self.room.release()
+
+    def start(self, coro, offset=0, length=0, write=False, barrier=False, reserved=None, merge=False):
+        """
+        Schedule coro for a request that has been reserved.
+
+        offset and length define the range, write is True if the request modifies
+        that range and barrier is True if it must wait for all previous requests.
+        reserved are the bytes reserved for the request (length by default).
+        merge is True for the writes merged by the storage.
+        """
+        if reserved is None:
+            reserved = length
+
+        start, end = offset, offset + length
+        offset -= offset % self.block_size
+        end += -end % self.block_size
+        if barrier:
+            deps = [entry[-1] for entry in self.pending]
+        else:
+            deps = []
+            for (_offset, _end, _start, _length, _write, _merge, task) in self.pending:
+                if not (write or _write) or (_merge and not write):
+                    # reads don't wait for merged writes
+                    continue
+                if merge and (_merge or not _write):
+                    if _start < start + length and start < _start + _length:
+                        deps.append(task)
+                elif _offset < end and offset < _end:
+                    deps.append(task)
+
+        task = asyncio.ensure_future(self._run(coro, deps, reserved))
+        entry = (offset, end, start, length, write, merge, task)
+        self.pending.append(entry)
+        task.add_done_callback(lambda _: self.pending.remove(entry))
+        return task
+
+    @asyncio.coroutine
+    def _run(self, coro, deps, length):
+        try:
+            if deps:
+                yield from asyncio.wait(deps)
+            yield from coro
+        except Exception as ex:
+            # the request should have replied already, nothing else to do
+            self.log.exception("Request failed: %s" % ex)
+        finally:
+            yield from self._release(length)
+
+    @asyncio.coroutine
+    def drain(self):
+        """Wait for all the requests in flight"""
+        if self.pending:
+            yield from asyncio.wait([entry[-1] for entry in self.pending])
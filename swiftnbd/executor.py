@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+swiftnbd. storage execution layer
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from swiftnbd.const import storage_workers, coalesce_window
+from swiftnbd.coalesce import Coalescer
+
+class AsyncSwiftStorage(object):
+    """
+    Awaitable facade over a SwiftStorage.
+
+    The storage operations block on network I/O, so they run in a bounded
+    thread pool owned by the store instead of in the event loop.
+
+    Small writes can be merged during 'coalesce' seconds (see Coalescer).
+    """
+    def __init__(self, store, workers=storage_workers, coalesce=coalesce_window):
+        self.store = store
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.coalescer = Coalescer(store.object_size, self.merge, coalesce)
+
+    def __str__(self):
+        return str(self.store)
+
+    @asyncio.coroutine
+    def run(self, func, *args):
+        """Run func(*args) in the store's thread pool"""
+        loop = asyncio.get_event_loop()
+        result = yield from loop.run_in_executor(self.executor, func, *args)
+        return result
+
+    @asyncio.coroutine
+    def lock(self, client_id):
+        yield from self.run(self.store.lock, client_id)
+
+    @asyncio.coroutine
+    def unlock(self):
+        yield from self.run(self.store.unlock)
+
+    @asyncio.coroutine
+    def read(self, offset, size):
+        views = yield from self.read_views(offset, size)
+        return b"".join(views)
+
+    @asyncio.coroutine
+    def read_views(self, offset, size):
+        # the writes being merged are applied to the data read
+        snapshot = self.coalescer.snapshot(offset, size) if self.coalescer else None
+        views = yield from self.run(self.store.read_views, offset, size)
+        if snapshot:
+            views = self.coalescer.overlay(offset, views, snapshot)
+        return views
+
+    @asyncio.coroutine
+    def write(self, offset, data, merge=False):
+        """Write data, merging it with other writes if merge is True (see coalescable)"""
+        if merge:
+            yield from self.coalescer.write(offset, data)
+        else:
+            yield from self.run(self.store.write_at, offset, data)
+
+    def coalescable(self, offset, length):
+        """Check if a write can be merged with other writes"""
+        return self.coalescer.accepts(offset, length)
+
+    def expire(self, offset=0, length=None):
+        """Store now the merged writes in a range (all by default)"""
+        self.coalescer.expire(offset, length)
+
+    @asyncio.coroutine
+    def merge(self, object_num, patches):
+        yield from self.run(self.store.merge_at, object_num, patches)
+
+    @asyncio.coroutine
+    def trim(self, offset, length):
+        yield from self.run(self.store.trim_at, offset, length)
+
+    @asyncio.coroutine
+    def zero(self, offset, length, hole=True):
+        yield from self.run(self.store.zero_at, offset, length, hole)
+
+    @asyncio.coroutine
+    def extents(self, offset, length):
+        extents = yield from self.run(self.store.extents, offset, length)
+        return extents
+
+    @asyncio.coroutine
+    def flush(self, merged=True):
+        """Wait until the written data is stored, including the merged writes if merged is True"""
+        if merged:
+            yield from self.coalescer.flush()
+        yield from self.run(self.store.flush)
+
+    def shutdown(self):
+        """Wait for any pending operation and release the thread pool"""
+        self.executor.shutdown(wait=True)
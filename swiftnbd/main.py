@@ -31,10 +31,17 @@ from argparse import ArgumentParser
 from swiftclient import client
 
 from swiftnbd.const import (version, description, project_url, auth_url, secrets_file,
-        disk_version, keystone_separator, keystone_service, keystone_endpoint)
+        disk_version, disk_version_compressed, keystone_separator, keystone_service, keystone_endpoint, storage_workers,
+        max_requests, max_request_bytes, write_back_age, write_back_size,
+        read_ahead, concurrency, pool_size, token_ttl, pool_check_delay, coalesce_window)
 from swiftnbd.common import setLog, getMeta, Config
 from swiftnbd.cache import Cache
+from swiftnbd.writeback import WriteBack
+from swiftnbd.diskcache import DiskCache
+from swiftnbd.prefetch import Prefetcher
 from swiftnbd.swift import SwiftStorage
+from swiftnbd.pool import get_pool
+from swiftnbd.codec import get_codec
 from swiftnbd.server import Server
 
 class Main(object):
@@ -88,11 +95,92 @@ class Main(object):
                             default=10809,
                             help="bind address (default: 10809)")
 
+        parser.add_argument("--metrics-port", dest="metrics_port",
+                            type=int,
+                            default=0,
+                            help="port of the HTTP metrics listener on the bind address, 0 to disable (default: 0)")
+
+        parser.add_argument("--admin-socket", dest="admin_socket",
+                            default=None,
+                            help="path of the admin socket used by swiftnbd-ctl server (default: disabled)")
+
         parser.add_argument("-c", "--cache-limit", dest="cache_limit",
                             type=int,
                             default=64,
                             help="cache memory limit in MB (default: 64)")
 
+        parser.add_argument("--read-ahead", dest="read_ahead",
+                            type=int,
+                            default=read_ahead,
+                            help="max objects to prefetch on sequential reads, 0 to disable (default: %s)" % read_ahead)
+
+        parser.add_argument("--disk-cache", dest="disk_cache",
+                            default=None,
+                            help="directory to keep a local disk cache per container (optional)")
+
+        parser.add_argument("--disk-cache-size", dest="disk_cache_size",
+                            type=int,
+                            default=1024,
+                            help="disk cache limit in MB per container (default: 1024)")
+
+        parser.add_argument("--write-back", dest="write_back",
+                            action="store_true",
+                            help="acknowledge writes before they are stored (flush waits for them)")
+
+        parser.add_argument("--write-back-age", dest="write_back_age",
+                            type=float,
+                            default=write_back_age,
+                            help="max seconds the written data is kept before storing it (default: %s)" % write_back_age)
+
+        parser.add_argument("--write-back-size", dest="write_back_size",
+                            type=int,
+                            default=write_back_size // 1024**2,
+                            help="max MB of written data kept before storing it (default: %s)" % (write_back_size // 1024**2))
+
+        parser.add_argument("--concurrency", dest="concurrency",
+                            type=int,
+                            default=concurrency,
+                            help="concurrent requests to the object storage per container (default: %s)" % concurrency)
+
+        parser.add_argument("--pool-size", dest="pool_size",
+                            type=int,
+                            default=pool_size,
+                            help="connections to the object storage per user (default: %s)" % pool_size)
+
+        parser.add_argument("--token-ttl", dest="token_ttl",
+                            type=int,
+                            default=token_ttl,
+                            help="seconds before the auth token is refreshed (default: %s)" % token_ttl)
+
+        parser.add_argument("--pool-check-delay", dest="pool_check_delay",
+                            type=int,
+                            default=pool_check_delay,
+                            help="seconds before an idle connection is checked (default: %s)" % pool_check_delay)
+
+        parser.add_argument("-w", "--workers", dest="workers",
+                            type=int,
+                            default=storage_workers,
+                            help="threads per container running storage operations (default: %s)" % storage_workers)
+
+        parser.add_argument("--max-requests", dest="max_requests",
+                            type=int,
+                            default=max_requests,
+                            help="requests in flight per connection (default: %s)" % max_requests)
+
+        parser.add_argument("--max-requests-size", dest="max_requests_size",
+                            type=int,
+                            default=max_request_bytes // 1024**2,
+                            help="memory limit in MB for the requests in flight per connection (default: %s)" % (max_request_bytes // 1024**2))
+
+        parser.add_argument("--coalesce-window", dest="coalesce_window",
+                            type=int,
+                            default=int(coalesce_window*1000),
+                            help="ms the writes within an object are merged before storing it, 0 to disable (default: %s)" % int(coalesce_window*1000))
+
+        parser.add_argument("--buffered", dest="buffered",
+                            action="store_true",
+                            help="use the buffered protocol transport (less overhead per request)")
+
         parser.add_argument("-l", "--log-file", dest="log_file",
                             default=None,
                             help="log into the provided file"
@@ -124,6 +212,42 @@ class Main(object):
         if self.args.cache_limit < 1:
             parser.error("Cache limit can't be less than 1MB")
 
+        if self.args.workers < 1:
+            parser.error("Workers can't be less than 1")
+
+        if self.args.read_ahead < 0:
+            parser.error("Read-ahead can't be negative")
+
+        if self.args.coalesce_window < 0:
+            parser.error("Coalesce window can't be negative")
+
+        if not 0 <= self.args.metrics_port < 65536:
+            parser.error("Invalid metrics port")
+
+        if self.args.disk_cache:
+            if not os.path.isdir(self.args.disk_cache):
+                parser.error("Disk cache directory %s not found" % self.args.disk_cache)
+            if self.args.disk_cache_size < 1:
+                parser.error("Disk cache limit can't be less than 1MB")
+
+        if self.args.write_back_size < 1:
+            parser.error("Write-back size can't be less than 1MB")
+
+        if self.args.concurrency < 1:
+            parser.error("Concurrency can't be less than 1")
+
+        if self.args.pool_size < 1:
+            parser.error("Pool size can't be less than 1")
+
+        if self.args.token_ttl < 1 or self.args.pool_check_delay < 1:
+            parser.error("Token TTL and pool check delay can't be less than 1 second")
+
+        if self.args.max_requests < 1:
+            parser.error("Requests in flight can't be less than 1")
+
+        if self.args.max_requests_size < 1:
+            parser.error("Requests in flight memory limit can't be less than 1MB")
+
         self.log = setLog(debug=self.args.verbose, use_syslog=self.args.syslog, use_file=self.args.log_file)
 
         try:
@@ -193,19 +317,60 @@ class Main(object):
                 self.log.error("%s doesn't appear to be correct: %s" % (container, ex))
                 return 1
 
-            if meta['version'] != disk_version:
+            if meta['version'] not in (disk_version, disk_version_compressed):
                 self.log.warning("Version mismatch %s != %s in %s" % (meta['version'], disk_version, container))
 
+            codec = None
+            if meta.get('codec'):
+                try:
+                    codec = get_codec(meta['codec'])
+                except ValueError as ex:
+                    self.log.error("%s: %s, skipping" % (container, ex))
+                    continue
+                self.log.debug("%s: using codec %s" % (container, codec))
+
+            read_only = values['read-only'].lower() in ('1', 'yes', 'true', 'on')
+
+            write_back = None
+            if self.args.write_back and not read_only:
+                write_back = WriteBack(self.args.write_back_age, self.args.write_back_size*1024**2)
+
+            disk_cache = None
+            if self.args.disk_cache:
+                filename = os.path.join(self.args.disk_cache, "%s.cache" % container)
+                try:
+                    disk_cache = DiskCache(filename, self.args.disk_cache_size*1024**2, object_size)
+                except OSError as ex:
+                    self.log.error("%s: failed to setup the disk cache: %s" % (container, ex))
+                    return 1
+
+            prefetcher = None
+            if self.args.read_ahead:
+                prefetcher = Prefetcher(self.args.read_ahead)
+
             stores[container] = SwiftStorage(auth,
                                              container,
                                              object_size,
                                              objects,
-                                             Cache(int(self.args.cache_limit*1024**2 / object_size)),
-                                             values['read-only'].lower() in ('1', 'yes', 'true', 'on'),
+                                             Cache(self.args.cache_limit*1024**2),
+                                             read_only,
+                                             write_back,
+                                             disk_cache,
+                                             prefetcher,
+                                             self.args.concurrency,
+                                             get_pool(auth,
+                                                      self.args.pool_size,
+                                                      self.args.token_ttl,
+                                                      self.args.pool_check_delay),
+                                             codec,
                                             )
 
         addr = (self.args.bind_address, self.args.bind_port)
-        server = Server(addr, stores)
+        server = Server(addr, stores, self.args.workers,
+                        self.args.max_requests, self.args.max_requests_size*1024**2,
+                        self.args.buffered, self.args.coalesce_window / 1000.0,
+                        (self.args.bind_address, self.args.metrics_port) if self.args.metrics_port else None,
+                        self.args.admin_socket)
 
         if not self.args.foreground:
             try:
@@ -239,6 +404,8 @@ class Main(object):
 
         # unlock the storages before exit
         server.unlock_all()
+        for store in stores.values():
+            store.close()
 
         self.log.info("Exiting...")
         return 0
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+swiftnbd. metrics HTTP listener
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import asyncio
+
+class Metrics(object):
+    """
+    HTTP listener exposing the stats of the exports in the Prometheus text format.
+
+    Any GET request to /metrics gets the current values.
+    """
+    CONTENT_TYPE = "text/plain; version=0.0.4"
+
+    def __init__(self, server):
+        self.server = server
+        self.log = logging.getLogger(__package__)
+
+    def start_server(self, addr, port):
+        """Return a coroutine creating the asyncio server"""
+        return asyncio.start_server(self.handler, addr, port)
+
+    @asyncio.coroutine
+    def handler(self, reader, writer):
+        try:
+            request = yield from reader.readline()
+            # the headers are ignored
+            while True:
+                line = yield from reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+
+            parts = request.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] != "GET":
+                self.reply(writer, 405, "Method Not Allowed")
+            elif parts[1].split("?")[0] != "/metrics":
+                self.reply(writer, 404, "Not Found")
+            else:
+                self.reply(writer, 200, "OK", self.render())
+
+            yield from writer.drain()
+        except (IOError, UnicodeError) as ex:
+            self.log.debug("metrics request failed: %s" % ex)
+        finally:
+            writer.close()
+
+    def reply(self, writer, status, reason, body=""):
+        data = body.encode("utf-8")
+        writer.write(("HTTP/1.0 %s %s\r\n"
+                      "Content-Type: %s\r\n"
+                      "Content-Length: %s\r\n"
+                      "Connection: close\r\n"
+                      "\r\n" % (status, reason, self.CONTENT_TYPE, len(data))).encode("latin-1") + data)
+
+    def render(self):
+        """The metrics of all the exports in the text format"""
+        lines = []
+
+        def metric(name, kind, description, samples):
+            """Add a metric, samples are (labels, value) or (suffix, labels, value)"""
+            lines.append("# HELP %s %s" % (name, description))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for sample in samples:
+                suffix, labels, value = sample if len(sample) == 3 else ("",) + sample
+                lines.append("%s%s%s %s" % (name, suffix, self.labels(labels), value))
+
+        exports = sorted(self.server.stats.items(), key=lambda item: str(item[0]))
+        stores = [store for store, _ in exports]
+
+        metric("swiftnbd_requests_total", "counter", "Requests served per command",
+               [(dict(export=store, command=command), count)
+                for store, stats in exports for command, count in sorted(stats.requests.items())])
+        metric("swiftnbd_request_bytes_total", "counter", "Bytes requested per command",
+               [(dict(export=store, command=command), count)
+                for store, stats in exports for command, count in sorted(stats.bytes.items())])
+        metric("swiftnbd_request_errors_total", "counter", "Requests failed per command",
+               [(dict(export=store, command=command), count)
+                for store, stats in exports for command, count in sorted(stats.errors.items())])
+        metric("swiftnbd_requests_in_flight", "gauge", "Requests being served",
+               [(dict(export=store), stats.in_flight) for store, stats in exports])
+
+        samples = []
+        for store in stores:
+            for method, histogram in sorted(store.latency.items()):
+                buckets, counts, count, total = histogram.snapshot()
+                for bound, bucket_count in zip(buckets, counts):
+                    samples.append(("_bucket", dict(export=store, method=method, le=bound), bucket_count))
+                samples.append(("_bucket", dict(export=store, method=method, le="+Inf"), count))
+                samples.append(("_sum", dict(export=store, method=method), total))
+                samples.append(("_count", dict(export=store, method=method), count))
+        metric("swiftnbd_swift_request_duration_seconds", "histogram", "Latency of the object requests to Swift",
+               samples)
+
+        metric("swiftnbd_swift_bytes_total", "counter", "Bytes transferred from and to Swift",
+               [(dict(export=store, direction=direction), count) for store in stores
+                for direction, count in (("in", store.bytes_in), ("out", store.bytes_out))])
+
+        metric("swiftnbd_cache_hits_total", "counter", "Cache hits",
+               [(dict(export=store), store.cache.hits) for store in stores])
+        metric("swiftnbd_cache_misses_total", "counter", "Cache misses",
+               [(dict(export=store), store.cache.misses) for store in stores])
+        metric("swiftnbd_cache_evictions_total", "counter", "Cache evictions",
+               [(dict(export=store), store.cache.evictions) for store in stores])
+        metric("swiftnbd_cache_size_bytes", "gauge", "Cache occupancy",
+               [(dict(export=store), store.cache.size) for store in stores])
+        metric("swiftnbd_cache_limit_bytes", "gauge", "Cache limit",
+               [(dict(export=store), store.cache.limit) for store in stores])
+
+        metric("swiftnbd_dirty_bytes", "gauge", "Written data not stored yet (write-back)",
+               [(dict(export=store), store.write_back.dirty_bytes if store.write_back is not None else 0)
+                for store in stores])
+        metric("swiftnbd_dirty_objects", "gauge", "Objects not stored yet (write-back and writes being merged)",
+               [(dict(export=store), (len(store.write_back) if store.write_back is not None else 0)
+                 + len(self.server.aio[store].coalescer))
+                for store in stores])
+
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def labels(labels):
+        """Format the labels of a sample"""
+        values = []
+        for key in sorted(labels):
+            value = str(labels[key]).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            values.append("%s=\"%s\"" % (key, value))
+        return "{%s}" % ",".join(values)
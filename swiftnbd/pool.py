@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+swiftnbd. connection pool
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import socket
+import logging
+import threading
+from time import time, sleep
+from collections import deque
+from contextlib import contextmanager
+
+from swiftclient import client
+
+from swiftnbd.const import pool_size, token_ttl, pool_check_delay
+
+class ConnectionPool(object):
+    """
+    Pool of client connections for an auth identity.
+
+    Up to 'size' keep-alive connections are created on demand and all of
+    them share the same auth token and storage URL.
+
+    A background thread refreshes the token before it is 'token_ttl' seconds
+    old, so no request has to wait for the authentication, and checks the
+    idle connections so they are kept alive (broken connections are
+    discarded).
+    """
+    def __init__(self, auth, size=pool_size, token_ttl=token_ttl, check_delay=pool_check_delay):
+        self.auth = auth
+        self.size = size
+        self.token_ttl = token_ttl
+        self.check_delay = check_delay
+
+        self.url = None
+        self.token = None
+        self.auth_time = 0
+
+        # (connection, last used), the most recently used on the right
+        self.idle = deque()
+        self.connections = 0
+        self.cond = threading.Condition()
+        self.auth_lock = threading.Lock()
+
+        self.thread = None
+
+        self.log = logging.getLogger(__package__)
+
+    def __len__(self):
+        return self.connections
+
+    def authenticate(self, force=True):
+        """
+        Get a new auth token and storage URL for all the connections.
+
+        If force is False, it only authenticates if there's no token.
+        """
+        with self.auth_lock:
+            if not force and self.token is not None:
+                return
+
+            cli = client.Connection(**self.auth)
+            url, token = cli.get_auth()
+
+            with self.cond:
+                self.url = url
+                self.token = token
+                self.auth_time = time()
+
+        self.log.debug("pool authenticated: %s" % url)
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._maintenance)
+            self.thread.daemon = True
+            self.thread.start()
+
+    @contextmanager
+    def connection(self):
+        """Get a connection, waiting for one to be available"""
+        if self.token is None:
+            try:
+                self.authenticate(force=False)
+            except (socket.error, client.ClientException) as ex:
+                self.log.error("pool authentication failed: %s" % ex)
+                raise
+
+        cli = self._get()
+        try:
+            yield cli
+        except (socket.error, client.ClientException) as ex:
+            if getattr(ex, 'http_status', None):
+                self._put(cli)
+            else:
+                # not an HTTP error, the connection may be broken
+                self._discard(cli)
+            raise
+        except BaseException:
+            self._put(cli)
+            raise
+        else:
+            self._put(cli)
+
+    def _get(self):
+        with self.cond:
+            self.cond.wait_for(lambda: self.idle or self.connections < self.size)
+            if self.idle:
+                cli, _ = self.idle.pop()
+            else:
+                cli = client.Connection(preauthurl=self.url, preauthtoken=self.token, **self.auth)
+                self.connections += 1
+                self.log.debug("pool connections: %s" % self.connections)
+
+            if getattr(cli, 'token', self.token) != self.token:
+                # the token has been refreshed
+                cli.url = self.url
+                cli.token = self.token
+
+        return cli
+
+    def _put(self, cli):
+        with self.cond:
+            self.idle.append((cli, time()))
+            self.cond.notify()
+
+    def _discard(self, cli):
+        try:
+            cli.close()
+        except Exception:
+            pass
+
+        with self.cond:
+            self.connections -= 1
+            self.cond.notify()
+
+        self.log.debug("pool connection discarded")
+
+    def _maintenance(self):
+        while True:
+            sleep(self.maintain())
+
+    def maintain(self):
+        """
+        Refresh the token if it is about to expire and check the idle connections.
+
+        Returns the seconds to wait until the next maintenance.
+        """
+        refresh = self.auth_time + self.token_ttl*0.9 - time()
+        if refresh <= 0:
+            try:
+                self.authenticate()
+            except (socket.error, client.ClientException) as ex:
+                self.log.error("pool authentication failed, retrying: %s" % ex)
+                refresh = self.check_delay
+            else:
+                refresh = self.token_ttl*0.9
+
+        self.check()
+        return min(refresh, self.check_delay)
+
+    def check(self):
+        """Check the connections that have been idle for a while"""
+        now = time()
+        while True:
+            with self.cond:
+                if not self.idle or now - self.idle[0][1] < self.check_delay:
+                    return
+                cli, _ = self.idle.popleft()
+
+            try:
+                cli.head_account()
+            except (socket.error, client.ClientException) as ex:
+                self.log.debug("pool connection check failed: %s" % ex)
+                self._discard(cli)
+            else:
+                self._put(cli)
+
+_pools = dict()
+_pools_lock = threading.Lock()
+
+def get_pool(auth, size=pool_size, token_ttl=token_ttl, check_delay=pool_check_delay):
+    """
+    Get the connection pool for an auth identity.
+
+    The stores using the same credentials share the pool (the pool is created
+    with the parameters of the first call).
+    """
+    identity = tuple(sorted((key, repr(value)) for key, value in auth.items()))
+    with _pools_lock:
+        if identity not in _pools:
+            _pools[identity] = ConnectionPool(auth, size, token_ttl, check_delay)
+        return _pools[identity]
+
+def reset_pools():
+    """Forget all the connection pools (new stores will get new pools)"""
+    with _pools_lock:
+        _pools.clear()
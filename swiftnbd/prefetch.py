@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+swiftnbd. read-ahead management
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from swiftnbd.const import read_ahead, read_ahead_workers
+
+class Prefetcher(object):
+    """
+    Read-ahead manager.
+
+    Detects sequential and strided runs of reads and fetches the objects that
+    are likely to be read next in background threads.
+
+    The prefetched objects are kept apart until they are used (take), so they
+    don't count as cache hits or release data from the cache. Note that this
+    memory (up to twice 'max_window' objects) is not part of the cache limit.
+    The window grows by one object every time a prefetched object is used, and
+    halves when one is discarded without being used.
+
+    Objects found not to exist are remembered too, so take returns HOLE for
+    them and they aren't requested again.
+    """
+
+    # reads following the same pattern before prefetching
+    RUN = 2
+
+    # take result for an object that doesn't exist
+    HOLE = object()
+
+    def __init__(self, max_window=read_ahead, workers=read_ahead_workers):
+        self.max_window = max_window
+        self.window = min(2, max_window)
+        self.workers = workers
+
+        self.prev_first = None
+        self.prev_last = None
+        self.stride = 0
+        self.run = 0
+
+        # prefetched objects: object_num -> data
+        self.ready = OrderedDict()
+        # object_num -> threading.Event
+        self.inflight = dict()
+        self.started = set()
+        self.stale = set()
+
+        self.hits = 0
+        self.wasted = 0
+
+        self.lock = threading.Lock()
+        self.executor = None
+        self.download = None
+        self.cached = None
+
+        self.log = logging.getLogger(__package__)
+
+    def __len__(self):
+        return len(self.ready)
+
+    def resize(self, max_window):
+        """Change the max number of objects to prefetch, 0 disables it"""
+        with self.lock:
+            self.max_window = max_window
+            self.window = min(max(self.window, 2), max_window)
+
+    def start(self, download, cached):
+        """
+        Start the prefetch threads.
+
+        download(object_num) is called to fetch an object (None if it doesn't
+        exist) and cached(object_num) to know if an object doesn't need
+        to be prefetched.
+        """
+        self.download = download
+        self.cached = cached
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def access(self, first, last, objects):
+        """Register a read of the objects from first to last"""
+        with self.lock:
+            if self.prev_first is None:
+                self.prev_first = first
+                self.prev_last = last
+                return
+
+            if first == self.prev_first and last == self.prev_last:
+                # same objects, ie. small reads in the same object
+                return
+
+            if first == self.prev_last + 1 or self.prev_first <= first <= self.prev_last < last:
+                sequential = True
+                self.stride = 1
+                self.run += 1
+            elif first == self.prev_first:
+                # no stride, ie. small reads in the same objects
+                return
+            elif first - self.prev_first == self.stride:
+                sequential = False
+                self.run += 1
+            else:
+                sequential = False
+                self.stride = first - self.prev_first
+                self.run = 1
+
+            self.prev_first = first
+            self.prev_last = last
+
+            if self.run < self.RUN or not self.window:
+                return
+
+            if sequential:
+                candidates = range(last + 1, last + 1 + self.window)
+            else:
+                span = last - first + 1
+                candidates = [first + self.stride*(i // span + 1) + i % span for i in range(self.window)]
+
+            objects = [object_num for object_num in candidates
+                       if 0 <= object_num < objects
+                       and object_num not in self.ready
+                       and object_num not in self.inflight]
+
+            for object_num in objects:
+                self.inflight[object_num] = threading.Event()
+
+        for object_num in objects:
+            self.executor.submit(self._fetch, object_num)
+
+    def _fetch(self, object_num):
+        with self.lock:
+            if object_num in self.stale:
+                # cancelled before starting
+                self.stale.discard(object_num)
+                self.inflight.pop(object_num).set()
+                return
+            self.started.add(object_num)
+
+        data = None
+        try:
+            if not self.cached(object_num):
+                data = self.download(object_num)
+                if data is None:
+                    data = self.HOLE
+        except IOError as ex:
+            self.log.debug("prefetch failed: %s" % ex)
+
+        with self.lock:
+            event = self.inflight.pop(object_num)
+            self.started.discard(object_num)
+            if object_num in self.stale:
+                self.stale.discard(object_num)
+                data = None
+
+            if data is not None:
+                self.ready[object_num] = data
+                self.log.debug("prefetched: %s" % object_num)
+
+                while len(self.ready) > self.max_window*2:
+                    self.ready.popitem(last=False)
+                    self.wasted += 1
+                    self.window = max(self.window // 2, 1)
+
+        event.set()
+
+    def take(self, object_num):
+        """
+        Get a prefetched object or None.
+
+        It waits if the object is being fetched, but a fetch that hasn't
+        started yet is cancelled (the caller is better off fetching it).
+        HOLE is returned if the object doesn't exist.
+        """
+        with self.lock:
+            event = self.inflight.get(object_num)
+            if event is not None and object_num not in self.started:
+                self.stale.add(object_num)
+                event = None
+
+        if event is not None:
+            event.wait()
+
+        with self.lock:
+            data = self.ready.pop(object_num, None)
+            if data is not None:
+                self.hits += 1
+                self.window = min(self.window + 1, self.max_window)
+
+        return data
+
+    def invalidate(self, object_num):
+        """Discard any prefetched data for an object that has been modified"""
+        with self.lock:
+            self.ready.pop(object_num, None)
+            if object_num in self.inflight:
+                self.stale.add(object_num)
+
+    def flush(self):
+        """Discard all the prefetched data"""
+        with self.lock:
+            self.ready = OrderedDict()
+            self.stale.update(self.inflight.keys())
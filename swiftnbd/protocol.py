@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+swiftnbd. buffered protocol transport
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import asyncio
+
+from swiftnbd.const import receive_buffer
+from swiftnbd.server import AbortedNegotiationError
+from swiftnbd.dispatcher import Dispatcher
+
+# asyncio.Protocol is used if there's no BufferedProtocol (see data_received)
+BufferedProtocol = getattr(asyncio, "BufferedProtocol", asyncio.Protocol)
+
+class NBDProtocol(BufferedProtocol):
+    """
+    NBD connection handled by a buffered protocol.
+
+    The data is received into a preallocated buffer and the requests are parsed
+    from it as they are complete, without a coroutine per request read. The write
+    payloads that don't fit in the buffer are received directly into their own
+    buffer.
+
+    The negotiation phase is run by Server.negotiate, with the protocol acting as
+    both reader and writer.
+    """
+    def __init__(self, server, buffer_size=receive_buffer):
+        self.server = server
+        self.log = server.log
+        # the requests are logged by the export (its debug log can be enabled alone)
+        self.request_log = self.log
+
+        self.buffer = bytearray(max(buffer_size, server.REQUEST_HEADER.size))
+        self.view = memoryview(self.buffer)
+        # data received and not parsed: buffer[start:end]
+        self.start = 0
+        self.end = 0
+
+        # write request receiving its payload out of the buffer
+        self.request = None
+        self.payload = None
+        self.filled = 0
+
+        self.transport = None
+        self.host, self.port = None, None
+        self.store = None
+        self.structured = False
+        self.contexts = None
+        self.dispatcher = None
+
+        # reading is paused waiting for room in the dispatcher or
+        # because the transport asked to pause writing
+        self.reading = True
+        self.waiting_room = None
+        self.writing_paused = False
+
+        self.negotiating = True
+        self.waiter = None
+        self.drain_waiter = None
+        self.eof = False
+        self.finished = None
+
+    # protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.host, self.port = transport.get_extra_info("peername")[:2]
+        self.log.info("Incoming connection from %s:%s" % (self.host, self.port))
+        asyncio.ensure_future(self.negotiate())
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self._wakeup()
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        if not self.negotiating:
+            self.finish()
+
+    def pause_writing(self):
+        self.writing_paused = True
+        self._update_reading()
+
+    def resume_writing(self):
+        self.writing_paused = False
+        if self.drain_waiter is not None and not self.drain_waiter.done():
+            self.drain_waiter.set_result(None)
+        self._update_reading()
+
+    def get_buffer(self, sizehint):
+        if self.payload is not None:
+            return memoryview(self.payload)[self.filled:]
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif len(self.buffer) - self.end < len(self.buffer) // 4:
+            # move the incomplete request to the beginning of the buffer
+            pending = bytes(self.view[self.start:self.end])
+            self.buffer[:len(pending)] = pending
+            self.start, self.end = 0, len(pending)
+
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        if self.payload is not None:
+            self.filled += nbytes
+            if self.filled < len(self.payload):
+                return
+            (flags, cmd, handle, offset, length) = self.request
+            data = self.payload
+            self.request, self.payload = None, None
+            if not self.submit(flags, cmd, handle, offset, length, data):
+                return
+        else:
+            self.end += nbytes
+
+        if self.negotiating:
+            self._wakeup()
+        else:
+            self.parse()
+
+    def data_received(self, data):
+        # without BufferedProtocol the data is copied into the buffers
+        view = memoryview(data)
+        while view:
+            buffer = self.get_buffer(len(view))
+            if not buffer:
+                # the requests in the buffer can't be submitted yet
+                self._grow(len(self.buffer) + len(view))
+                continue
+            size = min(len(buffer), len(view))
+            buffer[:size] = view[:size]
+            view = view[size:]
+            self.buffer_updated(size)
+
+    def eof_received(self):
+        self.eof = True
+        self._wakeup()
+        if not self.negotiating:
+            self.finish()
+        # keep the transport open to send the pending replies
+        return True
+
+    # reader and writer used by the negotiation and the requests
+
+    @asyncio.coroutine
+    def readexactly(self, n):
+        while self.end - self.start < n:
+            if self.eof:
+                raise asyncio.IncompleteReadError(bytes(self.view[self.start:self.end]), n)
+            if n > len(self.buffer) - self.start:
+                # only the negotiation options can be larger than the buffer
+                self._grow(n)
+            self.waiter = asyncio.Future()
+            yield from self.waiter
+
+        data = bytes(self.view[self.start:self.start + n])
+        self.start += n
+        return data
+
+    def write(self, data):
+        self.transport.write(data)
+
+    def writelines(self, data):
+        self.transport.writelines(data)
+
+    @asyncio.coroutine
+    def drain(self):
+        if self.writing_paused and not self.eof:
+            self.drain_waiter = asyncio.Future()
+            yield from self.drain_waiter
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def close(self):
+        self.transport.close()
+
+    def _wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    def _grow(self, size):
+        buffer = bytearray(size)
+        buffer[:self.end - self.start] = self.view[self.start:self.end]
+        self.buffer, self.view = buffer, memoryview(buffer)
+        self.start, self.end = 0, self.end - self.start
+
+    def _update_reading(self):
+        reading = self.waiting_room is None and not self.writing_paused and self.finished is None
+        if reading == self.reading or self.transport.is_closing():
+            return
+        self.reading = reading
+        if reading:
+            self.transport.resume_reading()
+        else:
+            self.transport.pause_reading()
+
+    # phases of the connection
+
+    @asyncio.coroutine
+    def negotiate(self):
+        try:
+            self.store, self.structured, self.contexts = yield from self.server.negotiate(self, self, self.host, self.port)
+            yield from self.drain()
+        except AbortedNegotiationError:
+            self.log.info("[%s:%s] Client aborted negotiation" % (self.host, self.port))
+        except (asyncio.IncompleteReadError, IOError) as ex:
+            self.log.error("[%s:%s] %s" % (self.host, self.port, ex))
+        else:
+            self.dispatcher = Dispatcher(self.server.max_requests, self.server.max_request_bytes,
+                                         self.store.object_size)
+            self.request_log = self.store.log
+            self.negotiating = False
+            if self.eof:
+                self.finish()
+            else:
+                # the client may have sent requests already
+                self.parse()
+            return
+
+        self.negotiating = False
+        self.finish()
+
+    def parse(self):
+        """Parse and submit the complete requests in the buffer"""
+        header = self.server.REQUEST_HEADER
+        while self.finished is None and self.waiting_room is None:
+            available = self.end - self.start
+            if available < header.size:
+                return
+
+            (magic, flags, cmd, handle, offset, length) = header.unpack_from(self.buffer, self.start)
+            if magic != self.server.NBD_REQUEST:
+                self.log.error("[%s:%s] Bad magic number, disconnecting" % (self.host, self.port))
+                self.finish()
+                return
+
+            data = None
+            if cmd == self.server.NBD_CMD_WRITE:
+                if available < header.size + length:
+                    if header.size + length <= len(self.buffer):
+                        # wait for the rest of the payload
+                        return
+                    # too large for the buffer, receive it directly
+                    self.request = (flags, cmd, handle, offset, length)
+                    self.payload = bytearray(length)
+                    self.filled = available - header.size
+                    self.payload[:self.filled] = self.view[self.start + header.size:self.end]
+                    self.start = self.end = 0
+                    return
+                data = bytes(self.view[self.start + header.size:self.start + header.size + length])
+                self.start += length
+            self.start += header.size
+
+            if not self.submit(flags, cmd, handle, offset, length, data):
+                return
+
+    def submit(self, flags, cmd, handle, offset, length, data):
+        """Submit a request, returns False if no more requests can be submitted now"""
+        server = self.server
+        if self.request_log.isEnabledFor(logging.DEBUG):
+            self.request_log.debug("[%s:%s]: cmd=%s, flags=%s, handle=%s, offset=%s, len=%s"
+                           % (self.host, self.port, cmd, flags, handle, offset, length))
+
+        if cmd == server.NBD_CMD_DISC:
+            self.log.info("[%s:%s] disconnecting" % (self.host, self.port))
+            self.finish()
+            return False
+
+        if cmd not in server.NBD_CMDS:
+            self.log.warning("[%s:%s] Unknown cmd %s, disconnecting" % (self.host, self.port, cmd))
+            self.finish()
+            return False
+
+        # only reads and writes carry data
+        reserved = length if cmd in (server.NBD_CMD_WRITE, server.NBD_CMD_READ) else 0
+        request = (self.dispatcher, self, self.store, cmd, handle, offset, length, data, flags,
+                   self.structured, self.contexts, reserved)
+        if self.dispatcher.try_reserve(reserved):
+            server.nbd_dispatch(*request)
+            return True
+
+        self.waiting_room = asyncio.ensure_future(self.wait_room(request))
+        self._update_reading()
+        return False
+
+    @asyncio.coroutine
+    def wait_room(self, request):
+        """Dispatch a request when there's room, and continue parsing"""
+        reserved = request[-1]
+        yield from self.dispatcher.reserve(reserved)
+        self.server.nbd_dispatch(*request)
+
+        self.waiting_room = None
+        if self.finished is None:
+            self._update_reading()
+            self.parse()
+
+    def finish(self):
+        """Finish the connection once the requests in flight are done"""
+        if self.finished is None:
+            self.finished = asyncio.ensure_future(self._finish())
+            self._update_reading()
+        return self.finished
+
+    @asyncio.coroutine
+    def _finish(self):
+        if self.waiting_room is not None:
+            yield from asyncio.wait([self.waiting_room])
+
+        if self.dispatcher is not None:
+            yield from self.dispatcher.drain()
+
+        if self.store is not None:
+            try:
+                yield from self.server.aio[self.store].unlock()
+            except IOError as ex:
+                self.log.error(ex)
+
+        self.transport.close()
@@ -22,14 +22,18 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import os
 import struct
+import errno
 import logging
 
 import signal
 import asyncio
 
-from swiftnbd.const import stats_delay
+from swiftnbd.const import stats_delay, storage_workers, max_requests, max_request_bytes, coalesce_window
 from swiftnbd.common import Stats
+from swiftnbd.executor import AsyncSwiftStorage
+from swiftnbd.dispatcher import Dispatcher
 
 class AbortedNegotiationError(IOError):
     pass
@@ -45,36 +49,103 @@ class Server(object):
 
     NBD_REQUEST = 0x25609513
     NBD_RESPONSE = 0x67446698
+    NBD_STRUCTURED_REPLY = 0x668e33ef
 
     NBD_OPT_EXPORTNAME = 1
     NBD_OPT_ABORT = 2
     NBD_OPT_LIST = 3
+    NBD_OPT_INFO = 6
+    NBD_OPT_GO = 7
+    NBD_OPT_STRUCTURED_REPLY = 8
+    NBD_OPT_LIST_META_CONTEXT = 9
+    NBD_OPT_SET_META_CONTEXT = 10
 
     NBD_REP_ACK = 1
     NBD_REP_SERVER = 2
+    NBD_REP_INFO = 3
+    NBD_REP_META_CONTEXT = 4
     NBD_REP_ERR_UNSUP = 2**31 + 1
+    NBD_REP_ERR_INVALID = 2**31 + 3
+    NBD_REP_ERR_UNKNOWN = 2**31 + 6
+
+    NBD_INFO_EXPORT = 0
+    NBD_INFO_BLOCK_SIZE = 3
 
     NBD_CMD_READ = 0
     NBD_CMD_WRITE = 1
     NBD_CMD_DISC = 2
     NBD_CMD_FLUSH = 3
-
-    # fixed newstyle handshake
-    NBD_HANDSHAKE_FLAGS = (1 << 0)
+    NBD_CMD_TRIM = 4
+    NBD_CMD_WRITE_ZEROES = 6
+    NBD_CMD_BLOCK_STATUS = 7
+
+    # commands served by the dispatcher, and the ones modifying the data
+    NBD_CMDS = (NBD_CMD_WRITE, NBD_CMD_READ, NBD_CMD_FLUSH, NBD_CMD_TRIM, NBD_CMD_WRITE_ZEROES, NBD_CMD_BLOCK_STATUS)
+    NBD_WRITE_CMDS = (NBD_CMD_WRITE, NBD_CMD_TRIM, NBD_CMD_WRITE_ZEROES)
+
+    # names of the commands in the stats
+    NBD_CMD_NAMES = {NBD_CMD_READ: "read",
+                     NBD_CMD_WRITE: "write",
+                     NBD_CMD_FLUSH: "flush",
+                     NBD_CMD_TRIM: "trim",
+                     NBD_CMD_WRITE_ZEROES: "write_zeroes",
+                     NBD_CMD_BLOCK_STATUS: "block_status",
+                     }
+
+    NBD_CMD_FLAG_FUA = (1 << 0)
+    NBD_CMD_FLAG_NO_HOLE = (1 << 1)
+    NBD_CMD_FLAG_REQ_ONE = (1 << 3)
+
+    NBD_REPLY_FLAG_DONE = (1 << 0)
+
+    NBD_REPLY_TYPE_NONE = 0
+    NBD_REPLY_TYPE_OFFSET_DATA = 1
+    NBD_REPLY_TYPE_OFFSET_HOLE = 2
+    NBD_REPLY_TYPE_BLOCK_STATUS = 5
+    NBD_REPLY_TYPE_ERROR = 2**15 + 1
+
+    # metadata contexts: name -> id
+    NBD_META_CONTEXTS = {"base:allocation": 1}
+    NBD_STATE_HOLE = (1 << 0)
+    NBD_STATE_ZERO = (1 << 1)
+
+    # fixed newstyle handshake, no zeroes
+    NBD_HANDSHAKE_FLAGS = (1 << 0) ^ (1 << 1)
+    NBD_FLAG_C_NO_ZEROES = (1 << 1)
 
     # has flags, supports flush
     NBD_EXPORT_FLAGS = (1 << 0) ^ (1 << 2)
     NBD_RO_FLAG = (1 << 1)
-
-    def __init__(self, addr, stores):
+    NBD_FUA_FLAG = (1 << 3)
+    NBD_TRIM_FLAG = (1 << 5)
+    NBD_WRITE_ZEROES_FLAG = (1 << 6)
+
+    # headers of the requests, simple replies and structured reply chunks
+    REQUEST_HEADER = struct.Struct(">LHHQQL")
+    RESPONSE_HEADER = struct.Struct(">LLQ")
+    CHUNK_HEADER = struct.Struct(">LHHQL")
+
+    def __init__(self, addr, stores, workers=storage_workers,
+                 max_requests=max_requests, max_request_bytes=max_request_bytes, buffered=False,
+                 coalesce_window=coalesce_window, metrics_address=None, admin_socket=None):
         self.log = logging.getLogger(__package__)
 
         self.address = addr
         self.stores = stores
+        self.max_requests = max_requests
+        self.max_request_bytes = max_request_bytes
+        # use the buffered protocol transport instead of streams
+        self.buffered = buffered
+        # optional (address, port) of the metrics HTTP listener
+        self.metrics_address = metrics_address
+        # optional path of the admin socket
+        self.admin_socket = admin_socket
 
         self.stats = dict()
+        self.aio = dict()
         for store in self.stores.values():
             self.stats[store] = Stats(store)
+            self.aio[store] = AsyncSwiftStorage(store, workers, coalesce_window)
 
     @asyncio.coroutine
     def log_stats(self):
@@ -85,163 +156,439 @@ class Server(object):
 
             yield from asyncio.sleep(stats_delay)
 
-    @asyncio.coroutine
     def nbd_response(self, writer, handle, error=0, data=None):
-        writer.write(struct.pack('>LLQ', self.NBD_RESPONSE, error, handle))
+        """Write a simple reply, data is a list of buffers (if any)"""
+        header = self.RESPONSE_HEADER.pack(self.NBD_RESPONSE, error, handle)
         if data:
-            writer.write(data)
-        yield from writer.drain()
+            writer.writelines([header] + data)
+        else:
+            writer.write(header)
+
+    def nbd_chunk(self, writer, handle, chunk_type, payload=b'', data=None, done=False):
+        """Write a structured reply chunk, payload is followed by data, a list of buffers (if any)"""
+        length = len(payload) + (sum(len(view) for view in data) if data else 0)
+        flags = self.NBD_REPLY_FLAG_DONE if done else 0
+        header = self.CHUNK_HEADER.pack(self.NBD_STRUCTURED_REPLY, flags, chunk_type, handle, length) + payload
+        if data:
+            writer.writelines([header] + data)
+        else:
+            writer.write(header)
+
+    @staticmethod
+    def slice_views(views, pos, length):
+        """Slice a list of buffers as if they were one, without copying"""
+        sliced = []
+        for view in views:
+            if length <= 0:
+                break
+            if pos >= len(view):
+                pos -= len(view)
+                continue
+            view = memoryview(view)[pos:pos + length]
+            sliced.append(view)
+            length -= len(view)
+            pos = 0
+        return sliced
+
+    def nbd_read_chunks(self, writer, handle, offset, data, extents):
+        """Reply to a read with structured reply chunks, holes are not sent"""
+        size = sum(len(view) for view in data)
+        chunks = []
+        pos = 0
+        for length, hole in extents:
+            length = min(length, size - pos)
+            if length > 0:
+                chunks.append((pos, length, hole))
+            pos += length
+        if pos < size:
+            # the extents may not cover all the data
+            chunks.append((pos, size - pos, False))
+
+        if not chunks:
+            self.nbd_chunk(writer, handle, self.NBD_REPLY_TYPE_NONE, done=True)
+            return
+
+        for i, (pos, length, hole) in enumerate(chunks):
+            done = i == len(chunks) - 1
+            if hole:
+                self.nbd_chunk(writer, handle, self.NBD_REPLY_TYPE_OFFSET_HOLE,
+                               struct.pack(">QL", offset + pos, length), done=done)
+            else:
+                self.nbd_chunk(writer, handle, self.NBD_REPLY_TYPE_OFFSET_DATA,
+                               struct.pack(">Q", offset + pos), self.slice_views(data, pos, length), done=done)
+
+    def nbd_block_status(self, writer, handle, contexts, extents):
+        """Reply to a block status request with the extents for each context"""
+        descriptors = b"".join(struct.pack(">LL", length, (self.NBD_STATE_HOLE ^ self.NBD_STATE_ZERO) if hole else 0)
+                               for length, hole in extents)
+        ids = sorted(contexts)
+        for context_id in ids:
+            self.nbd_chunk(writer, handle, self.NBD_REPLY_TYPE_BLOCK_STATUS,
+                           struct.pack(">L", context_id) + descriptors, done=context_id == ids[-1])
+
+    def nbd_reply(self, writer, opt, reply, data=b''):
+        """Reply to an option in the negotiation phase"""
+        writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, reply, len(data)) + data)
+
+    def export_flags(self, store):
+        """Transmission flags of a store"""
+        export_flags = self.NBD_EXPORT_FLAGS
+        if store.read_only:
+            export_flags ^= self.NBD_RO_FLAG
+        else:
+            export_flags ^= self.NBD_FUA_FLAG ^ self.NBD_TRIM_FLAG ^ self.NBD_WRITE_ZEROES_FLAG
+        return export_flags
+
+    def block_size(self, store):
+        """Block size constraints of a store: minimum, preferred and maximum"""
+        # any size works, but whole objects avoid reading before writing
+        preferred = 512
+        while preferred*2 <= store.object_size:
+            preferred *= 2
+        maximum = max(self.max_request_bytes - self.max_request_bytes % preferred, preferred)
+        return 1, preferred, maximum
 
     @asyncio.coroutine
-    def handler(self, reader, writer):
-        """Handle the connection"""
+    def nbd_request(self, writer, store, cmd, handle, offset, length, data=None, flags=0,
+                    structured=False, contexts=None, merge=False):
+        """
+        Serve a request and reply to it.
+
+        If structured is True the structured replies have been negotiated, and
+        contexts are the metadata contexts selected (id -> name). merge is True
+        if a write is merged with other writes (see Dispatcher).
+        """
+        aio = self.aio[store]
+        stats = self.stats[store]
+        stats.in_flight += 1
+        extents = None
         try:
-            host, port = writer.get_extra_info("peername")
-            store, container = None, None
-            self.log.info("Incoming connection from %s:%s" % (host,port))
+            if cmd == self.NBD_CMD_WRITE:
+                yield from aio.write(offset, data, merge)
+                self.stats[store].bytes_in += length
+                data = None
+
+            elif cmd == self.NBD_CMD_READ:
+                if structured:
+                    extents = yield from aio.extents(offset, length)
+                # the objects are sent without copying them
+                data = yield from aio.read_views(offset, length)
+                self.stats[store].bytes_out += sum(len(view) for view in data)
+
+            elif cmd == self.NBD_CMD_FLUSH:
+                yield from aio.flush()
+
+            elif cmd == self.NBD_CMD_TRIM:
+                yield from aio.trim(offset, length)
+
+            elif cmd == self.NBD_CMD_WRITE_ZEROES:
+                yield from aio.zero(offset, length, hole=not flags & self.NBD_CMD_FLAG_NO_HOLE)
+
+            elif cmd == self.NBD_CMD_BLOCK_STATUS:
+                if not structured or not contexts:
+                    raise IOError(errno.EINVAL, "No metadata context has been negotiated")
+                extents = yield from aio.extents(offset, length)
+                if flags & self.NBD_CMD_FLAG_REQ_ONE:
+                    extents = extents[:1]
+
+            if flags & self.NBD_CMD_FLAG_FUA and cmd in self.NBD_WRITE_CMDS:
+                # the request has waited for the merged writes in its range
+                yield from aio.flush(merged=False)
+
+        except IOError as ex:
+            self.log.error("[%s] %s" % (store, ex))
+            self.nbd_error(writer, handle, cmd, ex.errno or errno.EIO, structured)
+            stats.request(self.NBD_CMD_NAMES[cmd], error=True)
+            return
+
+        except Exception as ex:
+            # the client must get a reply to every request
+            self.log.exception("[%s] Unexpected error: %s" % (store, ex))
+            self.nbd_error(writer, handle, cmd, errno.EIO, structured)
+            stats.request(self.NBD_CMD_NAMES[cmd], error=True)
+            return
 
-            # initial handshake
-            writer.write(b"NBDMAGIC" + struct.pack(">QH", self.NBD_HANDSHAKE, self.NBD_HANDSHAKE_FLAGS))
-            yield from writer.drain()
+        finally:
+            stats.in_flight -= 1
+
+        stats.request(self.NBD_CMD_NAMES[cmd], length if cmd == self.NBD_CMD_READ or cmd in self.NBD_WRITE_CMDS else 0)
+
+        if structured and cmd == self.NBD_CMD_READ:
+            self.nbd_read_chunks(writer, handle, offset, data, extents)
+        elif cmd == self.NBD_CMD_BLOCK_STATUS:
+            self.nbd_block_status(writer, handle, contexts, extents)
+        else:
+            self.nbd_response(writer, handle, data=data)
+
+    def nbd_dispatch(self, dispatcher, writer, store, cmd, handle, offset, length, data, flags,
+                     structured, contexts, reserved):
+        """Start a request that has been reserved in the dispatcher"""
+        aio = self.aio[store]
+        merge = (cmd == self.NBD_CMD_WRITE and not flags & self.NBD_CMD_FLAG_FUA
+                 and aio.coalescable(offset, length))
+        if cmd == self.NBD_CMD_FLUSH:
+            aio.expire()
+        elif cmd in self.NBD_WRITE_CMDS and not merge:
+            # don't wait for the merge window of the writes it depends on
+            aio.expire(offset, length)
+
+        return dispatcher.start(self.nbd_request(writer, store, cmd, handle, offset, length, data, flags,
+                                                 structured, contexts, merge),
+                                offset, length,
+                                write=(cmd in self.NBD_WRITE_CMDS),
+                                barrier=(cmd == self.NBD_CMD_FLUSH),
+                                reserved=reserved,
+                                merge=merge,
+                                )
+
+    def nbd_error(self, writer, handle, cmd, error, structured=False):
+        """Reply with an error, with a structured reply chunk for the commands that need it"""
+        if structured and cmd in (self.NBD_CMD_READ, self.NBD_CMD_BLOCK_STATUS):
+            self.nbd_chunk(writer, handle, self.NBD_REPLY_TYPE_ERROR, struct.pack(">LH", error, 0), done=True)
+        else:
+            self.nbd_response(writer, handle, error=error)
 
-            data = yield from reader.readexactly(4)
+    @asyncio.coroutine
+    def negotiate(self, reader, writer, host, port):
+        """
+        Handshake and negotiation phase.
+
+        Returns the negotiated store (locked), if structured replies were
+        negotiated and the metadata contexts selected. The last reply is
+        written but not drained.
+        """
+        # initial handshake
+        writer.write(b"NBDMAGIC" + struct.pack(">QH", self.NBD_HANDSHAKE, self.NBD_HANDSHAKE_FLAGS))
+        yield from writer.drain()
+
+        data = yield from reader.readexactly(4)
+        try:
+            client_flag = struct.unpack(">L", data)[0]
+        except struct.error:
+            raise IOError("Handshake failed, disconnecting")
+
+        # we support both fixed and unfixed new-style handshake
+        if client_flag == 0:
+            fixed = False
+            self.log.warning("Client using new-style non-fixed handshake")
+        elif client_flag & 1:
+            fixed = True
+        else:
+            raise IOError("Handshake failed, disconnecting")
+
+        no_zeroes = bool(client_flag & self.NBD_FLAG_C_NO_ZEROES)
+        structured = False
+        contexts = dict()
+
+        # negotiation phase
+        while True:
+            header = yield from reader.readexactly(16)
             try:
-                client_flag = struct.unpack(">L", data)[0]
-            except struct.error:
-                raise IOError("Handshake failed, disconnecting")
-
-            # we support both fixed and unfixed new-style handshake
-            if client_flag == 0:
-                fixed = False
-                self.log.warning("Client using new-style non-fixed handshake")
-            elif client_flag & 1:
-                fixed = True
+                (magic, opt, length) = struct.unpack(">QLL", header)
+            except struct.error as ex:
+                raise IOError("Negotiation failed: Invalid request, disconnecting")
+
+            if magic != self.NBD_HANDSHAKE:
+                raise IOError("Negotiation failed: bad magic number: %s" % magic)
+
+            if length:
+                data = yield from reader.readexactly(length)
+                if(len(data) != length):
+                    raise IOError("Negotiation failed: %s bytes expected" % length)
             else:
-                raise IOError("Handshake failed, disconnecting")
+                data = None
 
-            # negotiation phase
-            while True:
-                header = yield from reader.readexactly(16)
-                try:
-                    (magic, opt, length) = struct.unpack(">QLL", header)
-                except struct.error as ex:
-                    raise IOError("Negotiation failed: Invalid request, disconnecting")
+            self.log.debug("[%s:%s]: opt=%s, len=%s, data=%s" % (host, port, opt, length, data))
 
-                if magic != self.NBD_HANDSHAKE:
-                    raise IOError("Negotiation failed: bad magic number: %s" % magic)
+            if opt == self.NBD_OPT_EXPORTNAME:
+                if not data:
+                    raise IOError("Negotiation failed: no export name was provided")
 
-                if length:
-                    data = yield from reader.readexactly(length)
-                    if(len(data) != length):
-                        raise IOError("Negotiation failed: %s bytes expected" % length)
-                else:
-                    data = None
+                data = data.decode("utf-8")
+                if data not in self.stores:
+                    if not fixed:
+                        raise IOError("Negotiation failed: unknown export name")
 
-                self.log.debug("[%s:%s]: opt=%s, len=%s, data=%s" % (host, port, opt, length, data))
+                    self.nbd_reply(writer, opt, self.NBD_REP_ERR_UNSUP)
+                    yield from writer.drain()
+                    continue
 
-                if opt == self.NBD_OPT_EXPORTNAME:
-                    if not data:
-                        raise IOError("Negotiation failed: no export name was provided")
+                # we have negotiated a store and it will be used
+                # until the client disconnects
+                store = self.stores[data]
+                aio = self.aio[store]
+                yield from aio.lock("%s:%s" % (host, port))
 
-                    data = data.decode("utf-8")
-                    if data not in self.stores:
-                        if not fixed:
-                            raise IOError("Negotiation failed: unknown export name")
+                self.log.info("[%s:%s] Negotiated export: %s" % (host, port, store.container))
+                if store.read_only:
+                    self.log.info("[%s:%s] %s is read only" % (host, port, store.container))
 
-                        writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ERR_UNSUP, 0))
-                        yield from writer.drain()
-                        continue
+                writer.write(struct.pack('>QH', store.size, self.export_flags(store)))
+                if not no_zeroes:
+                    writer.write(b"\x00"*124)
+                return store, structured, contexts
 
-                    # we have negotiated a store and it will be used
-                    # until the client disconnects
-                    store = self.stores[data]
-                    store.lock("%s:%s" % (host, port))
+            elif opt in (self.NBD_OPT_INFO, self.NBD_OPT_GO) and fixed:
+                try:
+                    name_length = struct.unpack(">L", data[:4])[0]
+                    name = data[4:4 + name_length].decode("utf-8")
+                    count = struct.unpack(">H", data[4 + name_length:6 + name_length])[0]
+                    infos = struct.unpack(">%dH" % count, data[6 + name_length:])
+                except (struct.error, TypeError, UnicodeDecodeError):
+                    self.nbd_reply(writer, opt, self.NBD_REP_ERR_INVALID)
+                    yield from writer.drain()
+                    continue
 
-                    self.log.info("[%s:%s] Negotiated export: %s" % (host, port, store.container))
+                if name not in self.stores:
+                    self.nbd_reply(writer, opt, self.NBD_REP_ERR_UNKNOWN)
+                    yield from writer.drain()
+                    continue
 
-                    export_flags = self.NBD_EXPORT_FLAGS
-                    if store.read_only:
-                        export_flags ^= self.NBD_RO_FLAG
-                        self.log.info("[%s:%s] %s is read only" % (host, port, store.container))
-                    writer.write(struct.pack('>QH', store.size, export_flags))
-                    writer.write(b"\x00"*124)
+                _store = self.stores[name]
+                self.nbd_reply(writer, opt, self.NBD_REP_INFO,
+                               struct.pack(">HQH", self.NBD_INFO_EXPORT, _store.size, self.export_flags(_store)))
+                if self.NBD_INFO_BLOCK_SIZE in infos:
+                    self.nbd_reply(writer, opt, self.NBD_REP_INFO,
+                                   struct.pack(">HLLL", self.NBD_INFO_BLOCK_SIZE, *self.block_size(_store)))
+
+                if opt == self.NBD_OPT_INFO:
+                    self.nbd_reply(writer, opt, self.NBD_REP_ACK)
                     yield from writer.drain()
+                    continue
 
-                    break
+                # the store will be used until the client disconnects
+                store = _store
+                yield from self.aio[store].lock("%s:%s" % (host, port))
+
+                self.log.info("[%s:%s] Negotiated export: %s" % (host, port, store.container))
+                if store.read_only:
+                    self.log.info("[%s:%s] %s is read only" % (host, port, store.container))
 
-                elif opt == self.NBD_OPT_LIST:
-                    for container in self.stores.keys():
-                        writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_SERVER, len(container) + 4))
-                        container_encoded = container.encode("utf-8")
-                        writer.write(struct.pack(">L", len(container_encoded)))
-                        writer.write(container_encoded)
-                        yield from writer.drain()
+                self.nbd_reply(writer, opt, self.NBD_REP_ACK)
+                return store, structured, contexts
 
-                    writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ACK, 0))
+            elif opt == self.NBD_OPT_STRUCTURED_REPLY and fixed:
+                if data:
+                    self.nbd_reply(writer, opt, self.NBD_REP_ERR_INVALID)
+                else:
+                    structured = True
+                    self.nbd_reply(writer, opt, self.NBD_REP_ACK)
+                yield from writer.drain()
+
+            elif opt in (self.NBD_OPT_LIST_META_CONTEXT, self.NBD_OPT_SET_META_CONTEXT) and fixed:
+                try:
+                    name_length = struct.unpack(">L", data[:4])[0]
+                    name = data[4:4 + name_length].decode("utf-8")
+                    pos = 4 + name_length
+                    count = struct.unpack(">L", data[pos:pos + 4])[0]
+                    pos += 4
+                    queries = []
+                    for _ in range(count):
+                        query_length = struct.unpack(">L", data[pos:pos + 4])[0]
+                        queries.append(data[pos + 4:pos + 4 + query_length].decode("utf-8"))
+                        pos += 4 + query_length
+                except (struct.error, TypeError, UnicodeDecodeError):
+                    self.nbd_reply(writer, opt, self.NBD_REP_ERR_INVALID)
                     yield from writer.drain()
+                    continue
 
-                elif opt == self.NBD_OPT_ABORT:
-                    writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ACK, 0))
+                if opt == self.NBD_OPT_SET_META_CONTEXT and not structured:
+                    self.nbd_reply(writer, opt, self.NBD_REP_ERR_INVALID)
                     yield from writer.drain()
+                    continue
 
-                    raise AbortedNegotiationError()
+                if name not in self.stores:
+                    self.nbd_reply(writer, opt, self.NBD_REP_ERR_UNKNOWN)
+                    yield from writer.drain()
+                    continue
+
+                if opt == self.NBD_OPT_LIST_META_CONTEXT:
+                    # no queries lists all, and "namespace:" lists all in the namespace
+                    selected = [context for context in self.NBD_META_CONTEXTS
+                                if not queries or any(query == context or (query.endswith(":") and context.startswith(query))
+                                                      for query in queries)]
+                    for context in selected:
+                        self.nbd_reply(writer, opt, self.NBD_REP_META_CONTEXT,
+                                       struct.pack(">L", 0) + context.encode("utf-8"))
                 else:
-                    # we don't support any other option
-                    if not fixed:
-                        raise IOError("Unsupported option")
-
-                    writer.write(struct.pack(">QLLL", self.NBD_REPLY, opt, self.NBD_REP_ERR_UNSUP, 0))
+                    contexts = dict((self.NBD_META_CONTEXTS[query], query) for query in queries
+                                    if query in self.NBD_META_CONTEXTS)
+                    for context_id, context in contexts.items():
+                        self.nbd_reply(writer, opt, self.NBD_REP_META_CONTEXT,
+                                       struct.pack(">L", context_id) + context.encode("utf-8"))
+
+                self.nbd_reply(writer, opt, self.NBD_REP_ACK)
+                yield from writer.drain()
+
+            elif opt == self.NBD_OPT_LIST:
+                for container in self.stores.keys():
+                    container_encoded = container.encode("utf-8")
+                    self.nbd_reply(writer, opt, self.NBD_REP_SERVER,
+                                   struct.pack(">L", len(container_encoded)) + container_encoded)
                     yield from writer.drain()
 
+                self.nbd_reply(writer, opt, self.NBD_REP_ACK)
+                yield from writer.drain()
+
+            elif opt == self.NBD_OPT_ABORT:
+                self.nbd_reply(writer, opt, self.NBD_REP_ACK)
+                yield from writer.drain()
+
+                raise AbortedNegotiationError()
+            else:
+                # we don't support any other option
+                if not fixed:
+                    raise IOError("Unsupported option")
+
+                self.nbd_reply(writer, opt, self.NBD_REP_ERR_UNSUP)
+                yield from writer.drain()
+
+    @asyncio.coroutine
+    def handler(self, reader, writer):
+        """Handle the connection"""
+        try:
+            host, port = writer.get_extra_info("peername")
+            store = None
+            dispatcher = None
+            self.log.info("Incoming connection from %s:%s" % (host,port))
+
+            store, structured, contexts = yield from self.negotiate(reader, writer, host, port)
+            yield from writer.drain()
+
             # operation phase
+            dispatcher = Dispatcher(self.max_requests, self.max_request_bytes, store.object_size)
             while True:
-                header = yield from reader.readexactly(28)
-                try:
-                    (magic, cmd, handle, offset, length) = struct.unpack(">LLQQL", header)
-                except struct.error:
-                    raise IOError("Invalid request, disconnecting")
+                header = yield from reader.readexactly(self.REQUEST_HEADER.size)
+                (magic, flags, cmd, handle, offset, length) = self.REQUEST_HEADER.unpack(header)
 
                 if magic != self.NBD_REQUEST:
                     raise IOError("Bad magic number, disconnecting")
 
-                self.log.debug("[%s:%s]: cmd=%s, handle=%s, offset=%s, len=%s" % (host, port, cmd, handle, offset, length))
+                # the requests are logged by the export (its debug log can be enabled alone)
+                if store.log.isEnabledFor(logging.DEBUG):
+                    store.log.debug("[%s:%s]: cmd=%s, flags=%s, handle=%s, offset=%s, len=%s" % (host, port, cmd, flags, handle, offset, length))
 
                 if cmd == self.NBD_CMD_DISC:
                     self.log.info("[%s:%s] disconnecting" % (host, port))
+                    yield from dispatcher.drain()
                     break
 
-                elif cmd == self.NBD_CMD_WRITE:
-                    data = yield from reader.readexactly(length)
-                    if(len(data) != length):
-                        raise IOError("%s bytes expected, disconnecting" % length)
-
-                    try:
-                        store.seek(offset)
-                        store.write(data)
-                    except IOError as ex:
-                        self.log.error("[%s:%s] %s" % (host, port, ex))
-                        yield from self.nbd_response(writer, handle, error=ex.errno)
-                        continue
-
-                    self.stats[store].bytes_in += length
-                    yield from self.nbd_response(writer, handle)
-
-                elif cmd == self.NBD_CMD_READ:
-                    try:
-                        store.seek(offset)
-                        data = store.read(length)
-                    except IOError as ex:
-                        self.log.error("[%s:%s] %s" % (host, port, ex))
-                        yield from self.nbd_response(writer, handle, error=ex.errno)
-                        continue
-
-                    if data:
-                        self.stats[store].bytes_out += len(data)
-                    yield from self.nbd_response(writer, handle, data=data)
-
-                elif cmd == self.NBD_CMD_FLUSH:
-                    store.flush()
-                    yield from self.nbd_response(writer, handle)
+                elif cmd in self.NBD_CMDS:
+                    # only reads and writes carry data
+                    reserved = length if cmd in (self.NBD_CMD_WRITE, self.NBD_CMD_READ) else 0
+                    yield from dispatcher.reserve(reserved)
+
+                    data = None
+                    if cmd == self.NBD_CMD_WRITE:
+                        data = yield from reader.readexactly(length)
+                        if(len(data) != length):
+                            raise IOError("%s bytes expected, disconnecting" % length)
+
+                    self.nbd_dispatch(dispatcher, writer, store, cmd, handle, offset, length, data, flags,
+                                      structured, contexts, reserved)
+
+                    # replies are written by the requests as they finish
+                    yield from writer.drain()
 
                 else:
                     self.log.warning("[%s:%s] Unknown cmd %s, disconnecting" % (host, port, cmd))
@@ -254,9 +601,12 @@ class Server(object):
             self.log.error("[%s:%s] %s" % (host, port, ex))
 
         finally:
+            if dispatcher is not None:
+                yield from dispatcher.drain()
+
             if store:
                 try:
-                    store.unlock()
+                    yield from self.aio[store].unlock()
                 except IOError as ex:
                     self.log.error(ex)
 
@@ -267,16 +617,37 @@ class Server(object):
         for store in self.stores.values():
             if store.locked:
                 self.log.debug("%s: Unlocking storage..." % store)
-                store.unlock()
+                try:
+                    store.unlock()
+                except IOError as ex:
+                    self.log.error("%s: %s" % (store, ex))
 
-    def serve_forever(self):
-        """Create and run the asyncio loop"""
+    def start_server(self):
+        """Return a coroutine creating the asyncio server"""
         addr, port = self.address
 
+        if self.buffered:
+            from swiftnbd.protocol import NBDProtocol
+            loop = asyncio.get_event_loop()
+            return loop.create_server(lambda: NBDProtocol(self), addr, port)
+
+        return asyncio.start_server(self.handler, addr, port)
+
+    def serve_forever(self):
+        """Create and run the asyncio loop"""
         loop = asyncio.get_event_loop()
-        stats = asyncio.async(self.log_stats(), loop=loop)
-        coro = asyncio.start_server(self.handler, addr, port, loop=loop)
-        server = loop.run_until_complete(coro)
+        stats = asyncio.ensure_future(self.log_stats(), loop=loop)
+        server = loop.run_until_complete(self.start_server())
+
+        metrics = None
+        if self.metrics_address is not None:
+            from swiftnbd.metrics import Metrics
+            metrics = loop.run_until_complete(Metrics(self).start_server(*self.metrics_address))
+
+        admin = None
+        if self.admin_socket is not None:
+            from swiftnbd.admin import Admin
+            admin = loop.run_until_complete(Admin(self).start_server(self.admin_socket))
 
         loop.add_signal_handler(signal.SIGTERM, loop.stop)
         loop.add_signal_handler(signal.SIGINT, loop.stop)
@@ -286,5 +657,19 @@ class Server(object):
         stats.cancel()
         server.close()
         loop.run_until_complete(server.wait_closed())
+        if metrics is not None:
+            metrics.close()
+            loop.run_until_complete(metrics.wait_closed())
+        if admin is not None:
+            admin.close()
+            loop.run_until_complete(admin.wait_closed())
+            try:
+                os.unlink(self.admin_socket)
+            except OSError:
+                pass
         loop.close()
 
+        # wait for any pending storage operation
+        for aio in self.aio.values():
+            aio.shutdown()
+
@@ -23,14 +23,20 @@ THE SOFTWARE.
 """
 
 import errno
+import logging
 from time import time
 from hashlib import md5
 import socket
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 from swiftclient import client
 
-from swiftnbd.common import getMeta, setMeta
+from swiftnbd.const import concurrency, listing_limit, zero_objects, max_extents
+from swiftnbd.common import getMeta, setMeta, Histogram
 from swiftnbd.cache import Cache
+from swiftnbd.allocation import Allocation
+from swiftnbd.pool import get_pool
 
 class StorageError(IOError):
     """Storage error exception."""
@@ -44,7 +50,10 @@ class SwiftStorage(object):
     May raise StorageError (IOError).
     """
 
-    def __init__(self, auth, container, object_size, objects, cache=None, read_only=False):
+    object_prefix = "disk.part/"
+
+    def __init__(self, auth, container, object_size, objects, cache=None, read_only=False, write_back=None, disk_cache=None, prefetcher=None,
+                 concurrency=concurrency, pool=None, codec=None):
         self.container = container
         self.object_size = object_size
         self.objects = objects
@@ -56,22 +65,72 @@ class SwiftStorage(object):
         self.bytes_in = 0
         self.bytes_out = 0
 
+        # latency of the object requests (GET, PUT and DELETE)
+        self.latency = dict((method, Histogram()) for method in ("GET", "PUT", "DELETE"))
+
+        # optional Codec, the objects are stored compressed
+        self.codec = codec
+
+        # objects never written read as zeros
+        self.zero = bytes(self.object_size)
+
+        # Allocation of the objects, loaded when the storage is locked
+        self.allocation = None
+
+        # a logger per container, so the debug log can be enabled for one container
+        self.log = logging.getLogger("%s.%s" % (__package__, container))
+
         self.cache = cache
         if self.cache is None:
-            self.cache = Cache(1024**2 // self.object_size)
+            self.cache = Cache(1024**2)
+
+        # optional DiskCache, second tier after the memory cache
+        self.disk_cache = disk_cache
 
-        self.cli = client.Connection(**auth)
+        # optional Prefetcher, read-ahead for sequential and strided reads
+        self.prefetcher = prefetcher
+
+        # connections are shared by the stores using the same credentials
+        self.pool = pool
+        if self.pool is None:
+            self.pool = get_pool(auth)
+
+        # up to 'concurrency' requests to the storage at the same time
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+        # optional WriteBack, writes are uploaded in the background
+        self.write_back = write_back
+        if self.write_back is not None:
+            self.write_back.start(self.upload_object)
+
+        if self.prefetcher is not None:
+            self.prefetcher.start(self.download_object, self.is_cached)
 
     def __str__(self):
         return self.container
 
+    def connection(self):
+        """Get a client connection from the pool (context manager)"""
+        return self.pool.connection()
+
+    @contextmanager
+    def timed(self, method):
+        """Measure the latency of an object request (context manager)"""
+        start = time()
+        try:
+            yield
+        finally:
+            self.latency[method].observe(time() - start)
+
     def lock(self, client_id):
         """Set the storage as busy"""
         if self.locked:
             return
 
         try:
-            headers, _ = self.cli.get_container(self.container)
+            with self.connection() as cli:
+                headers, _ = cli.get_container(self.container)
         except (socket.error, client.ClientException) as ex:
             raise StorageError(errno.EIO, "Failed to lock: %s" % ex)
 
@@ -80,75 +139,340 @@ class SwiftStorage(object):
         if self.meta.get('client'):
             raise StorageError(errno.EBUSY, "Already in use: %s" % self.meta['client'])
 
+        if self.disk_cache is not None:
+            # the disk cache is valid if we were the last ones using the container
+            self.disk_cache.load(self.meta.get('last', ''))
+
         self.meta['client'] = "%s@%i" % (client_id, time())
         hdrs = setMeta(self.meta)
         try:
-            self.cli.put_container(self.container, headers=hdrs)
+            with self.connection() as cli:
+                cli.put_container(self.container, headers=hdrs)
         except (socket.error, client.ClientException) as ex:
             raise StorageError(errno.EIO, "Failed to lock: %s" % ex)
 
         self.locked = True
 
+        try:
+            self.allocation = self.load_allocation()
+        except StorageError as ex:
+            # not fatal, the holes will be found reading the objects
+            self.log.warning("%s: %s" % (self.container, ex))
+
+    def list_objects(self):
+        """
+        Generator listing the objects in the container.
+
+        Yields (object_num, info) with the listing information of each object
+        (name, hash, bytes, etc).
+        """
+        marker = ""
+        while True:
+            try:
+                with self.connection() as cli:
+                    _, listing = cli.get_container(self.container, prefix=self.object_prefix,
+                                                   marker=marker, limit=listing_limit)
+            except (socket.error, client.ClientException) as ex:
+                raise StorageError(errno.EIO, "Failed to list the objects: %s" % ex)
+
+            if not listing:
+                break
+
+            for obj in listing:
+                try:
+                    yield int(obj['name'][len(self.object_prefix):]), obj
+                except ValueError:
+                    pass
+            marker = listing[-1]['name']
+
+    def load_allocation(self):
+        """Build the allocation bitmap listing the objects in the container"""
+        allocation = Allocation(self.objects)
+        for object_num, _ in self.list_objects():
+            allocation.add(object_num)
+
+        self.log.debug("%s: %s objects allocated" % (self.container, len(allocation)))
+        return allocation
+
     def unlock(self):
         """Set the storage as free"""
         if not self.locked:
             return
 
+        # the dirty data must be stored before releasing the lock
+        try:
+            self.flush()
+        except IOError as ex:
+            raise StorageError(errno.EIO, "Failed to unlock, dirty data couldn't be stored: %s" % ex)
+
+        if self.disk_cache is not None:
+            self.disk_cache.save(self.meta['client'])
+
         self.meta['last'] = self.meta.get('client')
         self.meta['client'] = ''
         hdrs = setMeta(self.meta)
         try:
-            self.cli.put_container(self.container, headers=hdrs)
+            with self.connection() as cli:
+                cli.put_container(self.container, headers=hdrs)
         except (socket.error, client.ClientException) as ex:
             raise StorageError(errno.EIO, "Failed to unlock: %s" % ex)
 
         self.locked = False
+        self.allocation = None
+
+    def set_concurrency(self, concurrency):
+        """Change the max number of concurrent requests to the storage"""
+        self.concurrency = concurrency
+        # the requests already submitted finish in the old threads, and they exit
+        # once the old executor is released (it's not shut down because a request
+        # may be submitting to it now)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def warm(self, first, last):
+        """
+        Fetch the objects from first to last (both included) into the cache.
+
+        Returns the number of objects fetched that are in the cache.
+        """
+        last = min(last, self.objects - 1)
+        # don't fetch more than the cache can hold
+        last = min(last, first + self.cache.limit // self.object_size - 1)
+        for start in range(first, last + 1, self.concurrency):
+            self.fetch_objects(start, min(start + self.concurrency - 1, last))
+        return sum(1 for object_num in range(first, last + 1) if object_num in self.cache)
+
+    def close(self):
+        """Release the resources of the storage (after unlocking it)"""
+        self.executor.shutdown(wait=True)
+        if self.disk_cache is not None:
+            self.disk_cache.close()
 
     def read(self, size):
-        data = bytearray()
-        _size = size
-        while _size > 0:
-            obj = self.fetch_object(self.object_num)
-            if obj == b'':
-                break
+        data = self.read_at(self.pos, size)
+        self.seek(self.pos + len(data))
+        return data
 
-            if _size + self.object_pos >= self.object_size:
-                data += obj[self.object_pos:]
-                part_size = self.object_size - self.object_pos
+    def write(self, data):
+        self.write_at(self.pos, data)
+        self.seek(self.pos + len(data))
+
+    def read_at(self, offset, size):
+        """
+        Read up to size bytes starting at offset.
+
+        It doesn't use the current position so it is safe to be used from
+        different threads.
+        """
+        return b"".join(self.read_views(offset, size))
+
+    def read_views(self, offset, size):
+        """
+        Read up to size bytes starting at offset as a list of memoryviews.
+
+        The views reference the objects (one view per object) so the data
+        is not copied, see read_at.
+        """
+        if offset < 0 or offset > self.size:
+            raise StorageError(errno.ESPIPE, "Offset out of bounds")
+
+        size = min(size, self.size - offset)
+        if size <= 0:
+            return []
+
+        first = offset // self.object_size
+        last = (offset + size - 1) // self.object_size
+
+        if self.prefetcher is not None:
+            self.prefetcher.access(first, last, self.objects)
+
+        views = []
+        object_pos = offset % self.object_size
+        for obj in self.fetch_objects(first, last):
+            view = memoryview(obj)[object_pos:object_pos + size]
+            size -= len(view)
+            views.append(view)
+            object_pos = 0
+
+        return views
+
+    def write_at(self, offset, data, holes=True):
+        """
+        Write data starting at offset.
+
+        If holes is True the objects that end up being all zeros are deleted
+        instead of stored (they read as zeros anyway).
+
+        It doesn't use the current position so it is safe to be used from
+        different threads.
+        """
+        if self.read_only:
+            raise StorageError(errno.EROFS, "Read only storage")
+
+        if offset < 0 or offset + len(data) > self.size:
+            raise StorageError(errno.ESPIPE, "Offset out of bounds")
+
+        if not data:
+            return
+
+        first = offset // self.object_size
+        last = (offset + len(data) - 1) // self.object_size
+        object_pos = offset % self.object_size
+        reminder = (offset + len(data)) % self.object_size
+
+        # the objects partially written are fetched concurrently
+        partial = []
+        if object_pos != 0:
+            partial.append(first)
+        if reminder != 0 and last not in partial:
+            partial.append(last)
+        futures = dict((object_num, self.executor.submit(self.fetch_object, object_num)) for object_num in partial[1:])
+        objs = dict((object_num, self.fetch_object(object_num)) for object_num in partial[:1])
+        objs.update((object_num, future.result()) for object_num, future in futures.items())
+
+        objs = self._split(first, last, object_pos, data, objs)
+        if holes:
+            objs = self._holes(objs)
+        self.put_objects(objs)
+
+    def _split(self, first, last, object_pos, data, partial):
+        """
+        Split data in objects, patching the objects in partial (object_num ->
+        current object) for the parts of data that don't cover full objects.
+
+        Every byte is copied once into its object (none if data is bytes and
+        covers exactly one object).
+        """
+        if isinstance(data, bytes) and first == last and len(data) == self.object_size:
+            yield first, data
+            return
+
+        view = memoryview(data)
+        pos = 0
+        for object_num in range(first, last + 1):
+            size = min(self.object_size - object_pos, len(view) - pos)
+            if size == self.object_size:
+                obj = bytes(view[pos:pos + size])
             else:
-                data += obj[self.object_pos:self.object_pos+_size]
-                part_size = _size
+                # the current object can't be patched in place because it may
+                # be referenced by a read that is still being sent, so the
+                # new object is assembled from views in a single copy
+                current = memoryview(partial[object_num])
+                obj = b"".join((current[:object_pos], view[pos:pos + size], current[object_pos + size:]))
+            yield object_num, obj
+            pos += size
+            object_pos = 0
+
+    def merge_at(self, object_num, patches):
+        """
+        Apply patches, a list of (object_pos, data), to an object and store it.
+
+        It is used to store at once several writes within an object.
+        """
+        if self.read_only:
+            raise StorageError(errno.EROFS, "Read only storage")
+
+        if object_num < 0 or object_num >= self.objects:
+            raise StorageError(errno.ESPIPE, "Offset out of bounds")
 
-            _size -= part_size
-            self.seek(self.pos + part_size)
+        obj = bytearray(self.fetch_object(object_num))
+        for object_pos, data in patches:
+            obj[object_pos:object_pos + len(data)] = data
+        self.put_objects(self._holes([(object_num, bytes(obj))]))
+
+    def _holes(self, objs):
+        """Replace the zero objects with empty ones (deleted), skip the known holes"""
+        for object_num, data in objs:
+            if data == self.zero:
+                if self.allocation is not None and object_num not in self.allocation:
+                    continue
+                data = b''
+            yield object_num, data
+
+    def zero_at(self, offset, length, hole=True):
+        """
+        Write length zeros starting at offset.
+
+        If hole is True the objects fully covered are deleted (see trim_at),
+        otherwise they are stored.
+        """
+        if hole:
+            self.trim_at(offset, length)
+            return
 
-        return data
+        if self.read_only:
+            raise StorageError(errno.EROFS, "Read only storage")
 
-    def write(self, data):
+        if offset < 0 or offset + length > self.size:
+            raise StorageError(errno.ESPIPE, "Offset out of bounds")
+
+        end = offset + length
+        while offset < end:
+            size = min(end - offset, zero_objects*self.object_size)
+            self.write_at(offset, bytes(size), holes=False)
+            offset += size
+
+    def trim_at(self, offset, length):
+        """
+        Discard length bytes starting at offset.
+
+        The objects fully covered are deleted and the parts of the objects
+        partially covered are zeroed, so the range reads as zeros.
+        """
         if self.read_only:
             raise StorageError(errno.EROFS, "Read only storage")
 
-        _data = data[:]
-        if self.object_pos != 0:
-            # object-align the beginning of data
-            obj = self.fetch_object(self.object_num)
-            _data = obj[:self.object_pos] + _data
-            self.seek(self.pos - self.object_pos)
+        if offset < 0 or offset + length > self.size:
+            raise StorageError(errno.ESPIPE, "Offset out of bounds")
+
+        end = offset + length
+        # objects fully covered: from first to last (not included)
+        first = -(-offset // self.object_size)
+        last = end // self.object_size
+
+        if first >= last:
+            self._zero_at(offset, length)
+            return
+
+        self._zero_at(offset, first*self.object_size - offset)
+        self._zero_at(last*self.object_size, end - last*self.object_size)
+        self.put_objects((object_num, b'') for object_num in range(first, last)
+                         if self.allocation is None or object_num in self.allocation)
+
+    def _zero_at(self, offset, length):
+        """Write zeros in a range of one or two objects (if they aren't holes)"""
+        if length <= 0:
+            return
+
+        if self.allocation is not None:
+            first = offset // self.object_size
+            last = (offset + length - 1) // self.object_size
+            if first not in self.allocation and last not in self.allocation:
+                return
 
-        reminder = len(_data) % self.object_size
-        if reminder != 0:
-            # object-align the end of data
-            obj = self.fetch_object(self.object_num + (len(_data) // self.object_size))
-            _data += obj[reminder:]
+        self.write_at(offset, bytes(length))
+
+    def extents(self, offset, length, limit=max_extents):
+        """
+        Allocation status of a range as a list of (length, hole) extents.
+
+        Up to limit extents are returned, so they may not cover all the range.
+        """
+        if offset < 0 or offset + length > self.size:
+            raise StorageError(errno.ESPIPE, "Offset out of bounds")
 
-        assert len(_data) % self.object_size == 0, "Data not aligned!"
+        if self.allocation is None:
+            # unknown, assume it's all data
+            return [(length, False)] if length else []
 
-        offs = 0
-        object_num = self.object_num
-        while offs < len(_data):
-            self.put_object(object_num, _data[offs:offs+self.object_size])
-            offs += self.object_size
-            object_num += 1
+        end = offset + length
+        extents = []
+        while offset < end and len(extents) < limit:
+            object_num = offset // self.object_size
+            hole = object_num not in self.allocation
+            extent_end = min(self.allocation.next_change(object_num)*self.object_size, end)
+            extents.append((extent_end - offset, hole))
+            offset = extent_end
+        return extents
 
     def tell(self):
         return self.pos
@@ -168,53 +492,211 @@ class SwiftStorage(object):
         return self.object_size * self.objects
 
     def flush(self):
-        self.cache.flush()
+        """Wait until all the written data is stored"""
+        if self.write_back is not None:
+            self.write_back.flush()
 
     def object_name(self, object_num):
-        return "disk.part/%08i" % object_num
+        return "%s%08i" % (self.object_prefix, object_num)
+
+    def is_cached(self, object_num):
+        """Check if an object is available without fetching it"""
+        if object_num in self.cache:
+            return True
+        if self.allocation is not None and object_num not in self.allocation \
+                and (self.write_back is None or self.write_back.get(object_num) is None):
+            # a hole
+            return True
+        if self.write_back is not None and self.write_back.get(object_num) is not None:
+            return True
+        if self.disk_cache is not None and object_num in self.disk_cache:
+            return True
+        return False
+
+    def fetch_objects(self, first, last):
+        """
+        Fetch the objects from first to last (both included).
+
+        The objects that are not cached are fetched concurrently.
+        """
+        if first == last:
+            return [self.fetch_object(first)]
+
+        object_nums = range(first, last + 1)
+        futures = dict((object_num, self.executor.submit(self.fetch_object, object_num))
+                       for object_num in object_nums if not self.is_cached(object_num))
+
+        objs = []
+        for object_num in object_nums:
+            if object_num in futures:
+                objs.append(futures[object_num].result())
+            else:
+                objs.append(self.fetch_object(object_num))
+        return objs
 
     def fetch_object(self, object_num):
         if object_num >= self.objects:
             return b''
 
-        data = self.cache.get(object_num)
+        data = None
+        if self.write_back is not None:
+            data = self.write_back.get(object_num)
+            if data is not None and not data:
+                # pending delete
+                return self.zero
+        if not data and self.allocation is not None and object_num not in self.allocation:
+            return self.zero
         if not data:
-            object_name = self.object_name(object_num)
-            try:
-                _, data = self.cli.get_object(self.container, object_name)
-            except socket.error as ex:
+            data = self.cache.get(object_num)
+        if not data and self.prefetcher is not None:
+            data = self.prefetcher.take(object_num)
+            if data is self.prefetcher.HOLE:
+                return self.zero
+            if data:
+                self.cache.set(object_num, data)
+                if self.disk_cache is not None:
+                    self.disk_cache.set(object_num, data)
+        if not data and self.disk_cache is not None:
+            data = self.disk_cache.get(object_num)
+            if data:
+                self.cache.set(object_num, data)
+        if not data:
+            data = self.download_object(object_num)
+            if data is None:
+                if self.allocation is not None:
+                    self.allocation.discard(object_num)
+                return self.zero
+
+            self.cache.set(object_num, data)
+            if self.disk_cache is not None:
+                self.disk_cache.set(object_num, data)
+        return data
+
+    def download_object(self, object_num):
+        """Get an object from the storage, None if it doesn't exist"""
+        object_name = self.object_name(object_num)
+        try:
+            with self.connection() as cli, self.timed("GET"):
+                _, data = cli.get_object(self.container, object_name)
+        except socket.error as ex:
+            raise StorageError(errno.EIO, ex)
+        except client.ClientException as ex:
+            if ex.http_status != 404:
                 raise StorageError(errno.EIO, ex)
-            except client.ClientException as ex:
-                if ex.http_status != 404:
-                    raise StorageError(errno.EIO, ex)
-                return b'\0' * self.object_size
+            return None
 
-            if len(data) != self.object_size:
-                raise StorageError(errno.EIO,
-                                   "Invalid object size (%s), %s expected" % len(data), self.object_size
-                                   )
+        self.bytes_in += len(data)
+
+        if self.codec is not None and len(data) != self.object_size:
+            try:
+                data = self.codec.decompress(data)
+            except Exception as ex:
+                raise StorageError(errno.EIO, "Failed to decompress %s: %s" % (object_name, ex))
+
+        if len(data) != self.object_size:
+            raise StorageError(errno.EIO,
+                               "Invalid object size (%s), %s expected" % (len(data), self.object_size)
+                               )
 
-            self.bytes_in += self.object_size
-            self.cache.set(object_num, data)
         return data
 
     def put_object(self, object_num, data):
+        """Put an object, empty data deletes it (it will read as zeros)"""
         if object_num >= self.objects:
             raise StorageError(errno.ESPIPE, "Write offset out of bounds")
 
+        if self.allocation is not None:
+            if data:
+                self.allocation.add(object_num)
+            else:
+                self.allocation.discard(object_num)
+
+        if self.write_back is not None:
+            self.write_back.set(object_num, data)
+        else:
+            self.upload_object(object_num, data)
+
+    def put_objects(self, objects):
+        """
+        Put several objects from an iterable of (object_num, data).
+
+        The objects are uploaded concurrently, and if any of them fails the
+        first error is raised once all the uploads have finished.
+        """
+        objects = list(objects)
+        if len(objects) == 1 or self.write_back is not None:
+            for object_num, data in objects:
+                self.put_object(object_num, data)
+            return
+
+        futures = [self.executor.submit(self.put_object, object_num, data) for object_num, data in objects]
+        error = None
+        for future in futures:
+            try:
+                future.result()
+            except IOError as ex:
+                if error is None:
+                    error = ex
+        if error is not None:
+            raise error
+
+    def encode(self, data):
+        """The payload to store for the data of an object"""
+        if self.codec is not None:
+            compressed = self.codec.compress(data)
+            # the objects that don't compress are stored as they are
+            if len(compressed) < self.object_size:
+                return compressed
+        return data
+
+    def upload_object(self, object_num, data):
+        if not data:
+            self.delete_object(object_num)
+            return
+
+        self.upload_payload(object_num, self.encode(data))
+
+        self.cache.set(object_num, data)
+        if self.disk_cache is not None:
+            self.disk_cache.set(object_num, data)
+
+    def upload_payload(self, object_num, payload):
+        """Put the payload of an object (see encode) verifying its checksum"""
         object_name = self.object_name(object_num)
         try:
-            etag = self.cli.put_object(self.container, object_name, data)
+            with self.connection() as cli, self.timed("PUT"):
+                etag = cli.put_object(self.container, object_name, payload)
         except (socket.error, client.ClientException) as ex:
             raise StorageError(errno.EIO, ex)
 
-        checksum = md5(data).hexdigest()
+        if self.prefetcher is not None:
+            # any data prefetched before this point is stale
+            self.prefetcher.invalidate(object_num)
+
+        checksum = md5(payload).hexdigest()
         etag = etag.lower()
         if etag != checksum:
             raise StorageError(errno.EAGAIN, "Block integrity error (object_num=%s)" % object_num)
 
-        self.bytes_out += self.object_size
-        self.cache.set(object_num, data)
+        self.bytes_out += len(payload)
+
+    def delete_object(self, object_num):
+        object_name = self.object_name(object_num)
+        try:
+            with self.connection() as cli, self.timed("DELETE"):
+                cli.delete_object(self.container, object_name)
+        except socket.error as ex:
+            raise StorageError(errno.EIO, ex)
+        except client.ClientException as ex:
+            if ex.http_status != 404:
+                raise StorageError(errno.EIO, ex)
+
+        if self.prefetcher is not None:
+            self.prefetcher.invalidate(object_num)
+
+        self.cache.discard(object_num)
+        if self.disk_cache is not None:
+            self.disk_cache.discard(object_num)
 
     def seek(self, offset):
         if offset < 0 or offset > self.size:
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+swiftnbd. parallel transfers for the control tool
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import sys
+from time import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from swiftnbd.const import transfer_jobs
+
+def parallel(func, items, jobs=transfer_jobs):
+    """
+    Run func(item) for every item in 'jobs' threads.
+
+    Yields (item, result) as they finish, and the exceptions are raised when
+    their item would be yielded. Up to jobs*2 items are in flight.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = dict()
+        items = iter(items)
+        while True:
+            for item in items:
+                pending[executor.submit(func, item)] = item
+                if len(pending) >= jobs*2:
+                    break
+
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                yield item, future.result()
+
+def batches(items, size):
+    """Generator grouping the items in lists of up to 'size' items"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class Progress(object):
+    """
+    Progress line of a transfer with its throughput.
+
+    The progress is counted in items (of 'total') and the throughput in
+    the bytes transferred.
+    """
+    def __init__(self, label, total, quiet=False, done=0):
+        self.label = label
+        self.total = total
+        self.quiet = quiet
+        self.done = done
+        self.bytes = 0
+        self.start = time()
+        self.shown = 0
+
+    def rate(self):
+        """Throughput in MB/s"""
+        return self.bytes / max(time() - self.start, 0.001) / 1024**2
+
+    def update(self, done=1, size=0):
+        self.done += done
+        self.bytes += size
+        if self.quiet:
+            return
+
+        # don't update the line too often
+        now = time()
+        if now - self.shown < 0.2 and self.done < self.total:
+            return
+        self.shown = now
+
+        percent = 100*self.done // self.total if self.total else 100
+        sys.stdout.write("\r%s [%.2d%%] %.2f MB/s " % (self.label, percent, self.rate()))
+        sys.stdout.flush()
+
+    def finish(self):
+        if not self.quiet:
+            sys.stdout.write("\r")
+            sys.stdout.flush()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+swiftnbd. write-back management
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import logging
+import threading
+from time import time
+from collections import OrderedDict
+
+from swiftnbd.const import (write_back_age, write_back_size, write_back_workers,
+        write_back_retry, write_back_retry_max)
+
+class WriteBack(object):
+    """
+    Write-back manager.
+
+    Keeps the dirty objects written to a store and uploads them in background
+    threads once they are older than 'max_age' seconds or when there are more
+    than 'max_dirty' bytes of dirty data. Writes absorbed in an object that is
+    still dirty don't generate new uploads.
+
+    Writers wait when the dirty data doubles 'max_dirty'. Failed uploads are
+    retried after 'retry_delay' seconds, doubling the delay on each consecutive
+    failure.
+    """
+    def __init__(self, max_age=write_back_age, max_dirty=write_back_size, workers=write_back_workers,
+                 retry_delay=write_back_retry):
+        self.max_age = max_age
+        self.max_dirty = max_dirty
+        self.workers = workers
+        self.retry_delay = retry_delay
+
+        # object_num: (data, dirty since)
+        self.dirty = OrderedDict()
+        self.uploading = dict()
+        self.dirty_bytes = 0
+        self.flushing = 0
+        self.errors = 0
+        self.error = None
+        self.failures = 0
+        self.retry_at = 0
+
+        self.cond = threading.Condition()
+        self.threads = []
+        self.upload = None
+
+        self.log = logging.getLogger(__package__)
+
+    def __len__(self):
+        with self.cond:
+            return len(self.dirty) + len(self.uploading)
+
+    def start(self, upload):
+        """
+        Set the upload function.
+
+        upload(object_num, data) is called to store an object. The upload
+        threads are started on the first write (the server may fork after
+        the stores are setup).
+        """
+        self.upload = upload
+
+    def _start_threads(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def get(self, object_num):
+        """Get the data of a dirty object or None"""
+        with self.cond:
+            if object_num in self.dirty:
+                return self.dirty[object_num][0]
+            return self.uploading.get(object_num)
+
+    def set(self, object_num, data):
+        """
+        Mark an object as dirty.
+
+        Raises the storage error if there's no room for it and an upload
+        failed while waiting.
+        """
+        with self.cond:
+            if not self.threads:
+                self._start_threads()
+
+            errors = self.errors
+            self.cond.wait_for(lambda: self._pending_bytes() < self.max_dirty*2 or self.errors != errors)
+            if self._pending_bytes() >= self.max_dirty*2:
+                raise self.error
+
+            if object_num in self.dirty:
+                old, since = self.dirty[object_num]
+                self.dirty[object_num] = (data, since)
+                self.dirty_bytes += len(data) - len(old)
+                self.log.debug("write-back absorbed: %s" % object_num)
+            else:
+                self.dirty[object_num] = (data, time())
+                self.dirty_bytes += len(data)
+                self.log.debug("write-back dirty: %s" % object_num)
+
+            self.cond.notify_all()
+
+    def flush(self):
+        """
+        Wait until all the dirty data is stored.
+
+        Raises the storage error if any upload failed meanwhile.
+        """
+        with self.cond:
+            errors = self.errors
+            self.flushing += 1
+            self.cond.notify_all()
+            try:
+                self.cond.wait_for(lambda: (not self.dirty and not self.uploading) or self.errors != errors)
+            finally:
+                self.flushing -= 1
+
+            if self.errors != errors:
+                raise self.error
+
+    def _pending_bytes(self):
+        """Bytes not stored yet, including the uploads in progress"""
+        return self.dirty_bytes + sum(len(data) for data in self.uploading.values())
+
+    def _next(self):
+        """Oldest dirty object that is due (and not being uploaded), or None"""
+        now = time()
+        if now < self.retry_at:
+            return None
+
+        due = self.flushing or self.dirty_bytes > self.max_dirty
+        for object_num, (data, since) in self.dirty.items():
+            if object_num in self.uploading:
+                # uploads of the same object must be in order
+                continue
+            if due or now - since >= self.max_age:
+                return object_num
+            # the rest are younger
+            break
+        return None
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                object_num = self._next()
+                while object_num is None:
+                    timeout = None
+                    if self.dirty:
+                        _, since = next(iter(self.dirty.values()))
+                        wake = since + self.max_age
+                        if self.retry_at > time():
+                            wake = self.retry_at
+                        timeout = max(wake - time(), 0.01)
+                    self.cond.wait(timeout)
+                    object_num = self._next()
+
+                data, since = self.dirty.pop(object_num)
+                self.dirty_bytes -= len(data)
+                self.uploading[object_num] = data
+
+            try:
+                self.upload(object_num, data)
+            except IOError as ex:
+                with self.cond:
+                    self.failures += 1
+                    delay = min(self.retry_delay*2**(self.failures - 1), write_back_retry_max)
+                    self.retry_at = time() + delay
+                    self.log.error("write-back failed, retrying in %.1fs: %s" % (delay, ex))
+
+                    del self.uploading[object_num]
+                    if object_num not in self.dirty:
+                        # retry later
+                        self.dirty[object_num] = (data, time())
+                        self.dirty_bytes += len(data)
+                    self.errors += 1
+                    self.error = ex
+                    self.cond.notify_all()
+                continue
+
+            with self.cond:
+                del self.uploading[object_num]
+                self.failures = 0
+                self.cond.notify_all()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the admin socket
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import json
+import shutil
+import asyncio
+import logging
+import tempfile
+import unittest
+
+class MockStore(object):
+    def __init__(self, name):
+        from swiftnbd.cache import Cache
+        from swiftnbd.common import Histogram
+        from swiftnbd.prefetch import Prefetcher
+        self.name = name
+        self.object_size = 8
+        self.objects = 16
+        self.locked = True
+        self.bytes_in = 10
+        self.bytes_out = 20
+        self.cache = Cache(1024)
+        self.prefetcher = Prefetcher(max_window=4)
+        self.write_back = None
+        self.concurrency = 8
+        self.latency = dict(GET=Histogram((0.1, 1)))
+        self.log = logging.getLogger("swiftnbd.test.%s" % name)
+
+    def __str__(self):
+        return self.name
+
+    def set_concurrency(self, concurrency):
+        self.concurrency = concurrency
+
+    def warm(self, first, last):
+        for object_num in range(first, last + 1):
+            self.cache.set(object_num, b"DATA%04d" % object_num)
+        return last - first + 1
+
+class MockServer(object):
+    def __init__(self, stores):
+        from swiftnbd.common import Stats
+        from swiftnbd.executor import AsyncSwiftStorage
+        self.stores = dict((store.name, store) for store in stores)
+        self.stats = dict((store, Stats(store)) for store in stores)
+        self.aio = dict((store, AsyncSwiftStorage(store, 1)) for store in stores)
+
+@unittest.skipUnless(hasattr(asyncio, "coroutine"), "requires generator based coroutines")
+class AdminTestCase(unittest.TestCase):
+    """Test the admin socket."""
+    def setUp(self):
+        from swiftnbd.admin import Admin, AdminError
+        self.AdminError = AdminError
+        self.store = MockStore("disk0")
+        self.server = MockServer([self.store])
+        self.admin = Admin(self.server)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.store.log.setLevel(logging.NOTSET)
+        for aio in self.server.aio.values():
+            aio.shutdown()
+        self.loop.close()
+
+    def execute(self, command, export=None, value=None):
+        return self.loop.run_until_complete(self.admin.execute(command, export, value))
+
+    def test_stats(self):
+        self.server.stats[self.store].request("read", 512)
+        result = self.execute("stats")
+        self.assertEqual(list(result.keys()), ["disk0"])
+        self.assertEqual(result["disk0"]["requests"], dict(read=1))
+        self.assertEqual(result["disk0"]["swift"], dict(bytes_in=10, bytes_out=20))
+        self.assertEqual(result["disk0"]["read_ahead"]["max"], 4)
+        self.assertNotIn("write_back", result["disk0"])
+        self.assertEqual(self.execute("stats", "disk0"), result["disk0"])
+
+    def test_unknown(self):
+        self.assertRaises(self.AdminError, self.execute, "other", "disk0")
+        self.assertRaises(self.AdminError, self.execute, "cache", "disk1")
+        self.assertRaises(self.AdminError, self.execute, "cache")
+
+    def test_cache(self):
+        for object_num in (0, 1, 2, 5, 7, 8):
+            self.store.cache.set(object_num, b"DATA%04d" % object_num)
+        result = self.execute("cache", "disk0")
+        self.assertEqual(result["objects"], 6)
+        self.assertEqual(result["size"], 48)
+        self.assertEqual(result["ranges"], [[0, 2], [5, 5], [7, 8]])
+
+    def test_cache_limit(self):
+        result = self.execute("cache-limit", "disk0", 2)
+        self.assertEqual(result["limit"], 2*1024**2)
+        self.assertEqual(self.store.cache.limit, 2*1024**2)
+        self.assertRaises(self.AdminError, self.execute, "cache-limit", "disk0", 0)
+        self.assertRaises(self.AdminError, self.execute, "cache-limit", "disk0", "1")
+
+    def test_drop_cache(self):
+        self.store.cache.set(0, b"DATA0000")
+        self.assertEqual(self.execute("drop-cache", "disk0"), dict(dropped=8))
+        self.assertEqual(len(self.store.cache), 0)
+
+    def test_warm_cache(self):
+        self.assertEqual(self.execute("warm-cache", "disk0", [2, 5]), dict(cached=4))
+        self.assertEqual(sorted(self.store.cache.keys()), [2, 3, 4, 5])
+        self.assertRaises(self.AdminError, self.execute, "warm-cache", "disk0", [5, 2])
+        self.assertRaises(self.AdminError, self.execute, "warm-cache", "disk0", [16, 20])
+        self.assertRaises(self.AdminError, self.execute, "warm-cache", "disk0", 2)
+
+    def test_read_ahead(self):
+        self.execute("read-ahead", "disk0", 32)
+        self.assertEqual(self.store.prefetcher.max_window, 32)
+        self.store.prefetcher = None
+        self.assertRaises(self.AdminError, self.execute, "read-ahead", "disk0", 32)
+
+    def test_concurrency(self):
+        self.assertEqual(self.execute("concurrency", "disk0", 2), dict(concurrency=2))
+        self.assertEqual(self.store.concurrency, 2)
+        self.assertRaises(self.AdminError, self.execute, "concurrency", "disk0", 0)
+
+    def test_debug(self):
+        self.assertEqual(self.execute("debug", "disk0", "on"), dict(debug=True))
+        self.assertTrue(self.store.log.isEnabledFor(logging.DEBUG))
+        self.execute("debug", "disk0", "off")
+        self.assertEqual(self.store.log.level, logging.NOTSET)
+        self.assertRaises(self.AdminError, self.execute, "debug", "disk0", "yes")
+
+    @unittest.skipUnless(hasattr(asyncio, "start_unix_server"), "requires unix sockets")
+    def test_handler(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "admin.sock")
+
+        @asyncio.coroutine
+        def request(*requests):
+            listener = yield from self.admin.start_server(path)
+            reader, writer = yield from asyncio.open_unix_connection(path)
+            replies = []
+            for data in requests:
+                writer.write(data + b"\n")
+                replies.append(json.loads((yield from reader.readline()).decode("utf-8")))
+            # the server closes the connection at the end of the requests
+            writer.write_eof()
+            yield from reader.read()
+            writer.close()
+            listener.close()
+            yield from listener.wait_closed()
+            return replies
+
+        try:
+            replies = self.loop.run_until_complete(request(
+                json.dumps(dict(command="concurrency", export="disk0", value=4)).encode("utf-8"),
+                json.dumps(dict(command="cache", export="disk1")).encode("utf-8"),
+                b"not json",
+            ))
+            self.assertEqual(replies[0], dict(result=dict(concurrency=4)))
+            self.assertIn("error", replies[1])
+            self.assertIn("error", replies[2])
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the allocation module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+
+class AllocationTestCase(unittest.TestCase):
+    """Test the allocation bitmap class."""
+    def setUp(self):
+        from swiftnbd.allocation import Allocation
+        self.Allocation = Allocation
+        self.allocation = Allocation(20)
+
+    def test_empty(self):
+        self.assertEqual(len(self.allocation), 0)
+        self.assertFalse(0 in self.allocation)
+        self.assertEqual(len(self.allocation.bitmap), 3)
+
+    def test_add(self):
+        self.allocation.add(9)
+        self.allocation.add(9)
+        self.assertTrue(9 in self.allocation)
+        self.assertFalse(8 in self.allocation)
+        self.assertFalse(10 in self.allocation)
+        self.assertEqual(len(self.allocation), 1)
+
+    def test_discard(self):
+        self.allocation.add(7)
+        self.allocation.add(8)
+        self.allocation.discard(7)
+        self.allocation.discard(7)
+        self.assertFalse(7 in self.allocation)
+        self.assertTrue(8 in self.allocation)
+        self.assertEqual(len(self.allocation), 1)
+
+    def test_out_of_bounds(self):
+        self.allocation.add(20)
+        self.allocation.add(-1)
+        self.assertFalse(20 in self.allocation)
+        self.assertFalse(-1 in self.allocation)
+        self.assertEqual(len(self.allocation), 0)
+
+    def test_clear(self):
+        for object_num in range(20):
+            self.allocation.add(object_num)
+        self.assertEqual(len(self.allocation), 20)
+        self.allocation.clear()
+        self.assertEqual(len(self.allocation), 0)
+        self.assertFalse(19 in self.allocation)
+
+    def test_next_change(self):
+        self.assertEqual(self.allocation.next_change(0), 20)
+        for object_num in (3, 4, 5, 17):
+            self.allocation.add(object_num)
+        self.assertEqual(self.allocation.next_change(0), 3)
+        self.assertEqual(self.allocation.next_change(3), 6)
+        self.assertEqual(self.allocation.next_change(6), 17)
+        self.assertEqual(self.allocation.next_change(17), 18)
+        self.assertEqual(self.allocation.next_change(18), 20)
+
+    def test_next_change_full(self):
+        for object_num in range(20):
+            self.allocation.add(object_num)
+        self.assertEqual(self.allocation.next_change(0), 20)
+        self.assertEqual(self.allocation.next_change(12), 20)
+
+    def test_to_from_bytes(self):
+        for object_num in (0, 7, 8, 19):
+            self.allocation.add(object_num)
+        allocation = self.Allocation.from_bytes(20, self.allocation.to_bytes())
+        self.assertEqual(len(allocation), 4)
+        for object_num in range(20):
+            self.assertEqual(object_num in allocation, object_num in self.allocation)
+
+    def test_from_bytes_invalid(self):
+        self.assertRaises(ValueError, self.Allocation.from_bytes, 20, b"\0")
@@ -22,64 +22,159 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import time
 import unittest
 
 class CacheTestCase(unittest.TestCase):
     """Test the cache class."""
     def setUp(self):
         from swiftnbd.cache import Cache
-        self.cache = Cache(10)
+        # room for 10 objects of 8 bytes, and no correlated references
+        self.cache = Cache(80, correlated=0)
 
     def tearDown(self):
         pass
 
     def test_get_miss(self):
         data = self.cache.get(1)
-        self.assertEqual(self.cache.ref[1], 0)
         self.assertEqual(data, None)
+        self.assertEqual(self.cache.misses, 1)
 
     def test_get_hit(self):
-        self.cache.set(1, "DATA1")
-        self.cache.set(2, "DATA2")
+        self.cache.set(1, b"DATA0001")
+        self.cache.set(2, b"DATA0002")
 
         data = self.cache.get(1)
-        self.assertEqual(data, "DATA1")
-        # set + get = 2 refferences
-        self.assertEqual(self.cache.ref[1], 2)
+        self.assertEqual(data, b"DATA0001")
 
         data = self.cache.get(2)
-        self.assertEqual(data, "DATA2")
+        self.assertEqual(data, b"DATA0002")
+        self.assertEqual(self.cache.hits, 2)
 
     def test_set(self):
-        self.cache.set(1, "1")
-        self.assertEqual(self.cache.ref[1], 1)
-        self.cache.set(1, "1")
-        self.assertEqual(self.cache.ref[1], 2)
+        self.cache.set(1, b"1")
+        self.assertEqual(self.cache.size, 1)
+        self.cache.set(1, b"11")
+        self.assertEqual(self.cache.size, 2)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get(1), b"11")
 
     def test_limit(self):
         for i in range(10):
-            self.cache.set(i, "DATA%s" % i)
+            self.cache.set(i, b"DATA%04d" % i)
 
-        self.assertEqual(len(self.cache.data), 10)
+        self.assertEqual(len(self.cache), 10)
+        self.assertEqual(self.cache.size, 80)
 
-        for i in range(10):
-            self.assertEqual(self.cache.ref[i], 1)
+        # 0 is the least recently used
+        self.cache.set(10, b"DATA0010")
+
+        self.assertEqual(len(self.cache), 10)
+        self.assertEqual(self.cache.size, 80)
+        self.assertTrue(0 not in self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+
+        # bigger objects release more than one object
+        self.cache.set(11, b"DATA0011"*2)
+        self.assertEqual(len(self.cache), 9)
+        self.assertTrue(1 not in self.cache)
+        self.assertTrue(2 not in self.cache)
+
+    def test_object_over_limit(self):
+        self.cache.set(1, b"X"*81)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_scan_resistance(self):
+        # working set, used more than once
+        for i in range(5):
+            self.cache.set(i, b"DATA%04d" % i)
+            self.cache.get(i)
+
+        # a scan
+        for i in range(100, 200):
+            self.cache.set(i, b"DATA%04d" % i)
+
+        for i in range(5):
+            self.assertEqual(self.cache.get(i), b"DATA%04d" % i)
+
+    def test_correlated_references(self):
+        from swiftnbd.cache import Cache
+        self.cache = Cache(80, correlated=0.05)
+
+        self.cache.set(1, b"DATA0001")
+        self.cache.get(1)
+        self.cache.get(1)
+        self.assertTrue(1 in self.cache.recent)
 
+        time.sleep(0.06)
+        self.cache.get(1)
+        self.assertTrue(1 in self.cache.frequent)
+
+    def test_scan_resistance_sub_object(self):
+        from swiftnbd.cache import Cache
+        self.cache = Cache(80, correlated=0.05)
+
+        # working set, used more than once
+        for i in range(5):
+            self.cache.set(i, b"DATA%04d" % i)
+        time.sleep(0.06)
+        for i in range(5):
+            self.cache.get(i)
+
+        # a scan reading each object in 4 requests: 1 miss and 3 hits
+        for i in range(100, 200):
+            if self.cache.get(i) is None:
+                self.cache.set(i, b"DATA%04d" % i)
+            for _ in range(3):
+                self.assertEqual(self.cache.get(i), b"DATA%04d" % i)
+
+        for i in range(5):
+            self.assertEqual(self.cache.get(i), b"DATA%04d" % i)
+
+    def test_adapts_to_recent(self):
         for i in range(10):
-            for j in range(i+1):
-                self.cache.get(i)
+            self.cache.set(i, b"DATA%04d" % i)
+            self.cache.get(i)
 
-        # 0 should be discarded
-        self.cache.set(10, "DATA11")
+        # objects seen once that come back after being released get more room
+        for _ in range(3):
+            for i in range(100, 108):
+                if self.cache.get(i) is None:
+                    self.cache.set(i, b"DATA%04d" % i)
 
-        self.assertEqual(len(self.cache.data), 10)
-        self.assertEqual(self.cache.ref[0], 0)
-        self.assertTrue(0 not in self.cache.data)
+        self.assertTrue(self.cache.target > 0)
 
-        # 10 should be discarded
-        self.cache.set(11, "DATA12")
+    def test_discard(self):
+        self.cache.set(1, b"DATA0001")
+        self.cache.set(2, b"DATA0002")
+        self.cache.get(2)
 
-        self.assertEqual(len(self.cache.data), 10)
-        self.assertEqual(self.cache.ref[10], 0)
-        self.assertTrue(10 not in self.cache.data)
+        self.cache.discard(1)
+        self.cache.discard(2)
+        self.cache.discard(3)
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
 
+    def test_flush(self):
+        for i in range(10):
+            self.cache.set(i, b"DATA%04d" % i)
+
+        self.cache.flush()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.cache.size, 0)
+        self.assertEqual(self.cache.get(1), None)
+
+    def test_resize(self):
+        for i in range(10):
+            self.cache.set(i, b"DATA%04d" % i)
+
+        # the oldest objects are released
+        self.cache.resize(40)
+        self.assertEqual(self.cache.limit, 40)
+        self.assertEqual(len(self.cache), 5)
+        self.assertEqual(sorted(self.cache.keys()), [5, 6, 7, 8, 9])
+
+        self.cache.resize(160)
+        for i in range(20):
+            self.cache.set(i, b"DATA%04d" % i)
+        self.assertEqual(len(self.cache), 20)
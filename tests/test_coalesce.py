@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the coalesce module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+import unittest
+
+@unittest.skipUnless(hasattr(asyncio, "coroutine"), "requires generator based coroutines")
+class CoalescerTestCase(unittest.TestCase):
+    """Test the write coalescing class."""
+    def setUp(self):
+        from swiftnbd.coalesce import Coalescer
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.merged = []
+        @asyncio.coroutine
+        def merge(object_num, patches):
+            yield from asyncio.sleep(0)
+            self.merged.append((object_num, list(patches)))
+        self.coalescer = Coalescer(512, merge, window=0.05)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_writes(self, writes):
+        @asyncio.coroutine
+        def _writes():
+            yield from asyncio.wait([asyncio.ensure_future(self.coalescer.write(offset, data)) for offset, data in writes])
+        self.loop.run_until_complete(_writes())
+
+    def test_accepts(self):
+        self.assertTrue(self.coalescer.accepts(0, 256))
+        self.assertTrue(self.coalescer.accepts(256, 256))
+        # full object
+        self.assertFalse(self.coalescer.accepts(0, 512))
+        # more than one object
+        self.assertFalse(self.coalescer.accepts(256, 512))
+        self.coalescer.window = 0
+        self.assertFalse(self.coalescer.accepts(0, 256))
+
+    def test_merged(self):
+        self.run_writes([(0, b'A'*16), (16, b'B'*16), (512, b'C'*16)])
+        self.assertEqual(sorted(self.merged), [(0, [(0, b'A'*16), (16, b'B'*16)]), (1, [(0, b'C'*16)])])
+        self.assertEqual(len(self.coalescer), 0)
+
+    def test_expire(self):
+        @asyncio.coroutine
+        def _writes():
+            write = asyncio.ensure_future(self.coalescer.write(0, b'A'*16))
+            yield from asyncio.sleep(0)
+            self.coalescer.expire(0, 16)
+            yield from asyncio.wait_for(write, 0.02)
+        self.loop.run_until_complete(_writes())
+        self.assertEqual(self.merged, [(0, [(0, b'A'*16)])])
+
+    def test_flush(self):
+        @asyncio.coroutine
+        def _writes():
+            write = asyncio.ensure_future(self.coalescer.write(512, b'A'*16))
+            yield from asyncio.sleep(0)
+            yield from asyncio.wait_for(self.coalescer.flush(), 0.02)
+            self.assertTrue(write.done())
+        self.loop.run_until_complete(_writes())
+
+    def test_merge_error(self):
+        @asyncio.coroutine
+        def merge(object_num, patches):
+            raise IOError("failed")
+        self.coalescer.merge = merge
+        self.assertRaises(IOError, self.loop.run_until_complete, self.coalescer.write(0, b'A'))
+
+    def test_overlay(self):
+        @asyncio.coroutine
+        def _writes():
+            write = asyncio.ensure_future(self.coalescer.write(500, b'A'*12))
+            yield from asyncio.sleep(0)
+            snapshot = self.coalescer.snapshot(256, 512)
+            views = self.coalescer.overlay(256, [b'\0'*256, b'\0'*256], snapshot)
+            self.coalescer.expire()
+            yield from write
+            return views
+        views = self.loop.run_until_complete(_writes())
+        self.assertEqual(b"".join(views), b'\0'*244 + b'A'*12 + b'\0'*256)
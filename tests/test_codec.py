@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the codec module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import unittest
+
+class CodecTestCase(unittest.TestCase):
+    """Test the compression codecs."""
+    def test_zlib(self):
+        from swiftnbd.codec import get_codec
+        codec = get_codec("zlib")
+        data = b"DATA"*1024
+        compressed = codec.compress(data)
+        self.assertTrue(len(compressed) < len(data))
+        self.assertEqual(codec.decompress(compressed), data)
+
+    def test_available(self):
+        from swiftnbd.codec import codecs, get_codec
+        for name in codecs():
+            codec = get_codec(name)
+            self.assertEqual(codec.decompress(codec.compress(b"DATA"*16)), b"DATA"*16)
+
+    def test_unknown(self):
+        from swiftnbd.codec import get_codec
+        self.assertRaises(ValueError, get_codec, "unknown")
+
+    def test_register(self):
+        from swiftnbd.codec import codecs, get_codec, register, _codecs
+        register("test", bytes, bytes)
+        try:
+            self.assertTrue("test" in codecs())
+            self.assertEqual(get_codec("test").name, "test")
+        finally:
+            del _codecs["test"]
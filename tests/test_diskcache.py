@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the disk cache module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+class DiskCacheTestCase(unittest.TestCase):
+    """Test the disk cache class."""
+    def setUp(self):
+        from swiftnbd.diskcache import DiskCache
+        self.DiskCache = DiskCache
+
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, "container.cache")
+        # room for 4 objects of 512 bytes
+        self.cache = DiskCache(self.filename, 2048, 512)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.path)
+
+    def test_get_miss(self):
+        self.assertEqual(self.cache.get(1), None)
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_get_hit(self):
+        self.cache.set(1, b'X'*512)
+        self.assertEqual(self.cache.get(1), b'X'*512)
+        self.assertEqual(self.cache.hits, 1)
+
+    def test_limit(self):
+        for i in range(4):
+            self.cache.set(i, bytes([i])*512)
+        self.cache.get(0)
+
+        # 1 is the least recently used
+        self.cache.set(4, b'X'*512)
+        self.assertEqual(len(self.cache), 4)
+        self.assertEqual(self.cache.get(1), None)
+        self.assertEqual(self.cache.get(0), b'\0'*512)
+        self.assertEqual(os.path.getsize(self.filename), 2048)
+
+    def test_checksum(self):
+        self.cache.set(1, b'X'*512)
+        slot, _ = self.cache.index[1]
+        os.pwrite(self.cache.fd, b'Y', slot*512)
+        self.assertEqual(self.cache.get(1), None)
+
+    def test_discard(self):
+        self.cache.set(1, b'X'*512)
+        self.cache.discard(1)
+        self.assertEqual(self.cache.get(1), None)
+        self.assertEqual(len(self.cache.free), 4)
+
+    def test_load_same_session(self):
+        self.cache.set(1, b'X'*512)
+        self.cache.save("session")
+
+        cache = self.DiskCache(self.filename, 2048, 512)
+        cache.load("session")
+        self.assertEqual(cache.get(1), b'X'*512)
+        self.assertEqual(len(cache.free), 3)
+        cache.close()
+
+    def test_load_other_session(self):
+        self.cache.set(1, b'X'*512)
+        self.cache.save("session")
+
+        cache = self.DiskCache(self.filename, 2048, 512)
+        cache.load("other")
+        self.assertEqual(cache.get(1), None)
+        cache.close()
+
+    def test_load_other_object_size(self):
+        self.cache.set(1, b'X'*512)
+        self.cache.save("session")
+
+        cache = self.DiskCache(self.filename, 2048, 256)
+        cache.load("session")
+        self.assertEqual(cache.get(1), None)
+        cache.close()
+
+    def test_load_once(self):
+        self.cache.set(1, b'X'*512)
+        self.cache.save("session")
+
+        self.cache.load("session")
+        self.cache.load("session")
+        self.assertEqual(self.cache.get(1), None)
+
+    def test_discard_while_writing(self):
+        pwrite = os.pwrite
+        def _pwrite(fd, data, offset):
+            self.cache.discard(1)
+            return pwrite(fd, data, offset)
+
+        with mock.patch("swiftnbd.diskcache.os.pwrite", _pwrite):
+            self.cache.set(1, b'X'*512)
+
+        self.assertEqual(self.cache.get(1), None)
+        self.assertEqual(len(self.cache.free), 4)
+
+    def test_concurrent_set(self):
+        def worker(num):
+            for i in range(50):
+                self.cache.set(i % 6, bytes([num])*512)
+
+        threads = [threading.Thread(target=worker, args=(num,)) for num in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # no slot is lost or used twice
+        slots = [slot for slot, _ in self.cache.index.values()] + self.cache.free
+        self.assertEqual(sorted(slots), list(range(4)))
+        for object_num in list(self.cache.index):
+            data = self.cache.get(object_num)
+            self.assertEqual(len(set(data)), 1)
+
+    def test_close(self):
+        self.cache.close()
+        self.cache.close()
+        self.assertEqual(self.cache.fd, None)
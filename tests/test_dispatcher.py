@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the dispatcher module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+import unittest
+
+@unittest.skipUnless(hasattr(asyncio, "coroutine"), "requires generator based coroutines")
+class DispatcherTestCase(unittest.TestCase):
+    """Test the request dispatcher class."""
+    def setUp(self):
+        from swiftnbd.dispatcher import Dispatcher
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dispatcher = Dispatcher(max_requests=4, max_bytes=1024, block_size=512)
+        self.events = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def op(self, name, delay=0):
+        @asyncio.coroutine
+        def _op():
+            self.events.append("start %s" % name)
+            yield from asyncio.sleep(delay)
+            self.events.append("end %s" % name)
+        return _op()
+
+    def submit(self, requests):
+        """requests are (name, delay, offset, length, write, barrier[, merge])"""
+        @asyncio.coroutine
+        def _submit():
+            for name, delay, offset, length, write, barrier, *merge in requests:
+                yield from self.dispatcher.reserve(length)
+                self.dispatcher.start(self.op(name, delay), offset, length, write, barrier, merge=bool(merge and merge[0]))
+            yield from self.dispatcher.drain()
+        self.loop.run_until_complete(_submit())
+
+    def test_reads_concurrent(self):
+        self.submit([("r1", 0.02, 0, 512, False, False),
+                     ("r2", 0, 0, 512, False, False),
+                     ])
+        self.assertEqual(self.events, ["start r1", "start r2", "end r2", "end r1"])
+
+    def test_non_overlapping_concurrent(self):
+        self.submit([("w1", 0.02, 0, 512, True, False),
+                     ("w2", 0, 512, 512, True, False),
+                     ])
+        self.assertEqual(self.events, ["start w1", "start w2", "end w2", "end w1"])
+
+    def test_overlapping_ordered(self):
+        self.submit([("w1", 0.02, 0, 512, True, False),
+                     ("r1", 0, 256, 16, False, False),
+                     ("w2", 0, 0, 16, True, False),
+                     ])
+        self.assertEqual(self.events, ["start w1", "end w1", "start r1", "end r1", "start w2", "end w2"])
+
+    def test_same_block_ordered(self):
+        # different bytes of the same block
+        self.submit([("w1", 0.02, 0, 16, True, False),
+                     ("w2", 0, 500, 8, True, False),
+                     ])
+        self.assertEqual(self.events, ["start w1", "end w1", "start w2", "end w2"])
+
+    def test_barrier(self):
+        self.submit([("w1", 0.02, 0, 512, True, False),
+                     ("r1", 0.01, 1024, 512, False, False),
+                     ("f", 0, 0, 0, False, True),
+                     ])
+        self.assertEqual(self.events[-2:], ["start f", "end f"])
+
+    def test_requests_budget(self):
+        seen = []
+
+        @asyncio.coroutine
+        def _submit():
+            for num in range(8):
+                yield from self.dispatcher.reserve(0)
+                seen.append(len(self.dispatcher))
+                self.dispatcher.start(self.op(num, 0.01), num*512, 0)
+            yield from self.dispatcher.drain()
+        self.loop.run_until_complete(_submit())
+
+        self.assertEqual(max(seen), 4)
+        self.assertEqual(len(self.dispatcher), 0)
+
+    def test_bytes_budget(self):
+        seen = []
+
+        @asyncio.coroutine
+        def _submit():
+            for num in range(4):
+                yield from self.dispatcher.reserve(512)
+                seen.append(self.dispatcher.bytes)
+                self.dispatcher.start(self.op(num, 0.01), num*512, 512)
+            yield from self.dispatcher.drain()
+        self.loop.run_until_complete(_submit())
+
+        self.assertEqual(max(seen), 1024)
+        self.assertEqual(self.dispatcher.bytes, 0)
+
+    def test_over_budget_runs_alone(self):
+        self.submit([("big", 0, 0, 4096, True, False)])
+        self.assertEqual(self.events, ["start big", "end big"])
+
+    def test_failed_request_releases(self):
+        @asyncio.coroutine
+        def _fail():
+            yield from asyncio.sleep(0)
+            raise IOError("failed")
+
+        @asyncio.coroutine
+        def _submit():
+            yield from self.dispatcher.reserve(512)
+            self.dispatcher.start(_fail(), 0, 512, True)
+            yield from self.dispatcher.drain()
+        self.loop.run_until_complete(_submit())
+
+        self.assertEqual(len(self.dispatcher), 0)
+        self.assertEqual(self.dispatcher.bytes, 0)
+
+    def test_try_reserve(self):
+        self.assertTrue(self.dispatcher.try_reserve(1024))
+        # over the bytes budget
+        self.assertFalse(self.dispatcher.try_reserve(512))
+        self.assertTrue(self.dispatcher.try_reserve(0))
+        self.assertEqual(len(self.dispatcher), 2)
+        self.assertEqual(self.dispatcher.bytes, 1024)
+
+    def test_merged_writes_concurrent(self):
+        # merged writes in the same block only wait for overlapping ones
+        self.submit([("m1", 0.02, 0, 16, True, False, True),
+                     ("m2", 0, 16, 16, True, False, True),
+                     ("m3", 0, 8, 16, True, False, True),
+                     ])
+        self.assertEqual(self.events, ["start m1", "start m2", "end m2", "end m1", "start m3", "end m3"])
+
+    def test_reads_dont_wait_merged(self):
+        self.submit([("m1", 0.02, 0, 16, True, False, True),
+                     ("r1", 0, 0, 16, False, False, False),
+                     ("w1", 0, 256, 16, True, False, False),
+                     ])
+        self.assertEqual(self.events, ["start m1", "start r1", "end r1", "end m1", "start w1", "end w1"])
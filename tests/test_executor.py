@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the executor module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+import threading
+import unittest
+
+class MockStore(object):
+    """Mock up for SwiftStorage recording the thread of each call."""
+    object_size = 512
+
+    def __init__(self):
+        self.data = bytearray(b'\xff'*1024)
+        self.threads = set()
+        self.locked = None
+
+    def __str__(self):
+        return "mock"
+
+    def lock(self, client_id):
+        self.threads.add(threading.get_ident())
+        self.locked = client_id
+
+    def unlock(self):
+        self.threads.add(threading.get_ident())
+        self.locked = None
+
+    def read_at(self, offset, size):
+        self.threads.add(threading.get_ident())
+        return bytes(self.data[offset:offset+size])
+
+    def read_views(self, offset, size):
+        self.threads.add(threading.get_ident())
+        views = []
+        while size > 0 and offset < len(self.data):
+            end = min(offset + size, offset - offset % self.object_size + self.object_size)
+            views.append(memoryview(bytes(self.data[offset:end])))
+            size -= end - offset
+            offset = end
+        return views
+
+    def write_at(self, offset, data):
+        self.threads.add(threading.get_ident())
+        if offset+len(data) > len(self.data):
+            raise IOError("out of bounds")
+        self.data[offset:offset+len(data)] = data
+
+    def merge_at(self, object_num, patches):
+        self.threads.add(threading.get_ident())
+        self.merged = patches
+        for object_pos, data in patches:
+            self.write_at(object_num*self.object_size + object_pos, data)
+
+    def flush(self):
+        self.threads.add(threading.get_ident())
+
+@unittest.skipUnless(hasattr(asyncio, "coroutine"), "requires generator based coroutines")
+class AsyncSwiftStorageTestCase(unittest.TestCase):
+    """Test the async facade over the storage."""
+    def setUp(self):
+        from swiftnbd.executor import AsyncSwiftStorage
+        self.store = MockStore()
+        self.aio = AsyncSwiftStorage(self.store, workers=2)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.aio.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_coro(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def test_read_write(self):
+        self.run_coro(self.aio.write(10, b'X'*4))
+        self.assertEqual(self.run_coro(self.aio.read(8, 8)), b'\xff\xffXXXX\xff\xff')
+        self.run_coro(self.aio.flush())
+
+    def test_lock_unlock(self):
+        self.run_coro(self.aio.lock("client"))
+        self.assertEqual(self.store.locked, "client")
+        self.run_coro(self.aio.unlock())
+        self.assertEqual(self.store.locked, None)
+
+    def test_runs_in_thread_pool(self):
+        self.run_coro(self.aio.read(0, 8))
+        self.assertNotIn(threading.get_ident(), self.store.threads)
+
+    def test_error(self):
+        with self.assertRaises(IOError):
+            self.run_coro(self.aio.write(1020, b'X'*8))
+
+    def test_write_merged(self):
+        self.aio.coalescer.window = 0.01
+
+        @asyncio.coroutine
+        def _writes():
+            yield from asyncio.wait([asyncio.ensure_future(self.aio.write(offset, b'X'*4, merge=True))
+                                     for offset in (512, 516)])
+        self.run_coro(_writes())
+        self.assertEqual(self.store.merged, [(0, b'X'*4), (4, b'X'*4)])
+        self.assertEqual(self.run_coro(self.aio.read(510, 12)), b'\xff\xff' + b'X'*8 + b'\xff\xff')
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the metrics
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+import unittest
+
+class HistogramTestCase(unittest.TestCase):
+    """Test the histogram class."""
+    def setUp(self):
+        from swiftnbd.common import Histogram
+        self.histogram = Histogram((0.1, 1, 10))
+
+    def test_observe(self):
+        for value in (0.05, 0.5, 0.7, 20):
+            self.histogram.observe(value)
+        buckets, counts, count, total = self.histogram.snapshot()
+        self.assertEqual(buckets, (0.1, 1, 10))
+        # the buckets are cumulative
+        self.assertEqual(counts, [1, 3, 3])
+        self.assertEqual(count, 4)
+        self.assertAlmostEqual(total, 21.25)
+
+class StatsTestCase(unittest.TestCase):
+    """Test the stats class."""
+    def setUp(self):
+        from swiftnbd.common import Stats
+        self.stats = Stats("store")
+
+    def test_request(self):
+        self.stats.request("read", 512)
+        self.stats.request("read", 1024)
+        self.stats.request("write", error=True)
+        self.assertEqual(self.stats.requests, dict(read=2, write=1))
+        self.assertEqual(self.stats.bytes, dict(read=1536, write=0))
+        self.assertEqual(self.stats.errors, dict(write=1))
+
+class MockStore(object):
+    def __init__(self, name):
+        from swiftnbd.cache import Cache
+        from swiftnbd.common import Histogram
+        self.name = name
+        self.bytes_in = 10
+        self.bytes_out = 20
+        self.cache = Cache(1024)
+        self.write_back = None
+        self.latency = dict(GET=Histogram((0.1, 1)))
+
+    def __str__(self):
+        return self.name
+
+class MockAsyncStorage(object):
+    def __init__(self):
+        self.coalescer = []
+
+class MockServer(object):
+    def __init__(self, stores):
+        from swiftnbd.common import Stats
+        self.stats = dict((store, Stats(store)) for store in stores)
+        self.aio = dict((store, MockAsyncStorage()) for store in stores)
+
+@unittest.skipUnless(hasattr(asyncio, "coroutine"), "requires generator based coroutines")
+class MetricsTestCase(unittest.TestCase):
+    """Test the metrics HTTP listener."""
+    def setUp(self):
+        from swiftnbd.metrics import Metrics
+        self.store = MockStore('disk"0')
+        self.server = MockServer([self.store])
+        self.metrics = Metrics(self.server)
+
+    def test_render(self):
+        self.server.stats[self.store].request("read", 512)
+        self.store.cache.set(0, b'X'*512)
+        self.store.cache.get(0)
+        self.store.latency["GET"].observe(0.5)
+
+        lines = self.metrics.render().splitlines()
+        self.assertIn('swiftnbd_requests_total{command="read",export="disk\\"0"} 1', lines)
+        self.assertIn('swiftnbd_request_bytes_total{command="read",export="disk\\"0"} 512', lines)
+        self.assertIn('swiftnbd_requests_in_flight{export="disk\\"0"} 0', lines)
+        self.assertIn('swiftnbd_swift_request_duration_seconds_bucket{export="disk\\"0",le="0.1",method="GET"} 0', lines)
+        self.assertIn('swiftnbd_swift_request_duration_seconds_bucket{export="disk\\"0",le="1",method="GET"} 1', lines)
+        self.assertIn('swiftnbd_swift_request_duration_seconds_bucket{export="disk\\"0",le="+Inf",method="GET"} 1', lines)
+        self.assertIn('swiftnbd_swift_request_duration_seconds_count{export="disk\\"0",method="GET"} 1', lines)
+        self.assertIn('swiftnbd_cache_hits_total{export="disk\\"0"} 1', lines)
+        self.assertIn('swiftnbd_cache_size_bytes{export="disk\\"0"} 512', lines)
+        self.assertIn('swiftnbd_dirty_bytes{export="disk\\"0"} 0', lines)
+        self.assertIn('# TYPE swiftnbd_swift_request_duration_seconds histogram', lines)
+
+    def test_handler(self):
+        loop = asyncio.new_event_loop()
+
+        @asyncio.coroutine
+        def get(path):
+            listener = yield from self.metrics.start_server("127.0.0.1", 0)
+            port = listener.sockets[0].getsockname()[1]
+            reader, writer = yield from asyncio.open_connection("127.0.0.1", port)
+            writer.write(("GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n" % path).encode("latin-1"))
+            response = yield from reader.read()
+            writer.close()
+            listener.close()
+            return response
+
+        try:
+            response = loop.run_until_complete(get("/metrics"))
+            self.assertTrue(response.startswith(b"HTTP/1.0 200 OK\r\n"))
+            self.assertIn(b"swiftnbd_cache_limit_bytes", response)
+
+            response = loop.run_until_complete(get("/other"))
+            self.assertTrue(response.startswith(b"HTTP/1.0 404"))
+        finally:
+            loop.close()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the pool module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import socket
+import unittest
+
+class MockClient(object):
+    """Mock up for the swiftclient module."""
+
+    class ClientException(Exception):
+        def __init__(self, msg, http_status=None):
+            super().__init__(msg)
+            self.http_status = http_status
+
+    class Connection(object):
+        auths = 0
+        created = 0
+
+        def __init__(self, preauthurl=None, preauthtoken=None, **kwargs):
+            self.url = preauthurl
+            self.token = preauthtoken
+            self.broken = False
+            self.closed = False
+            if preauthtoken is not None:
+                MockClient.Connection.created += 1
+
+        def get_auth(self):
+            MockClient.Connection.auths += 1
+            return "url", "token%d" % MockClient.Connection.auths
+
+        def head_account(self):
+            if self.broken:
+                raise socket.error("broken pipe")
+
+        def close(self):
+            self.closed = True
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    """Test the connection pool class."""
+    def setUp(self):
+        from swiftnbd import pool
+        self.pool_module = pool
+        self.client = pool.client
+        pool.client = MockClient
+        pool.reset_pools()
+        MockClient.Connection.auths = 0
+        MockClient.Connection.created = 0
+        self.auth = dict(authurl="url", user="user", key="key")
+        self.pool = pool.ConnectionPool(self.auth, size=2, token_ttl=100, check_delay=10)
+
+    def tearDown(self):
+        self.pool_module.client = self.client
+        self.pool_module.reset_pools()
+
+    def test_reuse(self):
+        with self.pool.connection() as cli:
+            first = cli
+        with self.pool.connection() as cli:
+            self.assertIs(cli, first)
+        self.assertEqual(len(self.pool), 1)
+        self.assertEqual(MockClient.Connection.auths, 1)
+        self.assertEqual(cli.token, "token1")
+
+    def test_size(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                self.assertIsNot(first, second)
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(MockClient.Connection.created, 2)
+
+    def test_token_refresh(self):
+        with self.pool.connection() as cli:
+            pass
+        self.assertEqual(cli.token, "token1")
+
+        # not yet
+        self.pool.maintain()
+        self.assertEqual(MockClient.Connection.auths, 1)
+
+        # token about to expire
+        self.pool.auth_time -= 95
+        self.assertEqual(self.pool.maintain(), 10)
+        self.assertEqual(MockClient.Connection.auths, 2)
+        self.assertEqual(self.pool.token, "token2")
+
+        with self.pool.connection() as cli:
+            self.assertEqual(cli.token, "token2")
+        self.assertEqual(len(self.pool), 1)
+
+    def test_discard_broken_connection(self):
+        with self.assertRaises(socket.error):
+            with self.pool.connection() as cli:
+                raise socket.error("connection reset")
+        self.assertTrue(cli.closed)
+        self.assertEqual(len(self.pool), 0)
+
+        with self.pool.connection() as other:
+            self.assertIsNot(other, cli)
+
+    def test_keep_on_http_error(self):
+        with self.assertRaises(MockClient.ClientException):
+            with self.pool.connection() as cli:
+                raise MockClient.ClientException("not found", http_status=404)
+        self.assertFalse(cli.closed)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_check_idle_connections(self):
+        with self.pool.connection() as first:
+            with self.pool.connection() as second:
+                pass
+        first.broken = True
+
+        # idle for long enough to be checked
+        self.pool.idle = type(self.pool.idle)((cli, last - 20) for cli, last in self.pool.idle)
+        self.pool.check()
+
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+        self.assertEqual(len(self.pool), 1)
+
+    def test_shared_pool(self):
+        from swiftnbd.swift import SwiftStorage
+        first = SwiftStorage(dict(self.auth), "container1", 512, 8)
+        second = SwiftStorage(dict(self.auth), "container2", 512, 8)
+        other = SwiftStorage(dict(self.auth, user="other"), "container3", 512, 8)
+        self.assertIs(first.pool, second.pool)
+        self.assertIsNot(first.pool, other.pool)
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the read-ahead module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import time
+import threading
+import unittest
+
+class PrefetcherTestCase(unittest.TestCase):
+    """Test the read-ahead class."""
+    def setUp(self):
+        from swiftnbd.prefetch import Prefetcher
+        self.prefetcher = Prefetcher(max_window=4, workers=2)
+        self.downloaded = []
+        self.cached = set()
+        self.prefetcher.start(self.download, lambda object_num: object_num in self.cached)
+
+    def tearDown(self):
+        self.prefetcher.executor.shutdown(wait=True)
+
+    def download(self, object_num):
+        self.downloaded.append(object_num)
+        return b"DATA%04d" % object_num
+
+    def wait(self):
+        self.prefetcher.executor.shutdown(wait=True)
+
+    def test_random_no_prefetch(self):
+        for object_num in (5, 1, 9, 3):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.assertEqual(self.downloaded, [])
+
+    def test_sequential(self):
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.assertEqual(sorted(self.downloaded), [3, 4])
+
+        self.assertEqual(self.prefetcher.take(3), b"DATA0003")
+        self.assertEqual(self.prefetcher.hits, 1)
+        # the window grows when prefetched data is used
+        self.assertEqual(self.prefetcher.window, 3)
+
+    def test_sequential_small_reads(self):
+        # several reads on the same object don't break the run
+        for object_num in (0, 0, 1, 1, 2, 2):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.assertEqual(sorted(self.downloaded), [3, 4])
+
+    def test_strided(self):
+        for object_num in (0, 10, 20):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.assertEqual(sorted(self.downloaded), [30, 40])
+
+    def test_end_of_disk(self):
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 4)
+        self.wait()
+        self.assertEqual(self.downloaded, [3])
+
+    def test_skip_cached(self):
+        self.cached.add(3)
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.assertEqual(self.downloaded, [4])
+
+    def test_invalidate(self):
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.prefetcher.invalidate(3)
+        self.assertEqual(self.prefetcher.take(3), None)
+        self.assertEqual(self.prefetcher.take(4), b"DATA0004")
+
+    def test_invalidate_inflight(self):
+        release = threading.Event()
+
+        def download(object_num):
+            release.wait()
+            return b"DATA%04d" % object_num
+
+        self.prefetcher.download = download
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.prefetcher.invalidate(3)
+        release.set()
+        self.assertEqual(self.prefetcher.take(3), None)
+        self.assertEqual(self.prefetcher.take(4), b"DATA0004")
+
+    def test_wasted(self):
+        # runs that are never used shrink the window
+        for object_num in range(0, 40, 2):
+            self.prefetcher.access(object_num, object_num + 1, 100)
+        self.wait()
+        self.assertTrue(self.prefetcher.wasted > 0)
+        self.assertTrue(len(self.prefetcher) <= 8)
+
+    def test_hole(self):
+        def download(object_num):
+            self.downloaded.append(object_num)
+            return None
+
+        self.prefetcher.download = download
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.assertIs(self.prefetcher.take(3), self.prefetcher.HOLE)
+        self.assertEqual(self.prefetcher.hits, 1)
+
+    def test_take_queued(self):
+        release = threading.Event()
+
+        def download(object_num):
+            release.wait()
+            self.downloaded.append(object_num)
+            return b"DATA%04d" % object_num
+
+        self.prefetcher.download = download
+        self.prefetcher.window = 4
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 100)
+
+        # 2 workers: 3 and 4 are being fetched, 5 and 6 are queued
+        for _ in range(100):
+            if self.prefetcher.started == {3, 4}:
+                break
+            time.sleep(0.01)
+        self.assertEqual(self.prefetcher.take(6), None)
+        release.set()
+        self.assertEqual(self.prefetcher.take(3), b"DATA0003")
+        self.wait()
+        self.assertEqual(sorted(self.downloaded), [3, 4, 5])
+
+    def test_no_stride(self):
+        # reads starting on the same object are not a strided run
+        for first, last in ((0, 2), (0, 1), (0, 0), (0, 1)):
+            self.prefetcher.access(first, last, 100)
+        self.wait()
+        self.assertEqual(self.downloaded, [])
+
+    def test_resize(self):
+        self.prefetcher.resize(0)
+        for object_num in range(3):
+            self.prefetcher.access(object_num, object_num, 100)
+        self.wait()
+        self.assertEqual(self.downloaded, [])
+
+        self.prefetcher.resize(8)
+        self.assertEqual(self.prefetcher.window, 2)
+        self.assertEqual(self.prefetcher.max_window, 8)
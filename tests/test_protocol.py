@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the protocol module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+import struct
+import unittest
+
+class MockTransport(object):
+    def __init__(self):
+        self.data = b''
+        self.reading = True
+        self.closed = False
+
+    def write(self, data):
+        self.data += bytes(data)
+
+    def writelines(self, data):
+        for buffer in data:
+            self.write(buffer)
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 10809) if name == "peername" else default
+
+    def pause_reading(self):
+        self.reading = False
+
+    def resume_reading(self):
+        self.reading = True
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+def request(cmd, handle, offset, length, data=b''):
+    return struct.pack(">LHHQQL", 0x25609513, 0, cmd, handle, offset, length) + data
+
+@unittest.skipUnless(hasattr(asyncio, "coroutine"), "requires generator based coroutines")
+class NBDProtocolTestCase(unittest.TestCase):
+    """Test the buffered protocol class."""
+    def setUp(self):
+        from swiftnbd.server import Server
+        from swiftnbd.protocol import NBDProtocol
+        from swiftnbd.dispatcher import Dispatcher
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.server = Server(("127.0.0.1", 0), dict(), max_requests=2)
+        self.requests = []
+        def nbd_dispatch(dispatcher, writer, store, cmd, handle, offset, length, data, *args):
+            self.requests.append((cmd, handle, offset, length, data))
+        self.server.nbd_dispatch = nbd_dispatch
+
+        self.protocol = NBDProtocol(self.server, buffer_size=1024)
+        self.protocol.transport = MockTransport()
+        # negotiation done
+        self.protocol.negotiating = False
+        self.protocol.dispatcher = Dispatcher(max_requests=2)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def feed(self, data, chunk_size):
+        for pos in range(0, len(data), chunk_size):
+            chunk = data[pos:pos + chunk_size]
+            buffer = self.protocol.get_buffer(len(chunk))
+            self.assertTrue(len(buffer) >= len(chunk))
+            buffer[:len(chunk)] = chunk
+            self.protocol.buffer_updated(len(chunk))
+
+    def test_parse_partial(self):
+        self.feed(request(0, 1, 0, 512) + request(1, 2, 512, 16, b'X'*16), 5)
+        self.assertEqual(self.requests, [(0, 1, 0, 512, None), (1, 2, 512, 16, b'X'*16)])
+
+    def test_large_payload(self):
+        data = b'Y'*4096
+        self.feed(request(1, 1, 0, len(data), data), 1000)
+        self.assertEqual(self.requests, [(1, 1, 0, 4096, data)])
+        self.assertEqual(self.protocol.payload, None)
+
+    def test_data_received(self):
+        data = b'Z'*2048
+        self.protocol.data_received(request(1, 1, 0, len(data), data) + request(0, 2, 0, 512))
+        self.assertEqual(self.requests, [(1, 1, 0, 2048, data), (0, 2, 0, 512, None)])
+
+    def test_wait_room(self):
+        self.protocol.data_received(request(0, 1, 0, 512) + request(0, 2, 512, 512) + request(0, 3, 0, 512))
+        # max_requests is 2, the third request waits
+        self.assertEqual(len(self.requests), 2)
+        self.assertFalse(self.protocol.transport.reading)
+
+        @asyncio.coroutine
+        def _release():
+            yield from self.protocol.dispatcher._release(512)
+            yield from asyncio.sleep(0)
+            yield from asyncio.sleep(0)
+        self.loop.run_until_complete(_release())
+
+        self.assertEqual(len(self.requests), 3)
+        self.assertTrue(self.protocol.transport.reading)
+
+    def test_bad_magic(self):
+        self.protocol.data_received(b'X'*28)
+        self.loop.run_until_complete(self.protocol.finish())
+        self.assertEqual(self.requests, [])
+        self.assertTrue(self.protocol.transport.closed)
+
+    def test_disconnect(self):
+        self.protocol.data_received(request(2, 1, 0, 0) + request(0, 2, 0, 512))
+        self.loop.run_until_complete(self.protocol.finish())
+        self.assertEqual(self.requests, [])
+        self.assertTrue(self.protocol.transport.closed)
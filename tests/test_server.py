@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the server module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import asyncio
+import struct
+import unittest
+
+class MockStore(object):
+    def __init__(self, object_size, read_only=False):
+        self.object_size = object_size
+        self.read_only = read_only
+
+class MockWriter(object):
+    def __init__(self):
+        self.data = b''
+
+    def write(self, data):
+        self.data += bytes(data)
+
+    def writelines(self, data):
+        for view in data:
+            self.write(view)
+
+    def chunks(self):
+        chunks = []
+        data = self.data
+        while data:
+            (magic, flags, chunk_type, handle, length) = struct.unpack(">LHHQL", data[:20])
+            chunks.append((flags, chunk_type, data[20:20 + length]))
+            data = data[20 + length:]
+        return chunks
+
+@unittest.skipUnless(hasattr(asyncio, "coroutine"), "requires generator based coroutines")
+class ServerTestCase(unittest.TestCase):
+    """Test the server class."""
+    def setUp(self):
+        from swiftnbd.server import Server
+        self.Server = Server
+
+    def test_export_flags(self):
+        server = self.Server(("127.0.0.1", 0), dict())
+        flags = server.export_flags(MockStore(512))
+        self.assertTrue(flags & self.Server.NBD_TRIM_FLAG)
+        self.assertFalse(flags & self.Server.NBD_RO_FLAG)
+
+        flags = server.export_flags(MockStore(512, read_only=True))
+        self.assertTrue(flags & self.Server.NBD_RO_FLAG)
+        self.assertFalse(flags & self.Server.NBD_TRIM_FLAG)
+        self.assertFalse(flags & self.Server.NBD_WRITE_ZEROES_FLAG)
+
+    def test_block_size(self):
+        server = self.Server(("127.0.0.1", 0), dict(), max_request_bytes=1024**2)
+        self.assertEqual(server.block_size(MockStore(65536)), (1, 65536, 1024**2))
+        # preferred is a power of 2
+        self.assertEqual(server.block_size(MockStore(1000)), (1, 512, 1024**2))
+        # max is at least preferred
+        self.assertEqual(server.block_size(MockStore(4*1024**2)), (1, 4*1024**2, 4*1024**2))
+
+    def test_read_chunks(self):
+        server = self.Server(("127.0.0.1", 0), dict())
+        writer = MockWriter()
+        server.nbd_read_chunks(writer, 1, 1024, [b'X'*512, b'\0'*512, b'Y'*256], [(512, False), (512, True)])
+        self.assertEqual(writer.chunks(), [
+            (0, self.Server.NBD_REPLY_TYPE_OFFSET_DATA, struct.pack(">Q", 1024) + b'X'*512),
+            (0, self.Server.NBD_REPLY_TYPE_OFFSET_HOLE, struct.pack(">QL", 1536, 512)),
+            # not covered by the extents
+            (self.Server.NBD_REPLY_FLAG_DONE, self.Server.NBD_REPLY_TYPE_OFFSET_DATA, struct.pack(">Q", 2048) + b'Y'*256),
+            ])
+
+        writer = MockWriter()
+        server.nbd_read_chunks(writer, 1, 0, [], [])
+        self.assertEqual(writer.chunks(), [(self.Server.NBD_REPLY_FLAG_DONE, self.Server.NBD_REPLY_TYPE_NONE, b'')])
+
+    def test_block_status(self):
+        server = self.Server(("127.0.0.1", 0), dict())
+        writer = MockWriter()
+        server.nbd_block_status(writer, 1, {1: "base:allocation"}, [(512, False), (1024, True)])
+        self.assertEqual(writer.chunks(), [
+            (self.Server.NBD_REPLY_FLAG_DONE, self.Server.NBD_REPLY_TYPE_BLOCK_STATUS, struct.pack(">LLLLL", 1, 512, 0, 1024, 3)),
+            ])
+
+    def test_slice_views(self):
+        views = [b'AB', b'CDE', b'F']
+        self.assertEqual([bytes(view) for view in self.Server.slice_views(views, 1, 4)], [b'B', b'CDE'])
+        self.assertEqual([bytes(view) for view in self.Server.slice_views(views, 5, 10)], [b'F'])
+        self.assertEqual(self.Server.slice_views(views, 6, 1), [])
@@ -25,7 +25,9 @@ THE SOFTWARE.
 import unittest
 from hashlib import md5
 from io import StringIO
+import os
 import errno
+import time
 
 class MockConnection(object):
     """
@@ -50,9 +52,26 @@ class MockConnection(object):
 
     @staticmethod
     def Connection(**kwargs):
-        return MockConnection()
+        # the objects are reset in the tests setup, not per connection
+        return object.__new__(MockConnection)
 
-    def get_container(self, container):
+    def get_auth(self):
+        return "url", "token"
+
+    def head_account(self):
+        pass
+
+    def close(self):
+        pass
+
+    def get_container(self, container, prefix="", marker="", limit=None):
+        names = sorted(name for name in MockConnection.objects if name.startswith(prefix) and name > marker)
+        return {}, [dict(name=name,
+                         hash=md5(MockConnection.objects[name]).hexdigest(),
+                         bytes=len(MockConnection.objects[name]),
+                         ) for name in names[:limit]]
+
+    def put_container(self, container, headers=None):
         pass
 
     def get_object(self, container, object_name):
@@ -62,16 +81,28 @@ class MockConnection(object):
             raise MockConnection.ClientException()
 
     def put_object(self, container, object_name, data):
-        assert len(data) == self.object_size, "Data size mismatch"
+        # compressed objects can be smaller
+        assert len(data) <= self.object_size, "Data size mismatch"
         MockConnection.objects[object_name] = data
         return md5(data).hexdigest()
 
+    def delete_object(self, container, object_name):
+        try:
+            del MockConnection.objects[object_name]
+        except KeyError:
+            raise MockConnection.ClientException()
+
 class SwiftStorageTestCase(unittest.TestCase):
     """Test the object-split file class."""
     def setUp(self):
         # monkey-patch swiftclient to use out mock up
         import swiftnbd.swift as swift
+        import swiftnbd.pool as pool
         swift.client = MockConnection
+        pool.client = MockConnection
+        pool.reset_pools()
+        # connections are created on demand, reset the objects now
+        MockConnection()
         from swiftnbd.swift import SwiftStorage
 
         # create a disk doubling the actual size of the mock up so we
@@ -175,7 +206,398 @@ class SwiftStorageTestCase(unittest.TestCase):
         data = self.store.read(1024)
         self.assertEqual(len(data), 512)
 
+    def test_read_multi_object(self):
+        self.store.seek(256)
+        data = self.store.read(512*9)
+        self.assertEqual(data, b'\xff'*(512*7 + 256) + b'\0'*(512 + 256))
+        self.assertEqual(self.store.tell(), 256 + 512*9)
+
+    def test_read_multi_object_error(self):
+        def get_object(self, container, object_name):
+            raise MockConnection.ClientException(500)
+
+        _get_object = MockConnection.get_object
+        MockConnection.get_object = get_object
+        try:
+            self.store.seek(0)
+            self.assertRaises(IOError, self.store.read, 512*4)
+        finally:
+            MockConnection.get_object = _get_object
+
+    def test_write_multi_object(self):
+        self.store.seek(256)
+        self.store.write(b'X'*512*9)
+        self.assertEqual(MockConnection.object(0), b'\xff'*256 + b'X'*256)
+        for object_num in range(1, 9):
+            self.assertEqual(MockConnection.object(object_num), b'X'*512)
+        self.assertEqual(MockConnection.object(9), b'X'*256 + b'\0'*256)
+
+    def test_read_views(self):
+        views = self.store.read_views(7*512 + 256, 1024)
+        self.assertEqual([len(view) for view in views], [256, 512, 256])
+        self.assertEqual(b"".join(views), b'\xff'*256 + b'\0'*768)
+        # the object is not copied
+        self.assertTrue(views[0].obj is self.store.cache.get(7))
+        self.assertEqual(self.store.read_views(16*512, 512), [])
+
+    def test_write_full_object_not_copied(self):
+        data = b'X'*512
+        self.store.write_at(0, data)
+        self.assertTrue(self.store.cache.get(0) is data)
+
+    def test_write_multi_object_bytearray(self):
+        self.store.write_at(256, bytearray(b'X'*512*2))
+        self.assertEqual(MockConnection.object(0), b'\xff'*256 + b'X'*256)
+        self.assertEqual(MockConnection.object(1), b'X'*512)
+        self.assertEqual(MockConnection.object(2), b'X'*256 + b'\xff'*256)
+        self.assertTrue(isinstance(self.store.cache.get(1), bytes))
+
+    def test_merge_at(self):
+        self.store.merge_at(0, [(0, b'X'*16), (8, b'Y'*16), (500, b'Z'*12)])
+        self.assertEqual(MockConnection.object(0), b'X'*8 + b'Y'*16 + b'\xff'*476 + b'Z'*12)
+        self.store.merge_at(9, [(0, b'X'*16)])
+        self.assertEqual(MockConnection.object(9), b'X'*16 + b'\0'*496)
+        self.assertRaises(IOError, self.store.merge_at, 16, [(0, b'X')])
+
+    def test_write_multi_object_error(self):
+        def put_object(self, container, object_name, data):
+            if object_name == "disk.part/00000002":
+                raise MockConnection.ClientException(500)
+            return _put_object(self, container, object_name, data)
+
+        _put_object = MockConnection.put_object
+        MockConnection.put_object = put_object
+        try:
+            self.store.seek(0)
+            self.store.write(b'X'*512*4)
+        except IOError as ex:
+            self.assertEqual(ex.errno, errno.EIO)
+        else:
+            self.fail("didn't raise IOError")
+        finally:
+            MockConnection.put_object = _put_object
+
+        # the other objects were written
+        self.assertEqual(MockConnection.object(3), b'X'*512)
+
     def test_wite_end_of_disk(self):
         self.store.seek(15*512)
         self.assertRaises(IOError, self.store.write, b'X'*1024)
 
+
+    def test_lock_loads_allocation(self):
+        import swiftnbd.swift as swift
+        _listing_limit = swift.listing_limit
+        # several pages
+        swift.listing_limit = 3
+        try:
+            self.store.lock("test")
+        finally:
+            swift.listing_limit = _listing_limit
+
+        self.assertEqual(len(self.store.allocation), 8)
+        self.assertTrue(7 in self.store.allocation)
+        self.assertFalse(8 in self.store.allocation)
+
+        self.store.unlock()
+        self.assertEqual(self.store.allocation, None)
+
+    def test_read_hole_no_get(self):
+        self.store.lock("test")
+
+        def get_object(self, container, object_name):
+            raise AssertionError("unexpected GET of %s" % object_name)
+
+        _get_object = MockConnection.get_object
+        MockConnection.get_object = get_object
+        try:
+            self.store.seek(8*512)
+            data = self.store.read(1024)
+        finally:
+            MockConnection.get_object = _get_object
+
+        self.assertEqual(data, b'\0'*1024)
+        self.assertFalse(8 in self.store.cache)
+
+    def test_write_allocates(self):
+        self.store.lock("test")
+        self.store.seek(8*512 + 256)
+        self.store.write(b'X'*512)
+        self.assertTrue(8 in self.store.allocation)
+        self.assertTrue(9 in self.store.allocation)
+
+        self.store.seek(8*512)
+        data = self.store.read(1024)
+        self.assertEqual(data, b'\0'*256 + b'X'*512 + b'\0'*256)
+
+    def test_extents(self):
+        self.assertEqual(self.store.extents(0, 16*512), [(16*512, False)])
+
+        self.store.lock("test")
+        self.store.seek(12*512)
+        self.store.write(b'X'*512)
+        self.assertEqual(self.store.extents(256, 15*512),
+                         [(8*512 - 256, False), (4*512, True), (512, False), (2*512 + 256, True)])
+        self.assertEqual(self.store.extents(0, 16*512, limit=2), [(8*512, False), (4*512, True)])
+        self.assertEqual(self.store.extents(0, 0), [])
+        self.assertRaises(IOError, self.store.extents, 15*512, 1024)
+
+    def test_trim_full_objects(self):
+        self.store.lock("test")
+        self.store.seek(512)
+        self.store.read(1024)
+        self.store.trim_at(512, 1024)
+
+        self.assertFalse("disk.part/00000001" in MockConnection.objects)
+        self.assertFalse("disk.part/00000002" in MockConnection.objects)
+        self.assertFalse(1 in self.store.allocation)
+        self.assertFalse(1 in self.store.cache)
+        self.assertEqual(MockConnection.object(0), b'\xff'*512)
+
+        self.store.seek(0)
+        data = self.store.read(512*4)
+        self.assertEqual(data, b'\xff'*512 + b'\0'*1024 + b'\xff'*512)
+
+    def test_trim_partial_objects(self):
+        self.store.lock("test")
+        self.store.trim_at(256, 1024)
+
+        self.assertEqual(MockConnection.object(0), b'\xff'*256 + b'\0'*256)
+        self.assertFalse("disk.part/00000001" in MockConnection.objects)
+        self.assertEqual(MockConnection.object(2), b'\0'*256 + b'\xff'*256)
+
+    def test_trim_holes(self):
+        self.store.lock("test")
+
+        def delete_object(self, container, object_name):
+            raise AssertionError("unexpected DELETE of %s" % object_name)
+
+        _delete_object = MockConnection.delete_object
+        MockConnection.delete_object = delete_object
+        try:
+            self.store.trim_at(8*512 + 256, 512*4)
+        finally:
+            MockConnection.delete_object = _delete_object
+
+        self.assertFalse("disk.part/00000008" in MockConnection.objects)
+
+    def test_trim_read_only(self):
+        self.store.read_only = True
+        self.assertRaises(IOError, self.store.trim_at, 0, 512)
+
+    def test_write_zero_object(self):
+        self.store.lock("test")
+        self.store.seek(0)
+        self.store.write(b'\0'*512)
+        self.assertFalse("disk.part/00000000" in MockConnection.objects)
+        self.assertFalse(0 in self.store.allocation)
+
+        self.store.seek(0)
+        self.assertEqual(self.store.read(512), b'\0'*512)
+
+    def test_write_zero_object_hole(self):
+        self.store.lock("test")
+
+        def put_object(self, container, object_name, data):
+            raise AssertionError("unexpected PUT of %s" % object_name)
+
+        _put_object = MockConnection.put_object
+        MockConnection.put_object = put_object
+        try:
+            self.store.seek(8*512)
+            self.store.write(b'\0'*1024)
+        finally:
+            MockConnection.put_object = _put_object
+
+        self.assertFalse("disk.part/00000008" in MockConnection.objects)
+
+    def test_zero_at_hole(self):
+        self.store.lock("test")
+        self.store.zero_at(256, 1024)
+        self.assertEqual(MockConnection.object(0), b'\xff'*256 + b'\0'*256)
+        self.assertFalse("disk.part/00000001" in MockConnection.objects)
+        self.assertEqual(MockConnection.object(2), b'\0'*256 + b'\xff'*256)
+
+    def test_zero_at_no_hole(self):
+        self.store.lock("test")
+        self.store.zero_at(512, 512*8, hole=False)
+        for object_num in range(1, 9):
+            self.assertEqual(MockConnection.object(object_num), b'\0'*512)
+            self.assertTrue(object_num in self.store.allocation)
+        self.assertEqual(MockConnection.object(0), b'\xff'*512)
+
+    def test_compressed(self):
+        from swiftnbd.codec import get_codec
+        self.store.codec = get_codec("zlib")
+
+        self.store.seek(512)
+        self.store.write(b'X'*512)
+        self.assertTrue(len(MockConnection.object(1)) < 512)
+
+        self.store.cache.flush()
+        self.store.seek(512)
+        self.assertEqual(self.store.read(512), b'X'*512)
+
+        # not compressed objects can be read too
+        self.store.seek(0)
+        self.assertEqual(self.store.read(512), b'\xff'*512)
+
+    def test_compressed_incompressible(self):
+        from swiftnbd.codec import get_codec
+        self.store.codec = get_codec("zlib")
+
+        data = os.urandom(512)
+        self.store.seek(512)
+        self.store.write(data)
+        self.assertEqual(MockConnection.object(1), data)
+
+    def test_encode(self):
+        self.assertEqual(self.store.encode(b'X'*512), b'X'*512)
+
+        from swiftnbd.codec import get_codec
+        self.store.codec = get_codec("zlib")
+        payload = self.store.encode(b'X'*512)
+        self.assertTrue(len(payload) < 512)
+
+        self.store.upload_payload(1, payload)
+        self.store.cache.flush()
+        self.store.seek(512)
+        self.assertEqual(self.store.read(512), b'X'*512)
+
+    def test_list_objects(self):
+        listing = dict(self.store.list_objects())
+        self.assertEqual(sorted(listing), list(range(8)))
+        self.assertEqual(listing[0]['hash'], md5(MockConnection.object(0)).hexdigest())
+
+    def test_compressed_invalid(self):
+        from swiftnbd.codec import get_codec
+        self.store.codec = get_codec("zlib")
+
+        MockConnection.objects["disk.part/00000001"] = b'invalid'
+        self.store.seek(512)
+        self.assertRaises(IOError, self.store.read, 512)
+
+class SwiftStorageWriteBackTestCase(unittest.TestCase):
+    """Test the object-split file class with write-back."""
+    def setUp(self):
+        import swiftnbd.swift as swift
+        import swiftnbd.pool as pool
+        swift.client = MockConnection
+        pool.client = MockConnection
+        pool.reset_pools()
+        # connections are created on demand, reset the objects now
+        MockConnection()
+        from swiftnbd.swift import SwiftStorage
+        from swiftnbd.writeback import WriteBack
+
+        # long max age so nothing is uploaded until flush
+        self.write_back = WriteBack(max_age=3600, max_dirty=512*4, workers=2, retry_delay=0.05)
+        self.store = SwiftStorage(dict(), 'container', 512, 16, write_back=self.write_back)
+
+    def tearDown(self):
+        # don't leave uploads running in the background
+        try:
+            self.store.flush()
+        except IOError:
+            pass
+
+    def test_threads_started_on_write(self):
+        self.assertEqual(self.write_back.threads, [])
+        self.store.seek(0)
+        self.store.write(b'X'*512)
+        self.assertEqual(len(self.write_back.threads), 2)
+
+    def test_write_is_deferred(self):
+        self.store.seek(0)
+        self.store.write(b'X'*512)
+        self.assertEqual(MockConnection.object(0), b'\xff'*512)
+
+        self.store.seek(0)
+        data = self.store.read(512)
+        self.assertEqual(data, b'X'*512)
+
+    def test_write_absorbed(self):
+        self.store.seek(0)
+        self.store.write(b'X'*256)
+        self.store.seek(256)
+        self.store.write(b'Y'*256)
+        self.assertEqual(len(self.write_back), 1)
+        self.assertEqual(self.write_back.dirty_bytes, 512)
+
+    def test_flush(self):
+        self.store.seek(256)
+        self.store.write(b'X'*512)
+        self.store.flush()
+        self.assertEqual(len(self.write_back), 0)
+        self.assertEqual(MockConnection.object(0), b'\xff'*256 + b'X'*256)
+        self.assertEqual(MockConnection.object(1), b'X'*256 + b'\xff'*256)
+
+    def test_flush_error(self):
+        def put_object(self, container, object_name, data):
+            raise MockConnection.ClientException(500)
+
+        _put_object = MockConnection.put_object
+        MockConnection.put_object = put_object
+        try:
+            self.store.seek(0)
+            self.store.write(b'X'*512)
+            self.assertRaises(IOError, self.store.flush)
+        finally:
+            MockConnection.put_object = _put_object
+
+    def test_retry_delay(self):
+        uploads = []
+        def put_object(self, container, object_name, data):
+            uploads.append(object_name)
+            raise MockConnection.ClientException(500)
+
+        _put_object = MockConnection.put_object
+        MockConnection.put_object = put_object
+        try:
+            self.store.seek(0)
+            self.store.write(b'X'*512)
+            self.assertRaises(IOError, self.store.flush)
+            time.sleep(0.2)
+        finally:
+            MockConnection.put_object = _put_object
+
+        # 0.05 + 0.1, doubling the delay on each failure
+        self.assertLessEqual(len(uploads), 4)
+        self.store.flush()
+        self.assertEqual(MockConnection.object(0), b'X'*512)
+
+    def test_write_error_when_full(self):
+        def put_object(self, container, object_name, data):
+            raise MockConnection.ClientException(500)
+
+        _put_object = MockConnection.put_object
+        MockConnection.put_object = put_object
+        try:
+            # twice max_dirty can't be stored
+            self.store.seek(0)
+            self.store.write(b'X'*512*8)
+            self.store.seek(512*8)
+            self.assertRaises(IOError, self.store.write, b'X'*512)
+        finally:
+            MockConnection.put_object = _put_object
+
+    def test_trim(self):
+        self.store.seek(0)
+        self.store.write(b'X'*512)
+        self.store.trim_at(0, 512)
+
+        self.store.seek(0)
+        self.assertEqual(self.store.read(512), b'\0'*512)
+
+        self.store.flush()
+        self.assertFalse("disk.part/00000000" in MockConnection.objects)
+
+    def test_size_threshold(self):
+        self.store.seek(0)
+        self.store.write(b'X'*512*5)
+        # over max_dirty, the oldest objects are uploaded without flush
+        for _ in range(100):
+            if self.write_back.dirty_bytes <= 512*4:
+                break
+            time.sleep(0.01)
+        self.assertEqual(MockConnection.object(0), b'X'*512)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+swiftnbd. tests for the transfer module
+Copyright (C) 2013-2016 by Juan J. Martinez <jjm@usebox.net>
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in
+all copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+THE SOFTWARE.
+"""
+
+import io
+import sys
+import unittest
+from threading import Lock
+
+class ParallelTestCase(unittest.TestCase):
+    """Test the parallel transfer helper."""
+    def setUp(self):
+        from swiftnbd.transfer import parallel
+        self.parallel = parallel
+
+    def test_results(self):
+        results = dict(self.parallel(lambda item: item*2, range(50), jobs=4))
+        self.assertEqual(results, dict((item, item*2) for item in range(50)))
+
+    def test_empty(self):
+        self.assertEqual(list(self.parallel(lambda item: item, [])), [])
+
+    def test_bounded(self):
+        lock = Lock()
+        consumed = []
+
+        def items():
+            for item in range(100):
+                with lock:
+                    consumed.append(item)
+                yield item
+
+        gen = self.parallel(lambda item: item, items(), jobs=2)
+        next(gen)
+        # only up to jobs*2 items are taken from the iterator at once
+        self.assertLessEqual(len(consumed), 4)
+        gen.close()
+
+    def test_exception(self):
+        def func(item):
+            if item == 3:
+                raise IOError("failed")
+            return item
+
+        with self.assertRaises(IOError):
+            for _ in self.parallel(func, range(10), jobs=2):
+                pass
+
+class BatchesTestCase(unittest.TestCase):
+    """Test grouping items in batches."""
+    def setUp(self):
+        from swiftnbd.transfer import batches
+        self.batches = batches
+
+    def test_batches(self):
+        self.assertEqual(list(self.batches(range(7), 3)), [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual(list(self.batches(range(6), 3)), [[0, 1, 2], [3, 4, 5]])
+
+    def test_empty(self):
+        self.assertEqual(list(self.batches([], 3)), [])
+
+class ProgressTestCase(unittest.TestCase):
+    """Test the transfer progress line."""
+    def setUp(self):
+        from swiftnbd.transfer import Progress
+        self.Progress = Progress
+        self.stdout = sys.stdout
+        sys.stdout = io.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_update(self):
+        progress = self.Progress("Test", 4, done=1)
+        progress.update(size=1024)
+        progress.update(size=1024)
+        self.assertEqual(progress.done, 3)
+        self.assertEqual(progress.bytes, 2048)
+        self.assertIn("Test [50%]", sys.stdout.getvalue())
+        progress.update()
+        self.assertIn("Test [100%]", sys.stdout.getvalue())
+
+    def test_quiet(self):
+        progress = self.Progress("Test", 4, quiet=True)
+        progress.update(size=1024)
+        progress.finish()
+        self.assertEqual(sys.stdout.getvalue(), "")
+        self.assertEqual(progress.bytes, 1024)